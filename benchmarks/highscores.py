@@ -0,0 +1,81 @@
+"""Compares the highscores page parser against the previous implementation.
+
+Highscores pages saved from Tibia.com can be placed in benchmarks/fixtures, named highscores_<category>.html, and they
+are used for their category. Otherwise, synthetic pages are built with the same markup and size as Tibia.com's
+highscores pages, which only shows the parser works on markup matching its pattern, not on the current site.
+
+Usage: python -m benchmarks.highscores [iterations]
+"""
+import os
+import random
+import re
+import sys
+import timeit
+
+from utils.highscores import parse_highscores, ENCODING
+
+ENTRY = '<TR BGCOLOR=#F1E0C6><td>{rank}</TD><td><a href="https://secure.tibia.com/community/?subtopic=characters&name=' \
+        '{url_name}" >{name}</a></td><td>{vocation}</TD>{title}<td style="text-align: right;" >{value}</TD></TR>'
+VOCATIONS = ["Elite Knight", "Royal Paladin", "Master Sorcerer", "Elder Druid", "Knight", "None"]
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def build_page(loyalty=False, seed=0) -> bytes:
+    """Builds a page with 25 entries, padded with markup like the rest of a real page."""
+    rng = random.Random(seed)
+    entries = []
+    for rank in range(1, 26):
+        name = " ".join(rng.choice(["Sir", "Lady", "Dark", "Bubble", "Eternal", "Oblivion", "Tibia"])
+                        for _ in range(2)) + f" {rank}"
+        entries.append(ENTRY.format(rank=rank, name=name, url_name=name.replace(" ", "+"),
+                                    vocation=rng.choice(VOCATIONS), title="<td>Warden</TD>" if loyalty else "",
+                                    value=f"{rng.randint(1000, 5000000):,}"))
+    padding = '<div class="Border_2"><div class="Border_3"><div class="BoxContent">' * 400
+    page = (padding + '<TABLE><TR><td style="width: 20%;" >Vocation</td></TR>' + "".join(entries) + '</TABLE>'
+            + '<div style="float: left;"><b>&raquo; Pages: <a href="#">1</a></b></div>' + padding)
+    return page.encode(ENCODING)
+
+
+def load_page(category: str, loyalty=False) -> bytes:
+    """Loads the saved page of a category, or builds a synthetic one if there's none."""
+    path = os.path.join(FIXTURES, f"highscores_{category}.html")
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            return f.read()
+    return build_page(loyalty)
+
+
+def legacy_parse_highscores(content: str, category: str):
+    """The previous parser, kept for comparison."""
+    start_index = content.index('<td style="width: 20%;" >Vocation</td>')
+    end_index = content.index('<div style="float: left;"><b>&raquo; Pages:')
+    content = content[start_index:end_index]
+    if category == "loyalty":
+        regex = r'<td>([^<]+)</TD><td><a href="https://secure.tibia.com/community/\?subtopic=characters&name=[^"]+" >' \
+                r'([^<]+)</a></td><td>([^<]+)</TD><td>[^<]+</TD><td style="text-align: right;" >([^<]+)</TD></TR>'
+    else:
+        regex = r'<td>([^<]+)</TD><td><a href="https://secure.tibia.com/community/\?subtopic=characters&name=[^"]+" >' \
+                r'([^<]+)</a></td><td>([^<]+)</TD><td style="text-align: right;" >([^<]+)</TD></TR>'
+    pattern = re.compile(regex, re.MULTILINE + re.S)
+    return [{'rank': m[0], 'name': m[1], 'vocation': m[2], 'value': m[3].replace(',', '')}
+            for m in re.findall(pattern, content)]
+
+
+def main(iterations=2000):
+    for category, loyalty in [("magic", False), ("loyalty", True)]:
+        page = load_page(category, loyalty)
+        legacy = legacy_parse_highscores(page.decode(ENCODING), category)
+        current = parse_highscores(page)
+        assert current
+        assert [(int(e["rank"]), e["name"], e["vocation"], int(e["value"])) for e in legacy] == current
+        # The legacy parser also had to decode the whole page first
+        legacy_time = timeit.timeit(lambda: legacy_parse_highscores(page.decode(ENCODING), category),
+                                    number=iterations)
+        current_time = timeit.timeit(lambda: parse_highscores(page), number=iterations)
+        print(f"{category} ({len(page) / 1024:.0f} KB page, {len(current)} entries, {iterations:,} iterations)")
+        print(f"\tlegacy:  {legacy_time * 1e6 / iterations:8.1f} µs/page")
+        print(f"\tcurrent: {current_time * 1e6 / iterations:8.1f} µs/page ({legacy_time / current_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,109 @@
+"""Checks that the most frequent queries to the users database use their indexes instead of scanning whole tables.
+
+A database is created in a temporary directory with every migration, filled with synthetic rows and analyzed, then the
+plan of every query is checked. It exits with an error if a query doesn't use its index.
+The bot's database module opens its databases when imported, so it's imported from the temporary directory, leaving the
+real databases untouched.
+
+Usage: python -m benchmarks.query_plans
+"""
+import importlib
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORLDS = ["Antica", "Secura", "Fortera", "Gladera", "Calmera"]
+CATEGORIES = ["experience", "magic", "shielding", "distance", "sword", "club", "axe", "fist", "fishing", "loyalty"]
+# Queries as (query, parameters, expected index) tuples
+QUERIES = [
+    ("SELECT id, name, level, user_id, world FROM chars WHERE name IN (?, ?, ?)", ("a", "b", "c"), "chars_name_index"),
+    ("SELECT user_id, vocation, name, id, world, guild FROM chars WHERE name = ? OR name = ?", ("a", "b"),
+     "chars_name_index"),
+    ("SELECT id FROM chars WHERE name = ? LIMIT 1", ("a",), "chars_name_index"),
+    ("SELECT guild FROM chars WHERE user_id = ?", (1,), "chars_user_index"),
+    ("SELECT category, rank, value FROM highscores WHERE name = ?", ("a",), "highscores_name_index"),
+    ("SELECT rank, name, vocation, value FROM highscores WHERE world = ? AND category = ?", ("Antica", "magic"),
+     "highscores_entry_index"),
+    ("DELETE FROM highscores WHERE world = ? AND category = ? AND name = ?", ("Antica", "magic", "a"),
+     "highscores_entry_index"),
+    ("SELECT last_scan FROM highscores_times WHERE world = ? and category = ?", ("Antica", "magic"),
+     "highscores_times_index"),
+    ("SELECT * FROM char_deaths WHERE char_id = ? AND date >= ? AND date <= ? AND level = ? AND killer LIKE ?",
+     (1, 0, 100, 50, "a dragon"), "char_deaths_index"),
+    ("SELECT level, date FROM char_levelups WHERE char_id = ? ORDER BY date DESC", (1,), "char_levelups_index"),
+    ("DELETE FROM highscores_history WHERE date < ?", (0,), "highscores_history_date_index"),
+    ("SELECT value FROM server_properties WHERE server_id = ? AND name = ?", (1, "world"), "server_properties_index"),
+]
+
+
+def load_database_module(path: str):
+    """Imports the bot's database module with the given directory as working directory, so its databases are created
+    there."""
+    sys.path.insert(0, ROOT)
+    os.makedirs(os.path.join(path, "data"))
+    # An empty loot database, so the template is not needed
+    open(os.path.join(path, "data", "loot.db"), "wb").close()
+    os.chdir(path)
+    return importlib.import_module("utils.database")
+
+
+def build_database(database, rows=5000, seed=0) -> sqlite3.Connection:
+    """Creates a database with the current schema, with some rows in the tables used by the queries."""
+    rng = random.Random(seed)
+    # The migrations run on the module's connection, opened in the temporary directory
+    conn = database.userDatabase
+    conn.row_factory = database.dict_factory
+    database.init_database()
+    with conn:
+        conn.executemany("INSERT INTO chars(id, user_id, name, level, vocation, world) VALUES(?,?,?,?,?,?)",
+                         ((i, i // 5, f"Character {i}", rng.randint(8, 600), "Knight", "Antica")
+                          for i in range(1, rows + 1)))
+        conn.executemany("INSERT INTO char_levelups(char_id, level, date) VALUES(?,?,?)",
+                         ((rng.randint(1, rows), rng.randint(8, 600), i) for i in range(rows * 4)))
+        conn.executemany("INSERT INTO char_deaths(char_id, level, killer, date, byplayer) VALUES(?,?,?,?,?)",
+                         ((rng.randint(1, rows), rng.randint(8, 600), "a dragon", i, 0) for i in range(rows * 2)))
+        conn.executemany("INSERT INTO highscores(rank, category, world, name, vocation, value) VALUES(?,?,?,?,?,?)",
+                         ((i, category, world, f"Character {i}", "Knight", i) for world in WORLDS
+                          for category in CATEGORIES for i in range(1, rows // 10 + 1)))
+        conn.executemany("INSERT INTO highscores_history(world, category, name, rank, value, date) "
+                         "VALUES(?,?,?,?,?,?)",
+                         (("Antica", "magic", f"Character {i}", i, i, i) for i in range(1, rows + 1)))
+    conn.execute("ANALYZE")
+    return conn
+
+
+def check_queries(conn: sqlite3.Connection) -> int:
+    """Prints the plan of every query, returning the number of queries that don't use their index."""
+    failed = 0
+    for query, params, index in QUERIES:
+        plan = [row["detail"] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params)]
+        ok = any(index in detail for detail in plan) and not any(detail.startswith("SCAN") and "INDEX" not in detail
+                                                                 for detail in plan)
+        failed += not ok
+        print(f"{'OK' if ok else 'FAIL'}\t{query}")
+        for detail in plan:
+            print(f"\t\t{detail}")
+    return failed
+
+
+def main():
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as path:
+        try:
+            database = load_database_module(path)
+            failed = check_queries(build_database(database))
+            for conn in (database.userDatabase, database.tibiaDatabase, database.lootDatabase):
+                conn.close()
+        finally:
+            os.chdir(cwd)
+    if failed:
+        print(f"{failed} queries don't use their index")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
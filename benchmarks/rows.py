@@ -0,0 +1,127 @@
+"""Compares the row factories used when reading from the users database.
+
+A synthetic database with the same tables as users.db is built in a temporary directory, with about the given number of
+rows in total, and read with the same queries and access patterns as the code using each row factory.
+The bot's database module is imported from that directory too, so its databases are not created in the working tree.
+
+Usage: python -m benchmarks.rows [rows]
+"""
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+from benchmarks.query_plans import load_database_module
+
+VOCATIONS = ["Elite Knight", "Royal Paladin", "Master Sorcerer", "Elder Druid", "Knight", "None"]
+CATEGORIES = ["experience", "magic", "shielding", "distance", "sword", "club", "axe", "fist", "fishing", "loyalty"]
+PROPERTIES = ["world", "prefixes", "levels_channel", "watched_channel", "events_channel"]
+
+
+def build_database(path: str, rows: int, seed=0):
+    """Builds a database with a quarter of the rows in characters, half in highscores and the rest in server properties.
+
+    Highscores have 1000 entries per world and category."""
+    rng = random.Random(seed)
+    chars = rows // 4
+    worlds = max(1, rows // 2 // (len(CATEGORIES) * 1000))
+    servers = rows // 4 // len(PROPERTIES)
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("CREATE TABLE chars(id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, "
+                     "name TEXT COLLATE NOCASE, level INTEGER DEFAULT -1, vocation TEXT, world TEXT, guild TEXT)")
+        conn.execute("CREATE INDEX chars_name_index ON chars(name)")
+        conn.execute("CREATE TABLE highscores(rank INTEGER, category TEXT, world TEXT, name TEXT COLLATE NOCASE, "
+                     "vocation TEXT, value INTEGER)")
+        conn.execute("CREATE UNIQUE INDEX highscores_entry_index ON highscores(world, category, name)")
+        conn.execute("CREATE TABLE server_properties(server_id INTEGER, name TEXT, value TEXT)")
+        conn.executemany("INSERT INTO chars(id, user_id, name, level, vocation, world, guild) VALUES(?,?,?,?,?,?,?)",
+                         ((i, i // 5, f"Character {i}", rng.randint(8, 600), rng.choice(VOCATIONS),
+                           f"World {i % worlds}", None) for i in range(1, chars + 1)))
+        conn.executemany("INSERT INTO highscores(rank, category, world, name, vocation, value) VALUES(?,?,?,?,?,?)",
+                         ((rank, category, f"World {world}", f"Character {world}-{rank}", rng.choice(VOCATIONS),
+                           rng.randint(1000, 5000000))
+                          for world in range(worlds) for category in CATEGORIES for rank in range(1, 1001)))
+        conn.executemany("INSERT INTO server_properties(server_id, name, value) VALUES(?,?,?)",
+                         ((server, name, str(server)) for server in range(servers) for name in PROPERTIES))
+    conn.close()
+    return chars, worlds
+
+
+def read_chars(conn: sqlite3.Connection, factory, chars: int, chunk_size: int) -> int:
+    """Looks up every character by name, in chunks, like get_chars_by_name does for online lists."""
+    conn.row_factory = factory
+    found = {}
+    names = [f"character {i}" for i in range(1, chars + 1)]
+    for i in range(0, len(names), chunk_size):
+        chunk = names[i:i + chunk_size]
+        for row in conn.execute("SELECT id, name, level, user_id, world FROM chars WHERE name IN ({0})"
+                                .format(", ".join("?" * len(chunk))), chunk):
+            found[row["name"].lower()] = row
+    return len(found)
+
+
+def read_highscores(conn: sqlite3.Connection, factory, worlds: int) -> int:
+    """Reads the current entries of every world and category, like update_highscores does."""
+    conn.row_factory = factory
+    count = 0
+    for world in range(worlds):
+        for category in CATEGORIES:
+            current = {row["name"]: (row["rank"], row["vocation"], row["value"]) for row in
+                       conn.execute("SELECT rank, name, vocation, value FROM highscores "
+                                    "WHERE world = ? AND category = ?", (f"World {world}", category))}
+            count += len(current)
+    return count
+
+
+def read_properties(conn: sqlite3.Connection, factory) -> int:
+    """Loads every server property, like the server properties cache does."""
+    conn.row_factory = factory
+    properties = {}
+    for row in conn.execute("SELECT server_id, name, value FROM server_properties"):
+        properties.setdefault(row["server_id"], {})[row["name"]] = row["value"]
+    return sum(len(p) for p in properties.values())
+
+
+def measure(func, *args, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(rows=1000000):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            database = load_database_module(directory)
+            path = os.path.join(directory, "benchmark.db")
+            print(f"Building database with {rows:,} rows...")
+            chars, worlds = build_database(path, rows)
+            conn = sqlite3.connect(path)
+            cases = [
+                ("Characters by name", read_chars, (chars, database.SQL_VARIABLE_LIMIT)),
+                ("Highscores by world and category", read_highscores, (worlds,)),
+                ("Server properties", read_properties, ()),
+            ]
+            for title, func, args in cases:
+                baseline, expected = measure(func, conn, database.dict_factory, *args)
+                elapsed, count = measure(func, conn, database.Row, *args)
+                assert count == expected
+                print(f"{title} ({count:,} rows)")
+                print(f"\tdict_factory: {count / baseline:12,.0f} rows/s")
+                print(f"\tRow:          {count / elapsed:12,.0f} rows/s ({baseline / elapsed:.2f}x)")
+            conn.close()
+            for conn in (database.userDatabase, database.tibiaDatabase, database.lootDatabase):
+                conn.close()
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
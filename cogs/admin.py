@@ -75,7 +75,7 @@ class Admin:
                 skipped.append(char)
                 continue
             with closing(userDatabase.cursor()) as c:
-                c.execute("SELECT name, guild, user_id as owner, abs(level) as level FROM chars WHERE name LIKE ?",
+                c.execute("SELECT name, guild, user_id as owner, abs(level) as level FROM chars WHERE name = ?",
                           (char.name,))
                 db_char = c.fetchone()
             if db_char is not None:
@@ -148,7 +148,7 @@ class Admin:
 
         for char in updated:
             with userDatabase as conn:
-                conn.execute("UPDATE chars SET user_id = ? WHERE name LIKE ?", (target.id, char['name']))
+                conn.execute("UPDATE chars SET user_id = ? WHERE name = ?", (target.id, char['name']))
         for char in added:
             with userDatabase as conn:
                 conn.execute("INSERT INTO chars (name,level,vocation,user_id, world, guild) VALUES (?,?,?,?,?,?)",
@@ -212,7 +212,7 @@ class Admin:
             embed.set_footer(text="{0.name}#{0.discriminator}".format(ctx.author), icon_url=icon_url)
 
             with closing(userDatabase.cursor()) as c:
-                c.execute("SELECT id, name, user_id FROM chars WHERE name LIKE ?", (char.name,))
+                c.execute("SELECT id, name, user_id FROM chars WHERE name = ?", (char.name,))
                 result = c.fetchone()
                 if result is not None:
                     # Registered to a different user
@@ -225,8 +225,8 @@ class Admin:
                             return
                         # User no longer in any servers
                         c.execute("UPDATE chars SET user_id = ? WHERE id = ?", (user.id, result["id"],))
-                        await ctx.send("This character was reassigned to this user successfully.")
                         userDatabase.commit()
+                        await ctx.send("This character was reassigned to this user successfully.")
                         for server in user_servers:
                             world = self.bot.tracked_worlds.get(server.id, None)
                             if world == char.world:
@@ -244,6 +244,7 @@ class Admin:
                 result = c.fetchone()
                 if result is None:
                     c.execute("INSERT INTO users(id,name) VALUES (?,?)", (user.id, user.display_name,))
+                userDatabase.commit()
                 await ctx.send("**{0}** was registered successfully to this user.".format(char.name))
                 # Log on relevant servers
                 for server in user_servers:
@@ -253,7 +254,6 @@ class Admin:
                         embed.description = "{0.mention} registered:\n\u2023 {1}  - Level {2} {3} - **{4}**"\
                             .format(user, char.name, char.level, get_voc_abb_and_emoji(char.vocation), guild)
                         await self.bot.send_log_message(server, embed=embed)
-                userDatabase.commit()
 
     @checks.is_admin()
     @commands.guild_only()
@@ -306,7 +306,7 @@ class Admin:
         c = userDatabase.cursor()
         try:
             c.execute("SELECT name, user_id, world, ABS(level) as level, vocation, guild "
-                      "FROM chars WHERE name LIKE ?", (name,))
+                      "FROM chars WHERE name = ?", (name,))
             result = c.fetchone()
             if result is None or result["user_id"] == 0:
                 await ctx.send("There's no character with that name registered.")
@@ -318,7 +318,8 @@ class Admin:
                     await ctx.send("The character is assigned to someone on another server.")
                     return
             username = "unknown" if user is None else user.display_name
-            c.execute("UPDATE chars SET user_id = 0 WHERE name LIKE ?", (name,))
+            c.execute("UPDATE chars SET user_id = 0 WHERE name = ?", (name,))
+            userDatabase.commit()
             await ctx.send("**{0}** was removed successfully from **@{1}**.".format(result["name"], username))
             if user is not None:
                 for server in self.bot.get_user_guilds(user.id):
@@ -15,7 +15,7 @@ from discord.ext import commands
 from nabbot import NabBot
 from utils.config import config
 from utils.context import NabCtx
-from utils.database import userDatabase, get_server_property
+from utils.database import userDatabase, asyncUserDatabase, get_server_property
 from utils.general import parse_uptime, TimeString, single_line, log, BadTime, get_user_avatar, get_region_string, \
     clean_string, is_numeric
 from utils.pages import CannotPaginate, VocationPages, HelpPaginator
@@ -105,7 +105,8 @@ class General:
                     else:
                         event["start"] = 'now'
                     message = "**{name}** (by **@{author}**,*ID:{id}*) - Is starting {start}!".format(**event)
-                    c.execute("UPDATE events SET status = ? WHERE id = ?", (new_status, event["id"],))
+                    await asyncUserDatabase.execute("UPDATE events SET status = ? WHERE id = ?",
+                                                    (new_status, event["id"],))
                     announce_channel_id = get_server_property(guild.id, "events_channel", is_int=True)
                     if announce_channel_id == 0:
                         continue
@@ -453,7 +454,7 @@ class General:
             await ctx.send(f"{ctx.tick(False)} You can only add people to your own events.")
             return
         with closing(userDatabase.cursor()) as c:
-            c.execute("SELECT * FROM chars WHERE name LIKE ?", (character,))
+            c.execute("SELECT * FROM chars WHERE name = ?", (character,))
             char = c.fetchone()
         if event["slots"] != 0 and len(event["participants"]) >= event["slots"]:
             await ctx.send(f"{ctx.tick(False)} All the slots for this event has been filled. "
@@ -484,8 +485,7 @@ class General:
 
         with userDatabase as con:
             con.execute("INSERT INTO event_participants(event_id, char_id) VALUES(?,?)", (event_id, char["id"]))
-            await ctx.send(f"{ctx.tick()} You successfully added **{char['name']}** to this event.")
-            return
+        await ctx.send(f"{ctx.tick()} You successfully added **{char['name']}** to this event.")
 
     @commands.guild_only()
     @events.group(name="edit", invoke_without_command=True, case_insensitive=True)
@@ -816,7 +816,7 @@ class General:
             await ctx.send(f"{ctx.tick(False)} There's no active event with that id.")
             return
         with closing(userDatabase.cursor()) as c:
-            c.execute("SELECT * FROM chars WHERE name LIKE ?", (character,))
+            c.execute("SELECT * FROM chars WHERE name = ?", (character,))
             char = c.fetchone()
             c.execute("SELECT char_id, user_id FROM event_participants, chars WHERE event_id = ? AND chars.id = char_id"
                       , (event_id,))
@@ -855,8 +855,7 @@ class General:
 
         with userDatabase as con:
             con.execute("INSERT INTO event_participants(event_id, char_id) VALUES(?,?)", (event_id, char["id"]))
-            await ctx.send(f"{ctx.tick()} You successfully joined this event.")
-            return
+        await ctx.send(f"{ctx.tick()} You successfully joined this event.")
 
     @commands.guild_only()
     @events.command(name="leave")
@@ -883,8 +882,7 @@ class General:
 
         with userDatabase as con:
             con.execute("DELETE FROM event_participants WHERE event_id = ? AND char_id = ?", (event_id, joined_char))
-            await ctx.send(f"{ctx.tick()} You successfully left this event.")
-            return
+        await ctx.send(f"{ctx.tick()} You successfully left this event.")
 
     @commands.guild_only()
     @events.command(name="make", aliases=["creator", "maker"])
@@ -1107,7 +1105,7 @@ class General:
             await ctx.send(f"{ctx.tick(False)} You can only add people to your own events.")
             return
         with closing(userDatabase.cursor()) as c:
-            c.execute("SELECT * FROM chars WHERE name LIKE ?", (character,))
+            c.execute("SELECT * FROM chars WHERE name = ?", (character,))
             char = c.fetchone()
         joined_char = next((participant["char_id"] for participant in event["participants"]
                             if char["id"] == participant["char_id"]), None)
@@ -1129,8 +1127,7 @@ class General:
 
         with userDatabase as con:
             con.execute("DELETE FROM event_participants WHERE event_id = ? AND char_id = ?", (event_id, joined_char))
-            await ctx.send(f"{ctx.tick()} You successfully left this event.")
-            return
+        await ctx.send(f"{ctx.tick()} You successfully left this event.")
 
     @commands.guild_only()
     @events.command(name="subscribe", aliases=["sub"])
@@ -1153,6 +1150,7 @@ class General:
                 return
 
             c.execute("INSERT INTO event_subscribers (event_id, user_id) VALUES(?,?)", (event_id, author.id))
+            userDatabase.commit()
             await ctx.send(f"{ctx.tick()} You have subscribed successfully to this event. "
                            f"I'll let you know when it's happening.")
 
@@ -1187,6 +1185,7 @@ class General:
                 return
 
             c.execute("DELETE FROM event_subscribers WHERE event_id = ? AND user_id = ?", (event_id, author.id))
+            userDatabase.commit()
             await ctx.send(f"{ctx.tick()} You have subscribed successfully to this event. "
                            f"I'll let you know when it's happening.")
 
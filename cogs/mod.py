@@ -75,8 +75,8 @@ class Mod:
         with userDatabase:
             userDatabase.execute("INSERT INTO ignored_channels(server_id, channel_id) VALUES(?, ?)",
                                  (ctx.guild.id, channel.id))
-            await ctx.send(f"{channel.mention} is now ignored.")
-            self.reload_ignored()
+        await ctx.send(f"{channel.mention} is now ignored.")
+        self.reload_ignored()
 
     @commands.guild_only()
     @checks.is_channel_mod()
@@ -177,8 +177,8 @@ class Mod:
 
         with userDatabase:
             userDatabase.execute("DELETE FROM ignored_channels WHERE channel_id = ?", (channel.id,))
-            await ctx.send(f"{channel.mention} is not ignored anymore.")
-            self.reload_ignored()
+        await ctx.send(f"{channel.mention} is not ignored anymore.")
+        self.reload_ignored()
 
     @checks.is_channel_mod()
     @commands.guild_only()
@@ -12,10 +12,13 @@ from discord.ext import commands
 from nabbot import NabBot
 from utils import checks
 from utils.context import NabCtx
+from utils.database import clear_server_properties_cache
 from utils.general import *
 from utils.messages import *
+from utils.network import get_circuit_breakers, get_rate_limiters, PRIORITY_NAMES, CIRCUIT_CLOSED
 from utils.tibia import *
 from utils.tibiawiki import *
+from utils.tracking import death_scheduler
 
 req_pattern = re.compile(r"([\w]+)([><=]+)([\d.]+),([><=]+)([\d.]+)")
 dpy_commit = re.compile(r"a(\d+)\+g([\w]+)")
@@ -133,6 +136,69 @@ class Owner:
                 self._last_result = ret
                 await ctx.send(f'```py\n{value}{ret}\n```')
 
+    @commands.command()
+    @checks.is_owner()
+    async def health(self, ctx: NabCtx):
+        """Shows the state of the connections to Tibia's websites.
+
+        For every host, it shows if requests are being let through, the requests made by priority and the average time
+        they waited for the rate limiter.
+        It also shows how effective the characters, worlds and guilds caches are, and how long deaths take to be
+        detected."""
+        embed = discord.Embed(title="Network health")
+        breakers = get_circuit_breakers()
+        limiters = get_rate_limiters()
+        for host in sorted(set(breakers) | set(limiters)):
+            lines = []
+            breaker = breakers.get(host)
+            if breaker is not None:
+                state = breaker.state
+                lines.append(f"{ctx.tick(state == CIRCUIT_CLOSED)} Circuit **{state}**")
+                if state != CIRCUIT_CLOSED:
+                    lines.append(f"Retrying in {breaker.retry_in:.0f} seconds")
+                lines.append(f"{breaker.failures} failures in a row, opened {breaker.trips} times, "
+                             f"{breaker.rejected} requests rejected")
+            limiter = limiters.get(host)
+            if limiter is not None:
+                for priority, name in PRIORITY_NAMES.items():
+                    requests = limiter.requests[priority]
+                    if not requests:
+                        continue
+                    lines.append(f"{name.title()} priority: {requests:,} requests, "
+                                 f"{limiter.wait_time[priority]/requests:.2f}s average wait")
+                lines.append(f"{limiter.waiting} requests waiting")
+            embed.add_field(name=host, value="\n".join(lines), inline=False)
+        caches = [("Characters", character_cache), ("Worlds", world_cache), ("Guilds", guild_cache)]
+        cache_lines = []
+        for name, cache in caches:
+            total = cache.hits + cache.misses
+            ratio = cache.hits / total if total else 0
+            cache_lines.append(f"**{name}**: {len(cache):,}/{cache.maxsize:,} entries, {ratio:.1%} hits")
+        embed.add_field(name="Caches", value="\n".join(cache_lines), inline=False)
+        death_lines = [f"{len(death_scheduler):,} characters queued"]
+        detection_stats = death_scheduler.get_detection_stats()
+        for reason, count in death_scheduler.checks.most_common():
+            line = f"**{reason.title()}**: {count:,} checks"
+            if reason in detection_stats:
+                deaths, average, maximum = detection_stats[reason]
+                line += f", {deaths} deaths detected after {average/60:.1f} minutes on average " \
+                        f"({maximum/60:.1f} max)"
+            death_lines.append(line)
+        embed.add_field(name="Death checks", value="\n".join(death_lines), inline=False)
+        tracking = self.bot.get_cog("Tracking")
+        if tracking is not None:
+            stage_lines = []
+            for stage in tracking.pipeline:
+                average = stage.busy_time / stage.processed if stage.processed else 0
+                stage_lines.append(f"**{stage.name.title()}**: {stage.pending} pending, {stage.processed} processed "
+                                   f"({average:.2f}s avg), {stage.errors} errors")
+            if tracking.scanners is not None:
+                scanners = tracking.scanners
+                stage_lines.append(f"**Scanner workers**: {scanners.alive}/{scanners.workers} running, "
+                                   f"{scanners.requests} scans, {scanners.errors} errors")
+            embed.add_field(name="Tracking pipeline", value="\n".join(stage_lines), inline=False)
+        await ctx.send(embed=embed)
+
     @commands.command()
     @checks.is_owner()
     async def leave(self, ctx: NabCtx, *, server: str):
@@ -230,7 +296,11 @@ class Owner:
             c.execute("UPDATE server_properties SET value = ? WHERE name = ? AND value LIKE ?",
                       (new_world, "world", old_world))
             affected_guilds = c.rowcount
+            clear_server_properties_cache()
             c.execute("DELETE FROM highscores WHERE world LIKE ?", (old_world,))
+            c.execute("DELETE FROM highscores_history WHERE world LIKE ?", (old_world,))
+            # Committed before waiting, so the database is not kept locked
+            userDatabase.commit()
             await ctx.send(f"Moved **{affected_chars:,}** characters to {new_world}. "
                            f"**{affected_guilds}** discord servers were affected.\n\n"
                            f"Enjoy **{new_world}**! 🔥♋")
@@ -268,7 +338,7 @@ class Owner:
         with ctx.typing():
             c = userDatabase.cursor()
             try:
-                c.execute("SELECT * FROM chars WHERE name LIKE ? LIMIT 1", (old_name,))
+                c.execute("SELECT * FROM chars WHERE name = ? LIMIT 1", (old_name,))
                 old_char_db = c.fetchone()
                 # If character wasn't registered, there's nothing to do.
                 if old_char_db is None:
@@ -324,7 +394,7 @@ class Owner:
                     return
 
                 # Check if new name was already registered
-                c.execute("SELECT * FROM chars WHERE name LIKE ?", (new_char.name,))
+                c.execute("SELECT * FROM chars WHERE name = ?", (new_char.name,))
                 new_char_db = c.fetchone()
 
                 if new_char_db is None:
@@ -337,6 +407,7 @@ class Owner:
                     c.execute("UPDATE char_deaths SET id = ? WHERE id = ?", (old_char_db["id"], new_char_db["id"],))
                     c.execute("UPDATE char_levelups SET id = ? WHERE id = ?",
                               (old_char_db["id"], new_char_db["id"],))
+                userDatabase.commit()
 
                 await ctx.send("Character renamed successfully.")
             finally:
@@ -35,11 +35,13 @@ class Roles:
         result = userDatabase.execute("SELECT * FROM joinable_roles WHERE role_id = ?", (role.id,))
         exists = list(result)
         if exists:
-            userDatabase.execute("DELETE FROM joinable_roles WHERE role_id = ?", (role.id,))
+            with userDatabase:
+                userDatabase.execute("DELETE FROM joinable_roles WHERE role_id = ?", (role.id,))
         result = userDatabase.execute("SELECT * FROM auto_roles WHERE role_id = ?", (role.id,))
         exists = list(result)
         if exists:
-            userDatabase.execute("DELETE FROM auto_roles WHERE role_id = ?", (role.id,))
+            with userDatabase:
+                userDatabase.execute("DELETE FROM auto_roles WHERE role_id = ?", (role.id,))
 
     async def on_character_change(self, user_id: int):
         try:
@@ -157,8 +159,9 @@ class Roles:
         if not confirm:
             return
 
-        userDatabase.execute("INSERT INTO auto_roles(server_id, role_id, guild) VALUES(?,?, ?)", (ctx.guild.id, role.id,
-                                                                                                  name))
+        with userDatabase:
+            userDatabase.execute("INSERT INTO auto_roles(server_id, role_id, guild) VALUES(?,?, ?)",
+                                 (ctx.guild.id, role.id, name))
         await ctx.send(f"{ctx.tick()} Autorole rule created.")
 
     @checks.has_guild_permissions(manage_roles=True)
@@ -245,9 +248,10 @@ class Roles:
             await ctx.send(f"{ctx.tick(False)} You can't delete a role rule for a role higher than yours.")
             return
 
+        with userDatabase:
+            userDatabase.execute("DELETE FROM auto_roles WHERE role_id = ? AND guild LIKE ?", (group.id, guild))
         await ctx.send(f"{ctx.tick()} Auto role rule removed. "
                        f"Note that the role won't be removed from current members.")
-        userDatabase.execute("DELETE FROM auto_roles WHERE role_id = ? AND guild LIKE ?", (group.id, guild))
 
     @commands.guild_only()
     @commands.group(invoke_without_command=True, case_insensitive=True)
@@ -322,7 +326,8 @@ class Roles:
             await ctx.send(f"{ctx.tick(False)} You can't make a group with a role higher or equals than your highest.")
             return
 
-        userDatabase.execute("INSERT INTO joinable_roles(server_id, role_id) VALUES(?,?)", (ctx.guild.id, role.id))
+        with userDatabase:
+            userDatabase.execute("INSERT INTO joinable_roles(server_id, role_id) VALUES(?,?)", (ctx.guild.id, role.id))
         await ctx.send(f"{ctx.tick()} Group `{role.name}` created successfully.")
 
     @commands.guild_only()
@@ -386,7 +391,8 @@ class Roles:
                                f"{ctx.tick()} Group `{group.name}` removed.")
         else:
             await ctx.send(f"{ctx.tick()} Group `{group.name}` was removed.")
-        userDatabase.execute("DELETE FROM joinable_roles WHERE role_id = ?", (group.id,))
+        with userDatabase:
+            userDatabase.execute("DELETE FROM joinable_roles WHERE role_id = ?", (group.id,))
 
     @commands.guild_only()
     @commands.command(aliases=["norole"])
@@ -243,6 +243,7 @@ class Settings:
             return
 
         set_server_property(ctx.guild.id, "levels_channel", new_value)
+        self.bot.dispatch("levels_channel_change", ctx.guild.id)
         if new_value is 0:
             await ctx.send(f"{ctx.tick(True)} The level & deaths channel has been disabled.")
         else:
@@ -305,7 +306,7 @@ class Settings:
         Multiple words also require using quotes.
 
         Mentioning the bot is always a valid command and can't be changed."""
-        prefixes = get_server_property(ctx.guild.id, "prefixes", deserialize=True, default=list(config.command_prefix))
+        prefixes = list(get_server_property(ctx.guild.id, "prefixes", deserialize=True, default=config.command_prefix))
         if prefix is None:
             current_value = ", ".join(f"`{p}`" for p in prefixes) if len(prefixes) > 0 else "Mentions only"
             await self.show_info_embed(ctx, current_value, "Any text", "prefix")
@@ -15,10 +15,11 @@ from nabbot import NabBot
 from utils import checks
 from utils.config import config
 from utils.context import NabCtx
-from utils.database import get_server_property, userDatabase
+from utils.database import get_server_property, userDatabase, asyncUserDatabase
 from utils.general import get_time_diff, join_list, get_brasilia_time_zone, global_online_list, get_local_timezone, log, \
     is_numeric, get_user_avatar
 from utils.messages import html_to_markdown, get_first_image, split_message
+from utils.network import PRIORITY_LOW, TIBIADATA_HOST, ParseError, wait_until_available
 from utils.pages import Pages, CannotPaginate, VocationPages
 from utils.tibia import NetworkError, get_character, tibia_logo, get_share_range, get_voc_emoji, get_voc_abb, get_guild, \
     url_house, get_stats, get_map_area, get_tibia_time_zone, get_world, tibia_worlds, get_world_bosses, get_recent_news, \
@@ -192,7 +193,7 @@ class Tibia:
                                                                                             name=killer))
                     count += 1
 
-                c.execute("SELECT id, name FROM chars WHERE name LIKE ?", (name,))
+                c.execute("SELECT id, name FROM chars WHERE name = ?", (name,))
                 result = c.fetchone()
                 if result is not None and not ctx.is_lite:
                     id = result["id"]
@@ -362,7 +363,6 @@ class Tibia:
                 await ctx.send("This server is not tracking any tibia worlds.")
                 return
         placeholders = ", ".join("?" for w in user_worlds)
-        c = userDatabase.cursor()
         now = time.time()
         embed = discord.Embed(title="Death statistics")
         if period in ["week", "weekly"]:
@@ -376,60 +376,38 @@ class Tibia:
             description_suffix = ""
             embed.set_footer(text=f"For a shorter period, try {ctx.clean_prefix}{ctx.command.qualified_name} week or "
                                   f"{ctx.clean_prefix}{ctx.command.qualified_name} month")
-        try:
-            c.execute("SELECT COUNT() AS total FROM char_deaths WHERE date >= ?", (start_date,))
-            total = c.fetchone()["total"]
-            embed.description = f"There are {total:,} deaths registered{description_suffix}."
-            c.execute("SELECT COUNT() as count, chars.name, chars.user_id FROM char_deaths, chars "
-                      f"WHERE id = char_id AND world IN ({placeholders}) AND date >= {start_date} "
-                      "GROUP BY char_id ORDER BY count DESC LIMIT 3", tuple(user_worlds))
-            content = ""
-            count = 0
-            while True:
-                row = c.fetchone()
-                if row is None:
-                    break
-                user = self.bot.get_member(row["user_id"], ctx.guild)
-                if user is None:
-                    continue
-                count += 1
-                content += f"**{row['name']}** \U00002014 {row['count']}\n"
-                if count >= 3:
-                    break
-            if count > 0:
-                embed.add_field(name="Most deaths per character", value=content, inline=False)
-
-            c.execute("SELECT COUNT() as count, chars.user_id FROM char_deaths, chars "
-                      f"WHERE id = char_id AND world IN ({placeholders}) AND date >= {start_date} "
-                      "GROUP BY user_id ORDER BY count DESC", tuple(user_worlds))
-            content = ""
-            count = 0
-            while True:
-                row = c.fetchone()
-                if row is None:
-                    break
-                user = self.bot.get_member(row["user_id"], ctx.guild)
-                if user is None:
-                    continue
-                count += 1
-                content += f"@**{user.display_name}** \U00002014 {row['count']}\n"
-                if count >= 3:
-                    break
-            if count > 0:
-                embed.add_field(name="Most deaths per user", value=content, inline=False)
-
-            c.execute("SELECT COUNT() as count, killer FROM char_deaths, chars "
-                      f"WHERE id = char_id and world IN ({placeholders}) AND date >= {start_date} "
-                      "GROUP BY killer ORDER BY count DESC LIMIT 3", tuple(user_worlds))
-            total_per_killer = c.fetchall()
-            content = ""
-            for row in total_per_killer:
-                killer = re.sub(r"(a|an)(\s+)", " ", row["killer"]).title().strip()
-                content += f"**{killer}** \U00002014 {row['count']}\n"
-            embed.add_field(name="Most deaths per killer", value=content, inline=False)
-            await ctx.send(embed=embed)
-        finally:
-            c.close()
+        # Members are looked up beforehand, so rows can be filtered while being read, outside the event loop
+        members = {m.id: m for m in (ctx.guild.members if ctx.guild is not None else self.bot.get_all_members())}
+        result = await asyncUserDatabase.fetchone("SELECT COUNT() AS total FROM char_deaths WHERE date >= ?",
+                                                  (start_date,))
+        embed.description = f"There are {result['total']:,} deaths registered{description_suffix}."
+        rows = await asyncUserDatabase.fetchall("SELECT COUNT() as count, chars.name, chars.user_id "
+                                                "FROM char_deaths, chars "
+                                                f"WHERE id = char_id AND world IN ({placeholders}) AND date >= ? "
+                                                "GROUP BY char_id ORDER BY count DESC LIMIT 3",
+                                                (*user_worlds, start_date), where=lambda r: r["user_id"] in members)
+        content = "".join(f"**{row['name']}** \U00002014 {row['count']}\n" for row in rows)
+        if content:
+            embed.add_field(name="Most deaths per character", value=content, inline=False)
+
+        rows = await asyncUserDatabase.fetchall("SELECT COUNT() as count, chars.user_id FROM char_deaths, chars "
+                                                f"WHERE id = char_id AND world IN ({placeholders}) AND date >= ? "
+                                                "GROUP BY user_id ORDER BY count DESC", (*user_worlds, start_date),
+                                                where=lambda r: r["user_id"] in members, limit=3)
+        content = "".join(f"@**{members[row['user_id']].display_name}** \U00002014 {row['count']}\n" for row in rows)
+        if content:
+            embed.add_field(name="Most deaths per user", value=content, inline=False)
+
+        rows = await asyncUserDatabase.fetchall("SELECT COUNT() as count, killer FROM char_deaths, chars "
+                                                f"WHERE id = char_id and world IN ({placeholders}) AND date >= ? "
+                                                "GROUP BY killer ORDER BY count DESC LIMIT 3",
+                                                (*user_worlds, start_date))
+        content = ""
+        for row in rows:
+            killer = re.sub(r"(a|an)(\s+)", " ", row["killer"]).title().strip()
+            content += f"**{killer}** \U00002014 {row['count']}\n"
+        embed.add_field(name="Most deaths per killer", value=content, inline=False)
+        await ctx.send(embed=embed)
 
     @commands.group(aliases=['checkguild'], invoke_without_command=True, case_insensitive=True)
     async def guild(self, ctx: NabCtx, *, name):
@@ -482,10 +460,11 @@ class Tibia:
                 result = ""
                 current_field = member['rank']
 
-            member["nick"] = '(*' + member['nick'] + '*) ' if member['nick'] != '' else ''
-            member["vocation"] = get_voc_abb(member["vocation"])
-
-            result += "{name} {nick}\u2192 {level} {vocation}\n".format(**member)
+            # The guild is cached and shared, so its members are left untouched
+            nick = '(*' + member['nick'] + '*) ' if member['nick'] != '' else ''
+            result += "{name} {nick}\u2192 {level} {vocation}\n".format(name=member["name"], nick=nick,
+                                                                      level=member["level"],
+                                                                      vocation=get_voc_abb(member["vocation"]))
         embed.add_field(name=current_field, value=result, inline=False)
         await ctx.send(embed=embed)
 
@@ -580,6 +559,8 @@ class Tibia:
         entries = []
         vocations = []
         for member in guild.members:
+            # The guild is cached and shared, so a copy of the member is modified
+            member = dict(member)
             member["nick"] = '(*' + member['nick'] + '*) ' if member['nick'] != '' else ''
             vocations.append(member["vocation"])
             member["emoji"] = get_voc_emoji(member["vocation"])
@@ -669,69 +650,50 @@ class Tibia:
                 await ctx.send("This server is not tracking any tibia worlds.")
                 return
 
-        c = userDatabase.cursor()
         entries = []
         author = None
         author_icon = discord.Embed.Empty
-        count = 0
         now = time.time()
         per_page = 20 if ctx.long else 5
         await ctx.channel.trigger_typing()
-        try:
-            if name is None:
-                title = "Latest level ups"
-                c.execute("SELECT char_levelups.level, date, name, user_id, world, vocation "
-                          "FROM char_levelups, chars "
-                          "WHERE char_id = id AND char_levelups.level >= ? "
-                          "ORDER BY date DESC", (config.announce_threshold, ))
-                while True:
-                    row = c.fetchone()
-                    if row is None:
-                        break
-                    user = self.bot.get_member(row["user_id"], user_guilds)
-                    if user is None:
-                        continue
-                    if row["world"] not in user_worlds:
-                        continue
-                    count += 1
-                    row["time"] = get_time_diff(dt.timedelta(seconds=now - row["date"]))
-                    row["user"] = user.display_name
-                    row["emoji"] = get_voc_emoji(row["vocation"])
-                    entries.append("{emoji} {name} - Level **{level}** - (**@{user}**) - *{time} ago*".format(**row))
-                    if count >= 100:
-                        break
-            else:
-                c.execute("SELECT id, name, user_id, vocation FROM chars WHERE name LIKE ?", (name,))
-                result = c.fetchone()
-                if result is None:
-                    await ctx.send("I don't have a character with that name registered.")
-                    return
-                # If user doesn't share a server with the owner, don't display it
-                owner = self.bot.get_member(result["user_id"], user_guilds)
-                if owner is None:
-                    await ctx.send("I don't have a character with that name registered.")
-                    return
-                author = owner.display_name
-                author_icon = owner.avatar_url
-                name = result["name"]
-                emoji = get_voc_emoji(result["vocation"])
-                title = f"{emoji} {name} latest level ups"
-                c.execute("SELECT char_levelups.level, date FROM char_levelups, chars "
-                          "WHERE id = char_id AND name LIKE ? "
-                          "ORDER BY date DESC", (name,))
-                while True:
-                    row = c.fetchone()
-                    if row is None:
-                        break
-                    count += 1
-                    row["time"] = get_time_diff(dt.timedelta(seconds=now-row["date"]))
-                    entries.append("Level **{level}** - *{time} ago*".format(**row))
-                    if count >= 100:
-                        break
-        finally:
-            c.close()
-
-        if count == 0:
+        if name is None:
+            title = "Latest level ups"
+            # Members are looked up beforehand, so rows can be filtered while being read, outside the event loop
+            members = {m.id: m for g in user_guilds for m in g.members}
+            rows = await asyncUserDatabase.fetchall("SELECT char_levelups.level, date, name, user_id, world, vocation "
+                                                    "FROM char_levelups, chars "
+                                                    "WHERE char_id = id AND char_levelups.level >= ? "
+                                                    "ORDER BY date DESC", (config.announce_threshold, ),
+                                                    where=lambda r: r["user_id"] in members and
+                                                    r["world"] in user_worlds, limit=100)
+            for row in rows:
+                row["time"] = get_time_diff(dt.timedelta(seconds=now - row["date"]))
+                row["user"] = members[row["user_id"]].display_name
+                row["emoji"] = get_voc_emoji(row["vocation"])
+                entries.append("{emoji} {name} - Level **{level}** - (**@{user}**) - *{time} ago*".format(**row))
+        else:
+            result = await asyncUserDatabase.fetchone("SELECT id, name, user_id, vocation FROM chars WHERE name = ?",
+                                                      (name,))
+            if result is None:
+                await ctx.send("I don't have a character with that name registered.")
+                return
+            # If user doesn't share a server with the owner, don't display it
+            owner = self.bot.get_member(result["user_id"], user_guilds)
+            if owner is None:
+                await ctx.send("I don't have a character with that name registered.")
+                return
+            author = owner.display_name
+            author_icon = owner.avatar_url
+            name = result["name"]
+            emoji = get_voc_emoji(result["vocation"])
+            title = f"{emoji} {name} latest level ups"
+            rows = await asyncUserDatabase.fetchall("SELECT level, date FROM char_levelups WHERE char_id = ? "
+                                                    "ORDER BY date DESC", (result["id"],), limit=100)
+            for row in rows:
+                row["time"] = get_time_diff(dt.timedelta(seconds=now-row["date"]))
+                entries.append("Level **{level}** - *{time} ago*".format(**row))
+
+        if not entries:
             await ctx.send("There are no registered levels.")
             return
 
@@ -1214,90 +1176,70 @@ class Tibia:
                 await ctx.send("This server is not tracking any tibia worlds.")
                 return
 
-        c = userDatabase.cursor()
         entries = []
         author = None
         author_icon = discord.Embed.Empty
-        count = 0
         now = time.time()
         per_page = 20 if ctx.long else 5
         await ctx.channel.trigger_typing()
-        try:
-            if name is None:
-                title = "Timeline"
-                c.execute("SELECT name, user_id, world, char_deaths.level as level, killer, 'death' AS `type`, date, "
-                          "vocation "
-                          "FROM char_deaths, chars WHERE char_id = id AND char_deaths.level >= ? "
-                          "UNION "
-                          "SELECT name, user_id, world, char_levelups.level as level, null, 'levelup' AS `type`, date, "
-                          "vocation "
-                          "FROM char_levelups, chars WHERE char_id = id AND char_levelups.level >= ? "
-                          "ORDER BY date DESC", (config.announce_threshold, config.announce_threshold))
-                while True:
-                    row = c.fetchone()
-                    if row is None:
-                        break
-                    user = self.bot.get_member(row["user_id"], user_servers)
-                    if user is None:
-                        continue
-                    if row["world"] not in user_worlds:
-                        continue
-                    count += 1
-                    row["time"] = get_time_diff(dt.timedelta(seconds=now - row["date"]))
-                    row["user"] = user.display_name
-                    row["voc_emoji"] = get_voc_emoji(row["vocation"])
-                    if row["type"] == "death":
-                        row["emoji"] = config.death_emoji
-                        entries.append("{emoji}{voc_emoji} {name} (**@{user}**) - At level **{level}** by {killer} - "
-                                       "*{time} ago*".format(**row))
-                    else:
-                        row["emoji"] = config.levelup_emoji
-                        entries.append("{emoji}{voc_emoji} {name} (**@{user}**) - Level **{level}** - *{time} ago*"
-                                       .format(**row))
-                    if count >= 200:
-                        break
-            else:
-                c.execute("SELECT id, name, user_id, vocation FROM chars WHERE name LIKE ?", (name,))
-                result = c.fetchone()
-                if result is None:
-                    await ctx.send("I don't have a character with that name registered.")
-                    return
-                # If user doesn't share a server with the owner, don't display it
-                owner = self.bot.get_member(result["user_id"], user_servers)
-                if owner is None:
-                    await ctx.send("I don't have a character with that name registered.")
-                    return
-                author = owner.display_name
-                author_icon = owner.avatar_url
-                name = result["name"]
-                emoji = get_voc_emoji(result["vocation"])
-                title = f"{emoji} {name} timeline"
-                c.execute("SELECT level, killer, 'death' AS `type`, date "
-                          "FROM char_deaths WHERE char_id = ? AND level >= ? "
-                          "UNION "
-                          "SELECT level, null, 'levelup' AS `type`, date "
-                          "FROM char_levelups WHERE char_id = ? AND level >= ? "
-                          "ORDER BY date DESC", (result["id"], config.announce_threshold, result["id"], config.announce_threshold))
-                while True:
-                    row = c.fetchone()
-                    if row is None:
-                        break
-                    count += 1
-                    row["time"] = get_time_diff(dt.timedelta(seconds=now - row["date"]))
-                    if row["type"] == "death":
-                        row["emoji"] = config.death_emoji
-                        entries.append("{emoji} At level **{level}** by {killer} - *{time} ago*"
-                                       .format(**row)
-                                       )
-                    else:
-                        row["emoji"] = config.levelup_emoji
-                        entries.append("{emoji} Level **{level}** - *{time} ago*".format(**row))
-                    if count >= 200:
-                        break
-        finally:
-            c.close()
+        if name is None:
+            title = "Timeline"
+            # Members are looked up beforehand, so rows can be filtered while being read, outside the event loop
+            members = {m.id: m for g in user_servers for m in g.members}
+            rows = await asyncUserDatabase.fetchall(
+                "SELECT name, user_id, world, char_deaths.level as level, killer, 'death' AS `type`, date, vocation "
+                "FROM char_deaths, chars WHERE char_id = id AND char_deaths.level >= ? "
+                "UNION "
+                "SELECT name, user_id, world, char_levelups.level as level, null, 'levelup' AS `type`, date, vocation "
+                "FROM char_levelups, chars WHERE char_id = id AND char_levelups.level >= ? "
+                "ORDER BY date DESC", (config.announce_threshold, config.announce_threshold),
+                where=lambda r: r["user_id"] in members and r["world"] in user_worlds, limit=200)
+            for row in rows:
+                row["time"] = get_time_diff(dt.timedelta(seconds=now - row["date"]))
+                row["user"] = members[row["user_id"]].display_name
+                row["voc_emoji"] = get_voc_emoji(row["vocation"])
+                if row["type"] == "death":
+                    row["emoji"] = config.death_emoji
+                    entries.append("{emoji}{voc_emoji} {name} (**@{user}**) - At level **{level}** by {killer} - "
+                                   "*{time} ago*".format(**row))
+                else:
+                    row["emoji"] = config.levelup_emoji
+                    entries.append("{emoji}{voc_emoji} {name} (**@{user}**) - Level **{level}** - *{time} ago*"
+                                   .format(**row))
+        else:
+            result = await asyncUserDatabase.fetchone("SELECT id, name, user_id, vocation FROM chars WHERE name = ?",
+                                                      (name,))
+            if result is None:
+                await ctx.send("I don't have a character with that name registered.")
+                return
+            # If user doesn't share a server with the owner, don't display it
+            owner = self.bot.get_member(result["user_id"], user_servers)
+            if owner is None:
+                await ctx.send("I don't have a character with that name registered.")
+                return
+            author = owner.display_name
+            author_icon = owner.avatar_url
+            name = result["name"]
+            emoji = get_voc_emoji(result["vocation"])
+            title = f"{emoji} {name} timeline"
+            rows = await asyncUserDatabase.fetchall(
+                "SELECT level, killer, 'death' AS `type`, date "
+                "FROM char_deaths WHERE char_id = ? AND level >= ? "
+                "UNION "
+                "SELECT level, null, 'levelup' AS `type`, date "
+                "FROM char_levelups WHERE char_id = ? AND level >= ? "
+                "ORDER BY date DESC", (result["id"], config.announce_threshold, result["id"], config.announce_threshold),
+                limit=200)
+            for row in rows:
+                row["time"] = get_time_diff(dt.timedelta(seconds=now - row["date"]))
+                if row["type"] == "death":
+                    row["emoji"] = config.death_emoji
+                    entries.append("{emoji} At level **{level}** by {killer} - *{time} ago*".format(**row))
+                else:
+                    row["emoji"] = config.levelup_emoji
+                    entries.append("{emoji} Level **{level}** - *{time} ago*".format(**row))
 
-        if count == 0:
+        if not entries:
             await ctx.send("There are no registered events.")
             return
 
@@ -1779,10 +1721,9 @@ class Tibia:
             if not characters:
                 embed.description = f"I don't know who **{display_name}** is..."
                 return embed
-            online_list = [x.name for x in global_online_list]
             char_list = []
             for char in characters:
-                char["online"] = config.online_emoji if char["name"] in online_list else ""
+                char["online"] = config.online_emoji if char["name"] in global_online_list else ""
                 char["vocation"] = get_voc_abb(char["vocation"])
                 char["url"] = url_character + urllib.parse.quote(char["name"].encode('iso-8859-1'))
                 if len(characters) <= 10:
@@ -1840,7 +1781,8 @@ class Tibia:
         await self.bot.wait_until_ready()
         while not self.bot.is_closed():
             try:
-                recent_news = await get_recent_news()
+                await wait_until_available(TIBIADATA_HOST)
+                recent_news = await get_recent_news(priority=PRIORITY_LOW)
                 if recent_news is None:
                     await asyncio.sleep(30)
                     continue
@@ -1863,7 +1805,7 @@ class Tibia:
                     # Do not post articles older than a week (in case bot was offline)
                     if (dt.date.today() - article["date"]).days > 7:
                         break
-                    fetched_article = await get_news_article(int(article["id"]))
+                    fetched_article = await get_news_article(int(article["id"]), priority=PRIORITY_LOW)
                     if fetched_article is not None:
                         new_articles.insert(0, fetched_article)
                 with open("data/last_article.txt", 'w+') as f:
@@ -1886,7 +1828,7 @@ class Tibia:
                         except discord.HTTPException:
                             log.warning("scan_news: Malformed message.")
                 await asyncio.sleep(60 * 60 * 2)
-            except NetworkError:
+            except (NetworkError, ParseError):
                 await asyncio.sleep(30)
                 continue
             except asyncio.CancelledError:
@@ -1894,6 +1836,8 @@ class Tibia:
                 break
             except Exception:
                 log.exception("Task: scan_news")
+                # Not retried right away, so a persistent error doesn't flood the log
+                await asyncio.sleep(60)
 
     def __unload(self):
         print("cogs.tibia: Cancelling pending tasks...")
@@ -1,11 +1,11 @@
 import asyncio
 import datetime as dt
-import pickle
 import re
+import sqlite3
 import time
 import urllib.parse
 from contextlib import closing
-from typing import List
+from typing import List, Dict, Tuple
 
 import discord
 from discord.ext import commands
@@ -14,16 +14,23 @@ from nabbot import NabBot
 from utils import checks
 from utils.config import config
 from utils.context import NabCtx
-from utils.database import userDatabase, get_server_property, set_server_property
+from utils.database import userDatabase, get_server_property, set_server_property, get_chars_by_name, \
+    asyncUserDatabase
 from utils.general import global_online_list, log, join_list, is_numeric, FIELD_VALUE_LIMIT, EMBED_LIMIT, \
     get_user_avatar
 from utils.messages import weighed_choice, death_messages_player, death_messages_monster, format_message, \
     level_messages, split_message
+from utils.network import PRIORITY_LOW, TIBIADATA_HOST, TIBIA_HOST, ParseError, wait_until_available
 from utils.pages import Pages, CannotPaginate, VocationPages
-from utils.tibia import get_highscores, ERROR_NETWORK, tibia_worlds, get_world, get_character, get_voc_emoji, get_guild, \
+from utils.scanners import ScannerPool
+from utils.tibia import get_highscores_category, tibia_worlds, get_world, get_character, get_voc_emoji, get_guild, \
     get_voc_abb, get_character_url, url_guild, \
     get_tibia_time_zone, NetworkError, Death, Character, HIGHSCORE_CATEGORIES, get_voc_abb_and_emoji, get_share_range, \
     World
+from utils.tracking import death_scheduler, tracking_state, update_highscores, CHECK_SCHEDULED, CHECK_LOGIN, \
+    CHECK_LOGOUT, PipelineStage, WorldScanResult, TrackingEvent, CharacterLogin, CharacterLogout, CharacterLevelUp, \
+    CharacterDeath, COMPARE_QUEUE_SIZE, CHECK_QUEUE_SIZE, PERSIST_QUEUE_SIZE, PUBLISH_QUEUE_SIZE, watched_index, \
+    guild_rosters, WATCHED_EDIT_INTERVAL, AnnouncementDispatcher, save_level_changes, save_new_deaths
 
 
 class Tracking:
@@ -31,9 +38,35 @@ class Tracking:
 
     def __init__(self, bot: NabBot):
         self.bot = bot
+        # Online scans pipeline: fetched worlds are compared against the online list, characters that logged in or out
+        # are checked, the changes found are saved, and the resulting events are published and announced, each stage
+        # running on its own
+        self.compare_stage = PipelineStage("compare", self.compare_world, COMPARE_QUEUE_SIZE)
+        # Checks can take a while, so several worlds are checked at the same time, each world always by the same worker
+        self.check_stage = PipelineStage("check", self.check_scan, CHECK_QUEUE_SIZE,
+                                         workers=config.online_scan_concurrency, key=lambda r: r.world)
+        self.persist_stage = PipelineStage("persist", self.persist_scan, PERSIST_QUEUE_SIZE)
+        self.publish_stage = PipelineStage("publish", self.publish_event, PUBLISH_QUEUE_SIZE)
+        self.pipeline = [self.compare_stage, self.check_stage, self.persist_stage, self.publish_stage]
+        for stage in self.pipeline:
+            stage.start()
+        watched_index.load()
+        self.announcer = AnnouncementDispatcher(bot)
+        # Online lists are fetched in separate processes if enabled
+        self.scanners = None
+        if config.scan_workers > 0:
+            self.scanners = ScannerPool(config.scan_workers)
+            self.scanners.start()
+        # Watched list updates waiting to be sent, by server id
+        self.watched_pending: Dict[int, Tuple[str, str, int, int]] = {}
+        # Hash of the watched list content last sent to each server
+        self.watched_hashes: Dict[int, int] = {}
+        # Scans going through the pipeline, resolved once their changes are saved, by world
+        self.world_scans: Dict[str, asyncio.Future] = {}
         self.scan_deaths_task = self.bot.loop.create_task(self.scan_deaths())
         self.scan_online_chars_task = bot.loop.create_task(self.scan_online_chars())
         self.scan_highscores_task = bot.loop.create_task(self.scan_highscores())
+        self.update_watched_lists_task = bot.loop.create_task(self.update_watched_lists())
 
     async def scan_deaths(self):
         #################################################
@@ -41,18 +74,21 @@ class Tracking:
         # Do not touch anything, enter at your own risk #
         #################################################
         await self.bot.wait_until_ready()
+        if config.death_scan_budget <= 0:
+            log.info("scan_deaths: Scheduled death checks are disabled")
+            return
         while not self.bot.is_closed():
             try:
-                await asyncio.sleep(config.death_scan_interval)
-                if len(global_online_list) == 0:
-                    await asyncio.sleep(0.5)
+                # Checks are spread evenly to stay within the budget
+                await asyncio.sleep(60 / config.death_scan_budget)
+                await wait_until_available(TIBIADATA_HOST)
+                # Take the char most likely to have died, it goes back to the end of the queue
+                name = death_scheduler.next()
+                if name is None:
                     continue
-                # Pop last char in queue, reinsert it at the beginning
-                current_char = global_online_list.pop()
-                global_online_list.insert(0, current_char)
 
                 # Check for new death
-                await self.check_death(current_char.name)
+                await self.check_death(name, fresh=True)
             except asyncio.CancelledError:
                 # Task was cancelled, so this is fine
                 break
@@ -73,15 +109,13 @@ class Tracking:
                 continue
             for world in self.bot.tracked_worlds_list:
                 if world not in tibia_worlds:
-                    log.debug()
                     await asyncio.sleep(0.1)
+                    continue
                 try:
                     for category in HIGHSCORE_CATEGORIES:
                         # Check the last scan time, highscores are updated every server save
-                        with closing(userDatabase.cursor()) as c:
-                            c.execute("SELECT last_scan FROM highscores_times WHERE world = ? and category = ?",
-                                      (world, category,))
-                            result = c.fetchone()
+                        result = await asyncUserDatabase.fetchone("SELECT last_scan FROM highscores_times "
+                                                                  "WHERE world = ? and category = ?", (world, category))
                         if result:
                             last_scan = result["last_scan"]
                             last_scan_date = dt.datetime.utcfromtimestamp(last_scan).replace(tzinfo=dt.timezone.utc)
@@ -91,32 +125,22 @@ class Tracking:
                             today_ss = dt.datetime.now(dt.timezone.utc).replace(hour=11 - get_tibia_time_zone())
                             if not now > today_ss > last_scan_date:
                                 continue
-                        highscore_data = []
-                        for pagenum in range(1, 13):
-                            # Special cases (ek/rp mls)
-                            if category == "magic_ek":
-                                scores = await get_highscores(world, "magic", pagenum, 1)
-                            elif category == "magic_rp":
-                                scores = await get_highscores(world, "magic", pagenum, 2)
-                            else:
-                                scores = await get_highscores(world, category, pagenum)
-                            if scores == ERROR_NETWORK:
-                                continue
-                            for entry in scores:
-                                highscore_data.append(
-                                    (entry["rank"], category, world, entry["name"], entry["vocation"], entry["value"]))
-                            await asyncio.sleep(config.highscores_page_delay)
-                        with userDatabase as conn:
-                            # Delete old records
-                            conn.execute("DELETE FROM highscores WHERE category = ? AND world = ?", (category, world,))
-                            # Add current entries
-                            conn.executemany("INSERT INTO highscores(rank, category, world, name, vocation, value) "
-                                             "VALUES (?, ?, ?, ?, ?, ?)", highscore_data)
-                            # These two executes are equal to an UPDATE OR INSERT
-                            conn.execute("UPDATE highscores_times SET last_scan = ? WHERE world = ? AND category = ?",
-                                         (time.time(), world, category))
-                            conn.execute("INSERT INTO highscores_times(world, last_scan, category) SELECT ?,?,? WHERE "
-                                         "(SELECT Changes() = 0)", (world, time.time(), category))
+                        # Pause while tibia.com is down, instead of skipping pages
+                        await wait_until_available(TIBIA_HOST)
+                        try:
+                            entries = await get_highscores_category(world, category, priority=PRIORITY_LOW)
+                        except ParseError:
+                            # Trying again won't help, the category is skipped until the next server save
+                            log.warning(f"scan_highscores: {world}, {category}: invalid content, skipping")
+                            await asyncUserDatabase.execute("INSERT OR REPLACE INTO highscores_times(world, category, "
+                                                            "last_scan) VALUES (?, ?, ?)",
+                                                            (world, category, int(time.time())))
+                            continue
+                        if entries is None:
+                            # Incomplete, it will be tried again on the next iteration
+                            continue
+                        changed = await asyncUserDatabase.transaction(update_highscores, world, category, entries)
+                        log.debug(f"scan_highscores: {world}, {category}: {changed} of {len(entries)} entries changed")
                 except asyncio.CancelledError:
                     # Task was cancelled, so this is fine
                     break
@@ -131,179 +155,275 @@ class Tracking:
         # Do not touch anything, enter at your own risk #
         #################################################
         await self.bot.wait_until_ready()
+        last_scans = {}
         try:
-            with open("data/online_list.dat", "rb") as f:
-                saved_list, timestamp = pickle.load(f)
-                if (time.time() - timestamp) < config.online_list_expiration:
-                    global_online_list.clear()
-                    global_online_list.extend(saved_list)
-                    log.info("Loaded cached online list")
-                else:
-                    log.info("Cached online list is too old, discarding")
-        except FileNotFoundError:
-            pass
-        except (ValueError, pickle.PickleError):
-            log.info("Couldn't read cached online list.")
-            pass
+            saved_chars, last_scans = await tracking_state.load(config.online_list_expiration)
+            global_online_list.clear()
+            death_scheduler.clear()
+            for char, death_check in saved_chars:
+                global_online_list.add(char)
+                death_scheduler.add(char.name, death_check)
+            log.info(f"Loaded saved online list, {len(saved_chars):,} characters online")
+        except sqlite3.Error:
+            log.exception("Couldn't read saved online list")
+        # Worlds are scanned concurrently, up to a limit, each one every online_scan_interval seconds
+        semaphore = asyncio.Semaphore(config.online_scan_concurrency)
+        next_scans = {}
+        # Continue where the previous run left off
+        for world, last_scan in last_scans.items():
+            next_scans[world] = time.monotonic() + max(0, last_scan + config.online_scan_interval - time.time())
+        scans = {}
         while not self.bot.is_closed():
-            # Open connection to users.db
-            c = userDatabase.cursor()
             try:
-                # Pop last server in queue, reinsert it at the beginning
-                current_world = tibia_worlds.pop()
-                tibia_worlds.insert(0, current_world)
-
-                if current_world.capitalize() not in self.bot.tracked_worlds_list:
-                    await asyncio.sleep(0.1)
-                    continue
-
-                await asyncio.sleep(config.online_scan_interval)
-                # Get online list for this server
-                try:
-                    world = await get_world(current_world)
-                    if world is None:
-                        await asyncio.sleep(0.1)
+                await wait_until_available(TIBIADATA_HOST)
+                now = time.monotonic()
+                tracked_worlds = {w for w in self.bot.tracked_worlds_list if w in tibia_worlds}
+                # Forget worlds that are no longer tracked
+                untracked_worlds = set(next_scans) - tracked_worlds
+                for world in untracked_worlds:
+                    del next_scans[world]
+                    for char in global_online_list.remove_world(world):
+                        death_scheduler.remove(char.name)
+                if untracked_worlds:
+                    await tracking_state.remove_worlds(untracked_worlds)
+                for world, task in list(scans.items()):
+                    if task.done():
+                        del scans[world]
+                for world in tracked_worlds:
+                    if world in scans:
                         continue
-                except NetworkError:
-                    await asyncio.sleep(0.1)
-                    continue
-                current_world_online = world.players_online
-                if len(current_world_online) == 0:
-                    await asyncio.sleep(0.1)
-                    continue
-                self.bot.dispatch("world_scanned", world)
-                # Save the online list in file
-                with open("data/online_list.dat", "wb") as f:
-                    pickle.dump((global_online_list, time.time()), f, protocol=pickle.HIGHEST_PROTOCOL)
-                # Remove chars that are no longer online from the global_online_list
-                offline_list = []
-                for char in global_online_list:
-                    if char.world not in tibia_worlds:
-                        # Remove chars from worlds that no longer exist
-                        offline_list.append(char)
-                    elif char.world == current_world:
-                        offline = True
-                        for server_char in current_world_online:
-                            if server_char.name == char.name:
-                                offline = False
-                                break
-                        if offline:
-                            offline_list.append(char)
-                for offline_char in offline_list:
-                    global_online_list.remove(offline_char)
-                    # Check for deaths and level ups when removing from online list
-                    try:
-                        name = offline_char.name
-                        offline_char = await get_character(name, bot=self.bot)
-                    except NetworkError:
-                        log.error(f"scan_online_chars: Could not fetch {name}, NetWorkError")
+                    if world not in next_scans:
+                        # Spread the first scans across the interval, instead of scanning every world at once
+                        next_scans[world] = now + config.online_scan_interval * len(next_scans) / len(tracked_worlds)
+                    if now < next_scans[world]:
                         continue
-                    if offline_char is not None:
-                        c.execute("SELECT name, level, id FROM chars WHERE name LIKE ?", (offline_char.name,))
-                        result = c.fetchone()
-                        if result:
-                            c.execute("UPDATE chars SET level = ? WHERE name LIKE ?",
-                                      (offline_char.level, offline_char.name))
-                            if offline_char.level > result["level"] > 0:
-                                # Saving level up date in database
-                                c.execute(
-                                    "INSERT INTO char_levelups (char_id,level,date) VALUES(?,?,?)",
-                                    (result["id"], offline_char.level, time.time(),)
-                                )
-                                # Announce the level up
-                                await self.announce_level(offline_char.level, char=offline_char)
-                        await self.check_death(offline_char.name)
-                # Add new online chars and announce level differences
-                for server_char in current_world_online:
-                    c.execute("SELECT name, level, id, user_id FROM chars WHERE name LIKE ?",
-                              (server_char.name,))
-                    result = c.fetchone()
-                    # If its a stalked character
-                    if result:
-                        # We update their last level in the db
-                        c.execute(
-                            "UPDATE chars SET level = ? WHERE name LIKE ?",
-                            (server_char.level, server_char.name)
-                        )
-                        if server_char not in global_online_list:
-                            # If the character wasn't in the globalOnlineList we add them
-                            # (We insert them at the beginning of the list to avoid messing with the death checks order)
-                            global_online_list.insert(0, server_char)
-                            await self.check_death(server_char.name)
-                        # Else we check for levelup
-                        elif server_char.level > result["level"] > 0:
-                            # Saving level up date in database
-                            c.execute(
-                                "INSERT INTO char_levelups (char_id,level,date) VALUES(?,?,?)",
-                                (result["id"], server_char.level, time.time(),)
-                            )
-                            # Announce the level up
-                            await self.announce_level(server_char.level, char_name=server_char.name)
+                    next_scans[world] = now + config.online_scan_interval
+                    scans[world] = asyncio.ensure_future(self.scan_world(world, semaphore))
+                await asyncio.sleep(1)
             except asyncio.CancelledError:
                 # Task was cancelled, so this is fine
                 break
             except Exception:
                 log.exception("scan_online_chars")
+                await asyncio.sleep(1)
                 continue
-            finally:
-                userDatabase.commit()
-                c.close()
+        for task in scans.values():
+            task.cancel()
 
-    async def on_world_scanned(self, scanned_world: World):
-        # Watched List checking
-        # Iterate through servers with tracked world to find one that matches the current world
-        for server, world in self.bot.tracked_worlds.items():
-            if world != scanned_world.name:
-                await asyncio.sleep(0.01)
+    async def scan_world(self, current_world: str, semaphore: asyncio.Semaphore):
+        """Fetches the online list of a world, and queues it to be compared against the online list.
+
+        It doesn't return until the scan's changes are saved, so the next scan of the world is compared against them.
+
+        :param current_world: The name of the world to scan.
+        :param semaphore: Limits the number of worlds scanned at the same time.
+        """
+        try:
+            async with semaphore:
+                # Get online list for this server
+                try:
+                    if self.scanners is not None:
+                        world = await self.scanners.get_world(current_world)
+                    else:
+                        world = await get_world(current_world, priority=PRIORITY_LOW, fresh=True)
+                    if world is None:
+                        return
+                except (NetworkError, ParseError):
+                    return
+                if len(world.players_online) == 0:
+                    return
+                done = self.bot.loop.create_future()
+                self.world_scans[current_world] = done
+                # Waits if the next stages are falling behind
+                await self.compare_stage.put(world)
+            await done
+        except asyncio.CancelledError:
+            # Task was cancelled, so this is fine
+            pass
+        except Exception:
+            log.exception(f"scan_world: {current_world}")
+        finally:
+            self.world_scans.pop(current_world, None)
+
+    def finish_world_scan(self, world: str):
+        """Marks a world's scan as finished, allowing the world to be scanned again.
+
+        :param world: The name of the world.
+        """
+        done = self.world_scans.pop(world, None)
+        if done is not None and not done.done():
+            done.set_result(None)
+
+    async def compare_world(self, world: World):
+        """Compares a world's online list against the global online list, looking for level ups, logins and logouts.
+
+        The result is queued for the characters that logged in or out to be checked.
+
+        :param world: The world that was fetched.
+        """
+        try:
+            await self._compare_world(world)
+        except Exception:
+            self.finish_world_scan(world.name)
+            raise
+
+    async def _compare_world(self, world: World):
+        current_world = world.name
+        current_world_online = world.players_online
+        self.bot.dispatch("world_scanned", world)
+        # Remove chars that are no longer online from the global_online_list
+        offline_list = global_online_list.remove_missing(current_world, current_world_online)
+        # Look up all the registered characters involved at once
+        names = [c.name for c in current_world_online] + [c.name for c in offline_list]
+        registered = await asyncUserDatabase.read(lambda conn: get_chars_by_name(names, conn))
+        result = WorldScanResult(current_world, [], [c.name for c in offline_list])
+        result.registered = registered
+        events = []
+        for offline_char in offline_list:
+            death_scheduler.remove(offline_char.name)
+            events.append(CharacterLogout(offline_char.name, offline_char.world))
+        # Add new online chars and announce level differences
+        for server_char in current_world_online:
+            row = registered.get(server_char.name.lower())
+            # If its a stalked character
+            if not row:
                 continue
-            if self.bot.get_guild(server) is None:
-                await asyncio.sleep(0.01)
+            # We update their last level in the db
+            if server_char.level != row["level"]:
+                result.level_updates.append((server_char.level, row["id"]))
+            previous = global_online_list.get(server_char.name)
+            if previous is None:
+                # If the character wasn't in the globalOnlineList we add them
+                # (They are checked for deaths last, to avoid messing with the death checks order)
+                global_online_list.add(server_char)
+                death_scheduler.add(server_char.name)
+                events.append(CharacterLogin(server_char.name, current_world, server_char.level))
+                result.logins.append(server_char.name)
                 continue
+            # A level change makes a death check more urgent, specially if the level went down
+            death_scheduler.level_changed(server_char.name, previous.level, server_char.level)
+            # Keep the latest level in the list
+            global_online_list.add(server_char)
+            # Else we check for levelup
+            if server_char.level > row["level"] > 0:
+                result.levelups.append((row["id"], server_char.level, server_char.name, None))
+        result.online = global_online_list.get_world(current_world)
+        for event in events:
+            await self.publish_stage.put(event)
+        await self.check_stage.put(result)
+
+    async def check_scan(self, result: WorldScanResult):
+        """Checks the characters that logged in or out in a world scan for deaths and level ups.
+
+        The result is then queued to be saved.
+
+        :param result: The changes found in the scan.
+        """
+        try:
+            await self._check_scan(result)
+        except Exception:
+            self.finish_world_scan(result.world)
+            raise
+
+    async def _check_scan(self, result: WorldScanResult):
+        # Logged off and logged in characters are checked concurrently, up to a limit
+        check_limit = asyncio.Semaphore(config.death_check_concurrency)
+
+        async def check_logout(name):
+            # Check for deaths and level ups when removing from online list
+            try:
+                async with check_limit:
+                    offline_char = await get_character(name, bot=self.bot, priority=PRIORITY_LOW, fresh=True)
+            except NetworkError:
+                log.error(f"scan_online_chars: Could not fetch {name}, NetWorkError")
+                return
+            except ParseError:
+                log.error(f"scan_online_chars: Could not parse {name}, ParseError")
+                return
+            if offline_char is None:
+                return
+            row = result.registered.get(name.lower())
+            if row:
+                if offline_char.level != row["level"]:
+                    result.level_updates.append((offline_char.level, row["id"]))
+                if offline_char.level > row["level"] > 0:
+                    result.levelups.append((row["id"], offline_char.level, offline_char.name, offline_char))
+            # The character was just fetched, so it's not fetched again
+            await self.check_death(offline_char.name, char=offline_char, reason=CHECK_LOGOUT)
+
+        async def check_login(name):
+            async with check_limit:
+                await self.check_death(name, fresh=True, reason=CHECK_LOGIN)
+
+        pending = [check_logout(name) for name in result.offline] + [check_login(name) for name in result.logins]
+        for error in await asyncio.gather(*pending, return_exceptions=True):
+            if isinstance(error, Exception):
+                log.error(f"check_scan: Error checking character in {result.world}", exc_info=error)
+        await self.persist_stage.put(result)
+
+    async def persist_scan(self, result: WorldScanResult):
+        """Saves the changes found in a world scan, and queues the level ups found to be announced.
+
+        :param result: The changes found.
+        """
+        try:
+            await asyncUserDatabase.transaction(save_level_changes, result)
+            # Save the world's online list, so it can be restored after a restart
+            await tracking_state.save_world(result.world, result.online, result.offline, death_scheduler)
+        finally:
+            self.finish_world_scan(result.world)
+        for _, level, name, char in result.levelups:
+            await self.publish_stage.put(CharacterLevelUp(name, result.world, level, char))
+
+    async def publish_event(self, event: TrackingEvent):
+        """Dispatches an event to every cog, and announces it if applicable.
+
+        :param event: The event to publish.
+        """
+        self.bot.dispatch(event.event_name, event)
+        if isinstance(event, CharacterLevelUp):
+            await self.announce_level(event.level, char_name=event.name, char=event.char)
+        elif isinstance(event, CharacterDeath):
+            await self.announce_death(event.death, event.levels_lost, event.char)
+
+    async def on_world_scanned(self, scanned_world: World):
+        # Watched List checking
+        # Find the online watched characters of every server in a single pass
+        watched_online = watched_index.match(scanned_world.players_online)
+        # Servers with a watched channel that track the current world, including those with an empty watched list, so
+        # their message is updated after their last entry is removed
+        servers = [s for s, w in self.bot.tracked_worlds.items()
+                   if w == scanned_world.name and self.bot.get_guild(s) is not None
+                   and get_server_property(s, "watched_channel", is_int=True) is not None]
+        # Fetch the members of the watched guilds only once, their online members are found using the world's list
+        await guild_rosters.update({g for s in servers for g in watched_index.get_guilds(s)})
+        online_chars = {c.name.lower(): c for c in scanned_world.players_online}
+        for server in servers:
             watched_channel_id = get_server_property(server, "watched_channel", is_int=True)
             if watched_channel_id is None:
                 # This server doesn't have watch list enabled
-                await asyncio.sleep(0.1)
                 continue
             watched_channel: discord.TextChannel = self.bot.get_channel(watched_channel_id)
             if watched_channel is None:
                 # This server's watched channel is not available to the bot anymore.
-                await asyncio.sleep(0.1)
-                continue
-            # Get watched list
-            entries = userDatabase.execute("SELECT * FROM watched_list WHERE server_id = ? "
-                                           "ORDER BY is_guild, name", (server,))
-            if not entries:
-                await asyncio.sleep(0.1)
                 continue
             # Online watched characters
-            currently_online = []
+            currently_online = watched_online.get(server, [])
             # Watched guilds
             guild_online = dict()
-            for watched in entries:
-                if watched["is_guild"]:
-                    try:
-                        guild = await get_guild(watched["name"])
-                    except NetworkError:
-                        continue
-                    # If the guild doesn't exist, add it as empty to show it was disbanded
-                    if guild is None:
-                        guild_online[watched["name"]] = None
-                        continue
-                    # If there's at least one member online, add guild to list
-                    if len(guild.online):
-                        guild_online[guild.name] = guild.online
-                # If it is a character, check if he's in the online list
-                for online_char in scanned_world.players_online:
-                    if online_char.name == watched["name"]:
-                        # Add to online list
-                        currently_online.append(online_char)
-            watched_message_id = get_server_property(server, "watched_message", is_int=True)
-            # We try to get the watched message, if the bot can't find it, we just create a new one
-            # This may be because the old message was deleted or this is the first time the list is checked
-            try:
-                watched_message = await watched_channel.get_message(watched_message_id)
-            except discord.HTTPException:
-                watched_message = None
+            for guild_name in watched_index.get_guilds(server):
+                if guild_name not in guild_rosters:
+                    # The guild couldn't be fetched yet
+                    continue
+                guild = guild_rosters.get(guild_name)
+                # If the guild doesn't exist, add it as empty to show it was disbanded
+                if guild is None:
+                    guild_online[guild_name] = None
+                    continue
+                # If there's at least one member online, add guild to list
+                members = guild_rosters.get_online(guild_name, online_chars)
+                if members:
+                    guild_online[guild.name] = members
             items = [f"\t{x.name} - Level {x.level} {get_voc_emoji(x.vocation)}" for x in currently_online]
             online_count = len(items)
             if len(items) > 0 or len(guild_online.keys()) > 0:
@@ -315,73 +435,130 @@ class Tracking:
                         content += "\t*Guild was disbanded.*"
                         continue
                     content += "\n".join(
-                        [f"\t{x['name']} - Level {x['level']} {get_voc_emoji(x['vocation'])}"
-                         for x in members])
+                        [f"\t{x.name} - Level {x.level} {get_voc_emoji(x.vocation)}" for x in members])
                     online_count += len(members)
             else:
                 description = "There are no watched characters online."
                 content = ""
-            # Send new watched message or edit last one
-            embed = discord.Embed(description=description)
-            embed.set_footer(text="Last updated")
-            embed.timestamp = dt.datetime.utcnow()
-            if content:
-                if len(content) >= EMBED_LIMIT - 50:
-                    content = split_message(content, EMBED_LIMIT - 50)[0]
-                    content += "\n*And more...*"
-                fields = split_message(content, FIELD_VALUE_LIMIT)
-                for s, split_field in enumerate(fields):
-                    name = "Watched List" if s == 0 else "\u200F"
-                    embed.add_field(name=name, value=split_field, inline=False)
+            # Only queue an update if the list changed since it was last sent, queued updates replace older ones
+            render_hash = hash((description, content, online_count))
+            if self.watched_hashes.get(server) == render_hash:
+                self.watched_pending.pop(server, None)
+            else:
+                self.watched_pending[server] = (description, content, online_count, render_hash)
+
+    async def update_watched_lists(self):
+        """Sends the queued watched list updates.
+
+        Updates are sent in batches, so each server's list is edited at most once per interval."""
+        await self.bot.wait_until_ready()
+        while not self.bot.is_closed():
             try:
-                if watched_message is None:
-                    new_watched_message = await watched_channel.send(embed=embed)
-                    set_server_property(server, "watched_message", new_watched_message.id)
-                else:
-                    await watched_message.edit(embed=embed)
-                await watched_channel.edit(name=f"{watched_channel.name.split('·', 1)[0]}·{online_count}")
-            except discord.HTTPException:
-                pass
+                await asyncio.sleep(WATCHED_EDIT_INTERVAL)
+                pending, self.watched_pending = self.watched_pending, {}
+                for server, render in pending.items():
+                    await self.update_watched_list(server, *render)
+            except asyncio.CancelledError:
+                # Task was cancelled, so this is fine
+                break
+            except Exception:
+                log.exception("Task: update_watched_lists")
+                continue
 
-    async def check_death(self, character):
-        """Checks if the player has new deaths"""
-        try:
-            char = await get_character(character, bot=self.bot)
-            if char is None:
-                # During server save, characters can't be read sometimes
-                return
-        except NetworkError:
-            log.warning("check_death: couldn't fetch {0}".format(character))
+    async def update_watched_list(self, server: int, description: str, content: str, online_count: int,
+                                  render_hash: int):
+        """Edits a server's watched list message, or sends a new one, and updates the channel's name.
+
+        :param server: The id of the server.
+        :param description: The description of the watched list.
+        :param content: The online characters and guilds.
+        :param online_count: The number of characters online.
+        :param render_hash: The hash of the watched list's content, saved once the message is sent.
+        """
+        if self.bot.get_guild(server) is None:
             return
-        c = userDatabase.cursor()
-        c.execute("SELECT name, id FROM chars WHERE name LIKE ?", (character,))
-        result = c.fetchone()
-        if result is None:
+        watched_channel_id = get_server_property(server, "watched_channel", is_int=True)
+        watched_channel: discord.TextChannel = self.bot.get_channel(watched_channel_id)
+        if watched_channel is None:
             return
-        char_id = result["id"]
-        pending_deaths = []
-        for death in char.deaths:
-            death_time = death.time.timestamp()
-            # Check if we have a death that matches the time
-            c.execute("SELECT * FROM char_deaths "
-                      "WHERE char_id = ? AND date >= ? AND date <= ? AND level = ? AND killer LIKE ?",
-                      (char_id, death_time - 20, death_time + 20, death.level, death.killer))
-            result = c.fetchone()
-            if result is not None:
-                # We already have this death, we're assuming we already have older deaths
-                break
-            pending_deaths.append(death)
-        c.close()
-
-        # Announce and save deaths from older to new
-        for death in reversed(pending_deaths):
-            with userDatabase as con:
-                con.execute("INSERT INTO char_deaths(char_id, level, killer, byplayer, date) VALUES(?,?,?,?,?)",
-                            (char_id, death.level, death.killer, death.by_player, death.time.timestamp()))
+        watched_message_id = get_server_property(server, "watched_message", is_int=True)
+        # We try to get the watched message, if the bot can't find it, we just create a new one
+        # This may be because the old message was deleted or this is the first time the list is checked
+        try:
+            watched_message = await watched_channel.get_message(watched_message_id)
+        except discord.NotFound:
+            # A new message is sent below, if that fails too, it's sent again on the next update
+            self.watched_hashes.pop(server, None)
+            watched_message = None
+        except discord.HTTPException:
+            watched_message = None
+        # Send new watched message or edit last one
+        embed = discord.Embed(description=description)
+        embed.set_footer(text="Last updated")
+        embed.timestamp = dt.datetime.utcnow()
+        if content:
+            if len(content) >= EMBED_LIMIT - 50:
+                content = split_message(content, EMBED_LIMIT - 50)[0]
+                content += "\n*And more...*"
+            fields = split_message(content, FIELD_VALUE_LIMIT)
+            for s, split_field in enumerate(fields):
+                name = "Watched List" if s == 0 else "\u200F"
+                embed.add_field(name=name, value=split_field, inline=False)
+        try:
+            if watched_message is None:
+                new_watched_message = await watched_channel.send(embed=embed)
+                set_server_property(server, "watched_message", new_watched_message.id)
+            else:
+                await watched_message.edit(embed=embed)
+            channel_name = f"{watched_channel.name.split('·', 1)[0]}·{online_count}"
+            # Channel renames have a very low rate limit
+            if watched_channel.name != channel_name:
+                await watched_channel.edit(name=channel_name)
+            self.watched_hashes[server] = render_hash
+        except discord.NotFound:
+            # The message or channel was deleted meanwhile, the list is sent again on the next update
+            self.watched_hashes.pop(server, None)
+        except discord.HTTPException:
+            pass
+
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        """Sends the watched list again on the next update if its message is deleted, even if it didn't change."""
+        channel = self.bot.get_channel(payload.channel_id)
+        if not isinstance(channel, discord.TextChannel):
+            return
+        if get_server_property(channel.guild.id, "watched_message", is_int=True) == payload.message_id:
+            self.watched_hashes.pop(channel.guild.id, None)
+
+    async def on_levels_channel_change(self, server_id: int):
+        self.announcer.invalidate()
+
+    async def check_death(self, character, *, char: Character = None, fresh=False, reason=CHECK_SCHEDULED):
+        """Checks if the player has new deaths
+
+        If the character was already fetched, it can be passed as char to avoid fetching it again.
+        If fresh is set, the character is always fetched instead of using a recently cached one.
+        The reason is used for the death checks statistics."""
+        if char is None:
+            try:
+                char = await get_character(character, bot=self.bot, priority=PRIORITY_LOW, fresh=fresh)
+                if char is None:
+                    # During server save, characters can't be read sometimes
+                    return
+            except NetworkError:
+                log.warning("check_death: couldn't fetch {0}".format(character))
+                return
+            except ParseError:
+                log.warning("check_death: couldn't parse {0}".format(character))
+                return
+        death_scheduler.checked(character, reason)
+        new_deaths = await asyncUserDatabase.transaction(save_new_deaths, character, char.deaths)
+        # Queue new deaths to be announced, from older to new
+        for death in new_deaths:
             if time.time() - death.time.timestamp() >= (30 * 60):
                 log.info("Death detected, too old to announce: {0}({1.level}) | {1.killer}".format(character, death))
             else:
-                await self.announce_death(death, max(death.level - char.level, 0), char)
+                death_scheduler.record_detection(time.time() - death.time.timestamp(), reason)
+                await self.publish_stage.put(CharacterDeath(char, death, max(death.level - char.level, 0)))
 
     async def announce_death(self, death: Death, levels_lost=0, char: Character = None, char_name: str = None):
         """Announces a level up on the corresponding servers"""
@@ -393,19 +570,24 @@ class Tracking:
                 log.error("announce_death: no character or character name passed.")
                 return
             try:
-                char = await get_character(char_name, bot=self.bot)
+                char = await get_character(char_name, bot=self.bot, priority=PRIORITY_LOW)
             except NetworkError:
                 log.warning("announce_death: couldn't fetch character (" + char_name + ")")
                 return
+            except ParseError:
+                log.warning("announce_death: couldn't parse character (" + char_name + ")")
+                return
 
         log.info("Announcing death: {0.name}({1.level}) | {1.killer}".format(char, death))
 
         # Find killer article (a/an)
+        # The death object may be shared with cached characters, so the killer is not modified
+        killer = death.killer
         killer_article = ""
         if not death.by_player:
-            killer_article = death.killer.split(" ", 1)
+            killer_article = killer.split(" ", 1)
             if killer_article[0] in ["a", "an"] and len(killer_article) > 1:
-                death.killer = killer_article[1]
+                killer = killer_article[1]
                 killer_article = killer_article[0] + " "
             else:
                 killer_article = ""
@@ -414,34 +596,24 @@ class Tracking:
         if death.by_player:
             message = weighed_choice(death_messages_player, vocation=char.vocation, level=death.level,
                                      levels_lost=levels_lost)
-        elif death.killer in ["death", "energy", "earth", "fire", "Pit Battler", "Pit Berserker", "Pit Blackling",
-                              "Pit Brawler", "Pit Condemned", "Pit Demon", "Pit Destroyer", "Pit Fiend",
-                              "Pit Groveller", "Pit Grunt", "Pit Lord", "Pit Maimer", "Pit Overlord", "Pit Reaver",
-                              "Pit Scourge"] and levels_lost == 0:
+        elif killer in ["death", "energy", "earth", "fire", "Pit Battler", "Pit Berserker", "Pit Blackling",
+                        "Pit Brawler", "Pit Condemned", "Pit Demon", "Pit Destroyer", "Pit Fiend",
+                        "Pit Groveller", "Pit Grunt", "Pit Lord", "Pit Maimer", "Pit Overlord", "Pit Reaver",
+                        "Pit Scourge"] and levels_lost == 0:
             # Skip element damage deaths unless player lost a level to avoid spam from arena deaths
             # This will cause a small amount of deaths to not be announced but it's probably worth the tradeoff (ty selken)
             return
         else:
             message = weighed_choice(death_messages_monster, vocation=char.vocation, level=death.level,
-                                     levels_lost=levels_lost, killer=death.killer)
+                                     levels_lost=levels_lost, killer=killer)
         # Format message with death information
-        death_info = {'name': char.name, 'level': death.level, 'killer': death.killer, 'killer_article': killer_article,
+        death_info = {'name': char.name, 'level': death.level, 'killer': killer, 'killer_article': killer_article,
                       'he_she': char.he_she.lower(), 'his_her': char.his_her.lower(), 'him_her': char.him_her.lower()}
         message = message.format(**death_info)
         # Format extra stylization
         message = f"{config.pvpdeath_emoji if death.by_player else config.death_emoji} {format_message(message)}"
 
-        for guild_id, tracked_world in self.bot.tracked_worlds.items():
-            guild = self.bot.get_guild(guild_id)
-            if char.world == tracked_world and guild is not None and guild.get_member(char.owner) is not None:
-                try:
-                    channel = self.bot.get_channel_or_top(guild,
-                                                          get_server_property(guild.id, "levels_channel", is_int=True))
-                    await channel.send(message[:1].upper() + message[1:])
-                except discord.Forbidden:
-                    log.warning("announce_death: Missing permissions.")
-                except discord.HTTPException:
-                    log.warning("announce_death: Malformed message.")
+        self.announcer.announce(char, message[:1].upper() + message[1:])
 
     async def announce_level(self, level, char_name: str = None, char: Character = None):
         """Announces a level up on corresponding servers
@@ -459,10 +631,13 @@ class Tracking:
                 log.error("announce_level: no character or character name passed.")
                 return
             try:
-                char = await get_character(char_name, bot=self.bot)
+                char = await get_character(char_name, bot=self.bot, priority=PRIORITY_LOW)
             except NetworkError:
                 log.warning("announce_level: couldn't fetch character (" + char_name + ")")
                 return
+            except ParseError:
+                log.warning("announce_level: couldn't parse character (" + char_name + ")")
+                return
 
         log.info("Announcing level up: {0} ({1})".format(char.name, level))
 
@@ -475,17 +650,7 @@ class Tracking:
         # Format extra stylization
         message = f"{config.levelup_emoji} {format_message(message)}"
 
-        for server_id, tracked_world in self.bot.tracked_worlds.items():
-            server = self.bot.get_guild(server_id)
-            if char.world == tracked_world and server is not None and server.get_member(char.owner) is not None:
-                try:
-                    channel = self.bot.get_channel_or_top(server,
-                                                          get_server_property(server.id, "levels_channel", is_int=True))
-                    await channel.send(message)
-                except discord.Forbidden:
-                    log.warning("announce_level: Missing permissions.")
-                except discord.HTTPException:
-                    log.warning("announce_level: Malformed message.")
+        self.announcer.announce(char, message)
 
     # Commands
     @commands.command()
@@ -530,7 +695,7 @@ class Tracking:
 
         await ctx.trigger_typing()
         try:
-            char = await get_character(char_name)
+            char = await get_character(char_name, fresh=True)
             if char is None:
                 await ctx.send("That character doesn't exist.")
                 return
@@ -569,7 +734,7 @@ class Tracking:
                 continue
             with closing(userDatabase.cursor()) as c:
                 c.execute("SELECT name, guild, user_id as owner, vocation, ABS(level) as level, guild FROM chars "
-                          "WHERE name LIKE ?", (char.name,))
+                          "WHERE name = ?", (char.name,))
                 db_char = c.fetchone()
             if db_char is not None:
                 owner = self.bot.get_member(db_char["owner"])
@@ -637,7 +802,7 @@ class Tracking:
 
         for char in updated:
             with userDatabase as conn:
-                conn.execute("UPDATE chars SET user_id = ? WHERE name LIKE ?", (user.id, char['name']))
+                conn.execute("UPDATE chars SET user_id = ? WHERE name = ?", (user.id, char['name']))
         for char in added:
             with userDatabase as conn:
                 conn.execute("INSERT INTO chars (name,level,vocation,user_id, world, guild) VALUES (?,?,?,?,?,?)",
@@ -715,7 +880,7 @@ class Tracking:
                 continue
             with closing(userDatabase.cursor()) as c:
                 c.execute("SELECT name, guild, user_id as owner, vocation, ABS(level) as level, guild FROM chars "
-                          "WHERE name LIKE ?", (char.name,))
+                          "WHERE name = ?", (char.name,))
                 db_char = c.fetchone()
             if db_char is not None:
                 owner = self.bot.get_member(db_char["owner"])
@@ -792,7 +957,7 @@ class Tracking:
 
         for char in updated:
             with userDatabase as conn:
-                conn.execute("UPDATE chars SET user_id = ? WHERE name LIKE ?", (user.id, char['name']))
+                conn.execute("UPDATE chars SET user_id = ? WHERE name = ?", (user.id, char['name']))
         for char in added:
             with userDatabase as conn:
                 conn.execute("INSERT INTO chars (name,level,vocation,user_id, world, guild) VALUES (?,?,?,?,?,?)",
@@ -823,7 +988,7 @@ class Tracking:
         c = userDatabase.cursor()
         try:
             c.execute("SELECT id, name, ABS(level) as level, user_id, vocation, world, guild "
-                      "FROM chars WHERE name LIKE ?", (name,))
+                      "FROM chars WHERE name = ?", (name,))
             char = c.fetchone()
             if char is None or char["user_id"] == 0:
                 await ctx.send("There's no character registered with that name.")
@@ -843,6 +1008,7 @@ class Tracking:
                 await ctx.send("No then? Ok.")
 
             c.execute("UPDATE chars SET user_id = 0 WHERE id = ?", (char["id"],))
+            userDatabase.commit()
             await ctx.send("**{0}** is no longer registered to you.".format(char["name"]))
 
             user_servers = [s.id for s in self.bot.get_user_guilds(user.id)]
@@ -878,15 +1044,12 @@ class Tracking:
         entries = []
         vocations = []
         try:
-            for char in global_online_list:
-                char_world = char.world
+            for char in global_online_list.get_world(world):
                 name = char.name
-                c.execute("SELECT name, user_id, vocation, ABS(level) as level FROM chars WHERE name LIKE ?", (name,))
+                c.execute("SELECT name, user_id, vocation, ABS(level) as level FROM chars WHERE name = ?", (name,))
                 row = c.fetchone()
                 if row is None:
                     continue
-                if char_world != world:
-                    continue
                 # Skip characters of members not in the server
                 owner = ctx.guild.get_member(row["user_id"])
                 if owner is None:
@@ -1007,7 +1170,6 @@ class Tracking:
                       "WHERE level >= ? AND level <= ? AND world = ?"
                       "ORDER by level DESC", (low, high, tracked_world,))
             count = 0
-            online_list = [x.name for x in global_online_list]
             while True:
                 player = c.fetchone()
                 if player is None:
@@ -1025,7 +1187,7 @@ class Tracking:
                 player["emoji"] = get_voc_emoji(player["vocation"])
                 player["voc"] = get_voc_abb(player["vocation"])
                 line_format = "**{name}** - Level {level} {voc}{emoji} - @**{owner}** {online}"
-                if player["name"] in online_list:
+                if player["name"] in global_online_list:
                     player["online"] = config.online_emoji
                     online_entries.append(line_format.format(**player))
                     online_vocations.append(player["vocation"])
@@ -1101,6 +1263,8 @@ class Tracking:
                                "**It is important to not allow anyone to write in here**\n"
                                "*This message can be deleted now.*")
             set_server_property(ctx.guild.id, "watched_channel", channel.id)
+            # Make sure the list is sent to the new channel
+            self.watched_hashes.pop(ctx.guild.id, None)
 
     @checks.is_mod()
     @checks.is_tracking_world()
@@ -1127,7 +1291,7 @@ class Tracking:
             return
 
         try:
-            char = await get_character(name)
+            char = await get_character(name, fresh=True)
             if char is None:
                 await ctx.send("There's no character with that name.")
                 return
@@ -1160,6 +1324,8 @@ class Tracking:
             c.execute("INSERT INTO watched_list(name, server_id, is_guild, reason, author, added) "
                       "VALUES(?, ?, 0, ?, ?, ?)",
                       (char.name, ctx.guild.id, reason, ctx.author.id, time.time()))
+            watched_index.add(ctx.guild.id, char.name)
+            userDatabase.commit()
             await ctx.send("Character added to the watched list.")
         finally:
             userDatabase.commit()
@@ -1220,6 +1386,9 @@ class Tracking:
 
             c.execute("INSERT INTO watched_list(name, server_id, is_guild, reason, author, added)"
                       "VALUES(?, ?, 1, ?, ?, ?)", (guild.name, ctx.guild.id, reason, ctx.author.id, time.time()))
+            watched_index.add(ctx.guild.id, guild.name, is_guild=True)
+            guild_rosters.set(guild.name, guild)
+            userDatabase.commit()
             await ctx.send("Guild added to the watched list.")
         finally:
             userDatabase.commit()
@@ -1374,6 +1543,8 @@ class Tracking:
 
             c.execute("DELETE FROM watched_list WHERE server_id = ? AND name LIKE ? AND is_guild = 0",
                       (ctx.guild.id, name,))
+            watched_index.remove(ctx.guild.id, result["name"])
+            userDatabase.commit()
             await ctx.send("Character removed from the watched list.")
         finally:
             userDatabase.commit()
@@ -1412,6 +1583,10 @@ class Tracking:
 
             c.execute("DELETE FROM watched_list WHERE server_id = ? AND name LIKE ? AND is_guild = 1",
                       (ctx.guild.id, name,))
+            watched_index.remove(ctx.guild.id, result["name"], is_guild=True)
+            if not watched_index.is_watched(result["name"], is_guild=True):
+                guild_rosters.discard(result["name"])
+            userDatabase.commit()
             await ctx.send("Guild removed from the watched list.")
         finally:
             userDatabase.commit()
@@ -1419,9 +1594,15 @@ class Tracking:
 
     def __unload(self):
         print("cogs.tracking: Cancelling pending tasks...")
+        for stage in self.pipeline:
+            stage.stop()
         self.scan_deaths_task.cancel()
         self.scan_highscores_task.cancel()
         self.scan_online_chars_task.cancel()
+        self.update_watched_lists_task.cancel()
+        self.announcer.close()
+        if self.scanners is not None:
+            self.scanners.stop()
 
 
 def setup(bot):
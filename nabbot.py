@@ -1,5 +1,7 @@
+import asyncio
 import datetime as dt
 import re
+import sqlite3
 import sys
 import traceback
 from typing import Union, List, Optional, Dict
@@ -9,10 +11,12 @@ from discord.ext import commands
 
 from utils import context
 from utils.config import config
-from utils.database import init_database, userDatabase, get_server_property
+from utils.database import init_database, userDatabase, get_server_property, maintain_databases, \
+    enable_incremental_vacuum, asyncUserDatabase, prune_highscores_history, MAINTENANCE_INTERVAL
 from utils.general import join_list, get_token, get_user_avatar, get_region_string
 from utils.general import log
 from utils.help_format import NabHelpFormat
+from utils.network import close_session, ParseError
 from utils.tibia import populate_worlds, tibia_worlds, get_voc_abb_and_emoji
 
 initial_cogs = {"cogs.tracking", "cogs.owner", "cogs.mod", "cogs.admin", "cogs.tibia", "cogs.general", "cogs.loot",
@@ -45,6 +49,7 @@ class NabBot(commands.Bot):
         self.tracked_worlds_list = []
         self.__version__ = "1.3.0"
         self.__min_discord__ = 1480
+        self.database_maintenance_task = self.loop.create_task(self.database_maintenance())
 
     async def on_ready(self):
         """Called when the bot is ready."""
@@ -72,6 +77,34 @@ class NabBot(commands.Bot):
 
         log.info('Bot is online and ready')
 
+    async def database_maintenance(self):
+        """Runs the databases' maintenance periodically, on a separate thread.
+
+        Old highscores history entries are deleted first, according to highscores_history_days."""
+        await self.wait_until_ready()
+        while not self.is_closed():
+            try:
+                await asyncio.sleep(MAINTENANCE_INTERVAL)
+                if config.highscores_history_days > 0:
+                    deleted = await asyncUserDatabase.transaction(prune_highscores_history,
+                                                                  config.highscores_history_days)
+                    log.info(f"database_maintenance: Deleted {deleted:,} old highscores history entries")
+                errors = await self.loop.run_in_executor(None, maintain_databases)
+                for path, error in errors.items():
+                    log.warning(f"database_maintenance: Couldn't maintain {path}: {error}")
+            except asyncio.CancelledError:
+                # Task was cancelled, so this is fine
+                break
+            except Exception:
+                log.exception("Task: database_maintenance")
+                continue
+
+    async def close(self):
+        """Closes the connection to discord and releases the shared HTTP session."""
+        await close_session()
+        asyncUserDatabase.close()
+        await super().close()
+
     async def on_message(self, message: discord.Message):
         """Called every time a message is sent on a visible channel."""
         # Ignore if message is from any bot
@@ -106,6 +139,17 @@ class NabBot(commands.Bot):
                 log.error(f"Reply to '{ctx.message.clean_content}' was too long.")
                 await ctx.send("Sorry, the message was too long to send.")
                 return
+            if isinstance(error.original, ParseError):
+                # The upstream service replied, but not with what was expected, trying again won't help
+                log.error(f"Invalid upstream content in command: {ctx.message.clean_content}, {error.original}")
+                await ctx.send("Sorry, I couldn't understand the reply I got for that, "
+                               "the website might have changed.")
+                return
+            if isinstance(error.original, sqlite3.OperationalError) and "locked" in str(error.original):
+                # The database's writing thread held the lock for longer than the main connection's busy timeout
+                log.warning(f"Database locked in command: {ctx.message.clean_content}")
+                await ctx.send("Sorry, I'm busy saving other changes right now, please try again.")
+                return
             log.error(f"Exception in command: {ctx.message.clean_content}", exc_info=error.original)
             await ctx.send(f'{ctx.tick(False)} Command error:\n```py\n{error.original.__class__.__name__}:'
                            f'{error.original}```')
@@ -569,6 +613,7 @@ nabbot = None
 
 if __name__ == "__main__":
     init_database()
+    enable_incremental_vacuum()
 
     print("Loading config...")
     config.parse()
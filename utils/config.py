@@ -22,9 +22,14 @@ KEYS = [
     "online_list_expiration",
     "announce_threshold",
     "online_scan_interval",
-    "death_scan_interval",
+    "online_scan_concurrency",
+    "death_scan_budget",
+    "death_check_concurrency",
+    "scan_workers",
     "highscores_delay",
     "highscores_page_delay",
+    "highscores_page_concurrency",
+    "highscores_history_days",
     "network_retry_delay",
     "extra_cogs",
     "command_prefix",
@@ -86,9 +91,14 @@ class Config:
         self.online_list_expiration = 300
         self.announce_threshold = 30
         self.online_scan_interval = 90
-        self.death_scan_interval = 15
+        self.online_scan_concurrency = 4
+        self.death_scan_budget = 4
+        self.death_check_concurrency = 5
+        self.scan_workers = 0
         self.highscores_delay = 45
-        self.highscores_page_delay = 10
+        self.highscores_page_delay = 0
+        self.highscores_page_concurrency = 4
+        self.highscores_history_days = 90
         self.network_retry_delay = 1
         self.online_emoji = "🔹"
         self.true_emoji = "✅"
@@ -147,6 +157,13 @@ class Config:
                     else:
                         _config[key] = tuple(_config[key])
                 setattr(self, key, _config[key])
+        # death_scan_interval was replaced by death_scan_budget, checks per minute instead of seconds between checks
+        if "death_scan_interval" in _config and "death_scan_budget" not in _config:
+            interval = _config.pop("death_scan_interval")
+            if isinstance(interval, (int, float)) and interval > 0:
+                self.death_scan_budget = max(int(60 / interval), 1)
+            print(f"\33[33m\t'death_scan_interval' was replaced by 'death_scan_budget', "
+                  f"using: {repr(self.death_scan_budget)}\033[0m")
         for key in _config:
             if key not in KEYS:
                 print(f"\33[34m\tExtra entry found: '{key}', ignoring\033[0m")
@@ -1,25 +1,85 @@
+import asyncio
 import json
 import os
 import shutil
 import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
-from typing import Dict
+from functools import partial
+from typing import Dict, Iterable, List, Optional, Callable, Any, Tuple
+
+from utils.general import is_worker_process
 
 # Databases filenames
 USERDB = "data/users.db"
 TIBIADB = "data/tibia_database.db"
 LOOTDB = "data/loot.db"
 
-userDatabase = sqlite3.connect(USERDB)
-tibiaDatabase = sqlite3.connect(TIBIADB)
+# Settings applied to each database when opened, according to how they are used
+# users.db is written constantly by the tracking tasks, so it uses write-ahead logging, allowing reads while writing,
+# and only syncs to disk on checkpoints
+# The main connection is used from the event loop, so it only waits briefly if the writer thread holds the lock
+# loot.db is written by loot commands, tibia_database.db is only read
+DATABASE_PRAGMAS = {
+    USERDB: {"journal_mode": "WAL", "synchronous": "NORMAL", "cache_size": -16000, "mmap_size": 64 * 1024 * 1024,
+             "temp_store": "MEMORY", "busy_timeout": 250},
+    LOOTDB: {"journal_mode": "WAL", "synchronous": "NORMAL", "cache_size": -4000, "temp_store": "MEMORY"},
+    TIBIADB: {"cache_size": -8000, "mmap_size": 128 * 1024 * 1024, "temp_store": "MEMORY", "query_only": 1},
+}
+# Databases that are written to, only these are maintained, the shipped read-only database is left untouched
+WRITABLE_DATABASES = [USERDB, LOOTDB]
+
+# Seconds between database maintenance runs
+MAINTENANCE_INTERVAL = 6 * 60 * 60
+# Maximum number of free pages released on every maintenance run
+MAINTENANCE_VACUUM_PAGES = 1000
+# Seconds the maintenance waits for a database to be available, before skipping it
+MAINTENANCE_TIMEOUT = 1
+
+
+def configure_database(conn: sqlite3.Connection, path: str) -> sqlite3.Connection:
+    """Applies the settings corresponding to a database.
+
+    :param conn: The connection to the database.
+    :param path: The database's filename.
+    :return: The same connection.
+    """
+    for name, value in DATABASE_PRAGMAS.get(path, {}).items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    return conn
+
 
-if os.path.isfile(LOOTDB):
-    lootDatabase = sqlite3.connect(LOOTDB)
+if is_worker_process():
+    # Worker processes don't use the databases, so the files are not opened
+    userDatabase = tibiaDatabase = lootDatabase = None
 else:
-    shutil.copyfile("data/loot_template.db", LOOTDB)
-    lootDatabase = sqlite3.connect(LOOTDB)
+    userDatabase = configure_database(sqlite3.connect(USERDB), USERDB)
+    tibiaDatabase = configure_database(sqlite3.connect(TIBIADB), TIBIADB)
 
-DB_LASTVERSION = 22
+    if not os.path.isfile(LOOTDB):
+        shutil.copyfile("data/loot_template.db", LOOTDB)
+    lootDatabase = configure_database(sqlite3.connect(LOOTDB), LOOTDB)
+
+DB_LASTVERSION = 25
+
+# Maximum number of parameters used in a single query, SQLite's limit is 999 by default
+SQL_VARIABLE_LIMIT = 900
+
+# Number of threads reading from a database at the same time, when accessed asynchronously
+ASYNC_DATABASE_READERS = 2
+# Milliseconds an asynchronous connection waits for a locked database, it doesn't block the event loop
+ASYNC_DATABASE_BUSY_TIMEOUT = 5000
+# Times an asynchronous write is tried again when the database is locked by another connection
+ASYNC_DATABASE_WRITE_RETRIES = 3
+# Seconds between attempts to write to a locked database, multiplied by the attempt number
+ASYNC_DATABASE_RETRY_DELAY = 0.5
+
+# Properties of every server, as {server_id: {name: value}}, loaded on first use and updated by set_server_property
+_server_properties: Optional[Dict[int, Dict[str, str]]] = None
+# Deserialized values of the properties stored as JSON, by server id and name
+_deserialized_properties: Dict[Tuple[int, str], Any] = {}
 
 
 def init_database():
@@ -260,6 +320,64 @@ def init_database():
                 guild TEXT NOT NULL
             );""")
             db_version += 1
+        if db_version == 22:
+            # Highscores are updated in place, keeping a history of rank and value changes
+            c.execute("DELETE FROM highscores WHERE rowid NOT IN "
+                      "(SELECT MIN(rowid) FROM highscores GROUP BY world, category, name)")
+            c.execute("CREATE UNIQUE INDEX highscores_entry_index ON highscores(world, category, name)")
+            c.execute("DELETE FROM highscores_times WHERE rowid NOT IN "
+                      "(SELECT MAX(rowid) FROM highscores_times GROUP BY world, category)")
+            c.execute("CREATE UNIQUE INDEX highscores_times_index ON highscores_times(world, category)")
+            c.execute("""CREATE TABLE highscores_history (
+                world TEXT,
+                category TEXT,
+                name TEXT,
+                rank INTEGER,
+                value INTEGER,
+                date INTEGER
+            );""")
+            c.execute("CREATE INDEX highscores_history_index ON highscores_history(name, category, date)")
+            db_version += 1
+        if db_version == 23:
+            # Character names are compared case insensitively, so lookups can use an index instead of LIKE
+            c.execute("""CREATE TABLE chars_temp(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                name TEXT COLLATE NOCASE,
+                level INTEGER DEFAULT -1,
+                vocation TEXT,
+                world TEXT,
+                guild TEXT
+            );""")
+            c.execute("INSERT INTO chars_temp SELECT id, user_id, name, level, vocation, world, guild FROM chars")
+            c.execute("DROP TABLE chars")
+            c.execute("ALTER table chars_temp RENAME TO chars")
+            c.execute("CREATE INDEX chars_name_index ON chars(name)")
+            c.execute("CREATE INDEX chars_user_index ON chars(user_id)")
+            c.execute("""CREATE TABLE highscores_temp (
+                rank INTEGER,
+                category TEXT,
+                world TEXT,
+                name TEXT COLLATE NOCASE,
+                vocation TEXT,
+                value INTEGER
+            );""")
+            c.execute("INSERT INTO highscores_temp SELECT rank, category, world, name, vocation, value FROM highscores "
+                      "WHERE rowid IN (SELECT MIN(rowid) FROM highscores GROUP BY world, category, lower(name))")
+            c.execute("DROP TABLE highscores")
+            c.execute("ALTER table highscores_temp RENAME TO highscores")
+            c.execute("CREATE UNIQUE INDEX highscores_entry_index ON highscores(world, category, name)")
+            c.execute("CREATE INDEX highscores_name_index ON highscores(name)")
+            c.execute("CREATE INDEX char_deaths_index ON char_deaths(char_id, date)")
+            c.execute("CREATE INDEX char_levelups_index ON char_levelups(char_id, date)")
+            c.execute("DELETE FROM server_properties WHERE rowid NOT IN "
+                      "(SELECT MAX(rowid) FROM server_properties GROUP BY server_id, name)")
+            c.execute("CREATE UNIQUE INDEX server_properties_index ON server_properties(server_id, name)")
+            db_version += 1
+        if db_version == 24:
+            # Old highscores history entries are deleted periodically
+            c.execute("CREATE INDEX highscores_history_date_index ON highscores_history(date)")
+            db_version += 1
         print("Updated database to version {0}".format(db_version))
         c.execute("UPDATE db_info SET value = ? WHERE key LIKE 'version'", (db_version,))
     finally:
@@ -267,6 +385,54 @@ def init_database():
         userDatabase.commit()
 
 
+def enable_incremental_vacuum():
+    """Allows the writable databases to release their free pages a few at a time, instead of with a full vacuum.
+
+    The mode of an existing database only changes after a full vacuum, so this may take a while the first time."""
+    for conn, path in [(userDatabase, USERDB), (lootDatabase, LOOTDB)]:
+        with closing(conn.cursor()) as c:
+            c.execute("PRAGMA auto_vacuum")
+            if c.fetchone()["auto_vacuum"] == 2:
+                continue
+            print(f"Enabling incremental vacuum on {path}...")
+            c.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            c.execute("VACUUM")
+
+
+def maintain_databases() -> Dict[str, str]:
+    """Runs routine maintenance on the databases that are written to.
+
+    Updates the statistics used by the query planner, releases some of the free pages and moves the write-ahead log's
+    content into the database.
+
+    This blocks, so it must be run on a separate thread, it uses its own connections for that reason.
+
+    :return: The errors found, by database filename.
+    """
+    errors = {}
+    for path in WRITABLE_DATABASES:
+        try:
+            with closing(sqlite3.connect(path, timeout=MAINTENANCE_TIMEOUT)) as conn:
+                conn.execute("PRAGMA analysis_limit = 1000")
+                conn.execute("PRAGMA optimize(0x10002)")
+                conn.execute(f"PRAGMA incremental_vacuum({MAINTENANCE_VACUUM_PAGES})").fetchall()
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error as e:
+            errors[path] = str(e)
+    return errors
+
+
+def prune_highscores_history(conn: sqlite3.Connection, days: int) -> int:
+    """Deletes the highscores history entries older than the given number of days.
+
+    :param conn: The connection to the users database, the changes are not committed.
+    :param days: The number of days entries are kept for.
+    :return: The number of entries deleted.
+    """
+    limit = int(time.time()) - days * 24 * 60 * 60
+    return conn.execute("DELETE FROM highscores_history WHERE date < ?", (limit,)).rowcount
+
+
 def dict_factory(cursor, row):
     """Makes values returned by cursor fetch functions return a dictionary instead of a tuple.
 
@@ -277,31 +443,229 @@ def dict_factory(cursor, row):
     return d
 
 
-userDatabase.row_factory = dict_factory
-tibiaDatabase.row_factory = dict_factory
-lootDatabase.row_factory = dict_factory
+class Row(sqlite3.Row):
+    """A row that can be read like a dictionary, without building one.
+
+    Rows are created by sqlite3 itself, so they are cheaper than dictionaries when reading many rows.
+    They can't be modified, dict(row) returns a dictionary with the same values."""
+    __slots__ = ()
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except IndexError:
+            return default
+
+    def items(self):
+        return zip(self.keys(), self)
+
+
+def row_cursor(conn: sqlite3.Connection = None) -> sqlite3.Cursor:
+    """Creates a cursor that returns rows as :class:`Row` instead of dictionaries.
+
+    Meant for queries on a single table returning many rows, that are only read.
+
+    :param conn: The connection to use, the users database by default.
+    :return: The cursor.
+    """
+    cursor = (conn or userDatabase).cursor()
+    cursor.row_factory = Row
+    return cursor
+
+
+if not is_worker_process():
+    userDatabase.row_factory = dict_factory
+    tibiaDatabase.row_factory = dict_factory
+    lootDatabase.row_factory = dict_factory
+
+
+class AsyncDatabase:
+    """Runs queries on a database in separate threads, so slow queries don't block the event loop.
+
+    Writes are made by a single thread, in the order they were requested. Reads are made by a few other threads, that
+    thanks to write-ahead logging, don't wait for writes to finish.
+    Every thread has its own connection, rows are returned as dictionaries."""
+    def __init__(self, path: str, readers: int = ASYNC_DATABASE_READERS):
+        self.path = path
+        self._writer = ThreadPoolExecutor(1)
+        self._readers = ThreadPoolExecutor(readers)
+        self._local = threading.local()
+
+    def __repr__(self) -> str:
+        return f"AsyncDatabase(path={self.path!r})"
+
+    async def fetchone(self, sql: str, params: Iterable = ()) -> Optional[Dict[str, Any]]:
+        """Gets the first row returned by a query.
+
+        :param sql: The query.
+        :param params: The query's parameters.
+        :return: The row, or None if there are no results.
+        """
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params: Iterable = (), *, where: Callable[[Dict], bool] = None,
+                       limit: int = None) -> List[Dict[str, Any]]:
+        """Gets the rows returned by a query.
+
+        Rows can be filtered while being read, for conditions that can't be expressed in SQL.
+
+        :param sql: The query.
+        :param params: The query's parameters.
+        :param where: Only rows this returns True for are returned. It's called from another thread.
+        :param limit: The maximum number of rows returned.
+        :return: The rows.
+        """
+        def fetch(conn):
+            rows = []
+            for row in conn.execute(sql, params):
+                if where is not None and not where(row):
+                    continue
+                rows.append(row)
+                if limit is not None and len(rows) >= limit:
+                    break
+            return rows
+        return await self.read(fetch)
+
+    async def execute(self, sql: str, params: Iterable = ()) -> int:
+        """Executes a statement and commits it.
+
+        :param sql: The statement.
+        :param params: The statement's parameters.
+        :return: The number of rows modified.
+        """
+        return await self.transaction(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def executemany(self, sql: str, seq_of_params: Iterable[Iterable]) -> int:
+        """Executes a statement once for every set of parameters and commits them.
+
+        :param sql: The statement.
+        :param seq_of_params: The parameters for every execution.
+        :return: The number of rows modified.
+        """
+        return await self.transaction(lambda conn: conn.executemany(sql, seq_of_params).rowcount)
+
+    async def read(self, func: Callable[..., Any], *args) -> Any:
+        """Runs a function on one of the reading threads.
+
+        :param func: The function, called with a connection as the first argument. It can't modify the database.
+        :param args: Extra arguments for the function.
+        :return: The function's result.
+        """
+        return await asyncio.get_event_loop().run_in_executor(self._readers, partial(self._run, True, func, *args))
+
+    async def transaction(self, func: Callable[..., Any], *args) -> Any:
+        """Runs a function on the writing thread, inside a transaction.
+
+        The transaction is committed if the function returns and rolled back if it raises an exception.
+        If the database is locked by another connection, the transaction is rolled back and the function is called
+        again, so it must not have effects outside the database.
+
+        :param func: The function, called with a connection as the first argument.
+        :param args: Extra arguments for the function.
+        :return: The function's result.
+        """
+        return await asyncio.get_event_loop().run_in_executor(self._writer, partial(self._run, False, func, *args))
+
+    def close(self):
+        """Stops the threads, after the pending queries finish."""
+        self._writer.shutdown(wait=False)
+        self._readers.shutdown(wait=False)
+
+    def _run(self, read_only: bool, func: Callable[..., Any], *args) -> Any:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = configure_database(sqlite3.connect(self.path), self.path)
+            conn.execute(f"PRAGMA busy_timeout = {ASYNC_DATABASE_BUSY_TIMEOUT}")
+            conn.row_factory = dict_factory
+            if read_only:
+                conn.execute("PRAGMA query_only = 1")
+            self._local.conn = conn
+        if read_only:
+            return func(conn, *args)
+        for attempt in range(1, ASYNC_DATABASE_WRITE_RETRIES + 2):
+            try:
+                with conn:
+                    return func(conn, *args)
+            except sqlite3.OperationalError as e:
+                # The main connection is used for writes too, its transactions may outlast the busy timeout
+                if attempt > ASYNC_DATABASE_WRITE_RETRIES or "locked" not in str(e):
+                    raise
+                time.sleep(ASYNC_DATABASE_RETRY_DELAY * attempt)
+
+
+asyncUserDatabase = AsyncDatabase(USERDB)
+
+
+def get_chars_by_name(names: Iterable[str], conn: sqlite3.Connection = None) -> Dict[str, Row]:
+    """Gets the registered characters matching any of the given names, using as few queries as possible.
+
+    :param names: The names of the characters to look for, case insensitive.
+    :param conn: The connection to use, by default, the main connection to the users database.
+    :return: A dictionary with the characters' id, name, level, user_id and world, by lowercase name.
+    """
+    names = list({name.lower() for name in names})
+    chars = {}
+    with closing(row_cursor(conn)) as c:
+        for i in range(0, len(names), SQL_VARIABLE_LIMIT):
+            chunk = names[i:i + SQL_VARIABLE_LIMIT]
+            c.execute("SELECT id, name, level, user_id, world FROM chars WHERE name IN ({0})"
+                      .format(", ".join("?" * len(chunk))), chunk)
+            for row in c:
+                chars[row["name"].lower()] = row
+    return chars
+
+
+def _get_server_properties() -> Dict[int, Dict[str, str]]:
+    """Returns the properties of every server, reading them from the database the first time."""
+    global _server_properties
+    if _server_properties is None:
+        properties = {}
+        with closing(row_cursor()) as c:
+            c.execute("SELECT server_id, name, value FROM server_properties")
+            for row in c:
+                properties.setdefault(row["server_id"], {})[row["name"]] = row["value"]
+        _server_properties = properties
+    return _server_properties
+
+
+def clear_server_properties_cache():
+    """Discards the cached server properties, so they are read from the database again.
+
+    Must be called after modifying the server_properties table directly, instead of using set_server_property."""
+    global _server_properties
+    _server_properties = None
+    _deserialized_properties.clear()
 
 
 def get_server_property(guild_id: int, key: str, *, default=None, is_int=None, deserialize=False):
     """Returns a guild's property
 
+    Properties are kept in memory, deserialized values are shared between calls, so they must not be modified.
+
     :param key: The key of the property to search for
     :param guild_id: The discord server's id
     :param default: A default value to return in case the key is not found
     :param is_int: If true, the return value will be casted to int
     :return: the property's value or the default value passed
     """
-    with closing(userDatabase.cursor()) as c:
-        c.execute("SELECT value FROM server_properties WHERE name = ? and server_id = ?", (key, guild_id))
-        result: Dict[str] = c.fetchone()
-        if is_int:
-            try:
-                return int(result["value"]) if result is not None else default
-            except ValueError:
-                return default
-        if result is None:
+    value = _get_server_properties().get(guild_id, {}).get(key)
+    if is_int:
+        try:
+            return int(value) if value is not None else default
+        except ValueError:
             return default
-        return result["value"] if not deserialize else json.loads(result["value"])
+    if value is None:
+        return default
+    if not deserialize:
+        return value
+    try:
+        return _deserialized_properties[(guild_id, key)]
+    except KeyError:
+        deserialized = _deserialized_properties[(guild_id, key)] = json.loads(value)
+        return deserialized
 
 
 def set_server_property(guild_id: int, key: str, value, *, serialize=False) -> None:
@@ -311,10 +675,18 @@ def set_server_property(guild_id: int, key: str, value, *, serialize=False) -> N
     :param guild_id: The discord server's id
     :param value: The new value for the property, if None, it will be deleted
     """
+    properties = _get_server_properties()
     with userDatabase as con:
         con.execute("DELETE FROM server_properties WHERE server_id = ? AND name = ?", (guild_id, key))
-        if value is None:
-            return
-        if serialize:
-            value = json.dumps(value)
-        con.execute("INSERT INTO server_properties(name, server_id, value) VALUES(?,?,?)", (key, guild_id, value))
+        if value is not None:
+            if serialize:
+                value = json.dumps(value)
+            con.execute("INSERT INTO server_properties(name, server_id, value) VALUES(?,?,?)", (key, guild_id, value))
+            # The value is read back, as it's stored as text
+            value = con.execute("SELECT value FROM server_properties WHERE server_id = ? AND name = ?",
+                                (guild_id, key)).fetchone()["value"]
+    _deserialized_properties.pop((guild_id, key), None)
+    if value is None:
+        properties.get(guild_id, {}).pop(key, None)
+    else:
+        properties.setdefault(guild_id, {})[key] = value
@@ -1,41 +1,168 @@
+import collections
 import datetime as dt
 import io
 import logging
+import multiprocessing
 import os
 import re
 import time
 from calendar import timegm
 from logging.handlers import TimedRotatingFileHandler
-from typing import Optional, List, Union, Tuple
+from typing import Optional, List, Union, Tuple, Iterable, Iterator, Dict, Set, Any
 
 import discord
 from PIL import Image
 from discord.ext import commands
 
-# This is the global online list
-# don't look at it too closely or you'll go blind!
-# characters are added as servername_charactername
-# The list is updated periodically on think() using get_server_online()
-global_online_list = []
+
+class OnlineList:
+    """The registered characters that are online in the tracked worlds.
+
+    Characters are indexed by their lowercase name and by world, so checking, adding and removing characters takes
+    constant time, and comparing a world's online list against it only takes a single pass.
+    Iterating goes through the characters in the order they were added."""
+    def __init__(self):
+        # Characters by lowercase name
+        self._chars: Dict[str, Any] = collections.OrderedDict()
+        # Lowercase names of the characters in each world
+        self._worlds: Dict[str, Set[str]] = collections.defaultdict(set)
+
+    def __repr__(self) -> str:
+        return f"OnlineList(characters={len(self)}, worlds={len(self._worlds)})"
+
+    def __len__(self) -> int:
+        return len(self._chars)
+
+    def __iter__(self) -> Iterator:
+        # A copy is iterated, so the list can change while it is being iterated
+        return iter(list(self._chars.values()))
+
+    def __contains__(self, char) -> bool:
+        return self._key(char) in self._chars
+
+    @staticmethod
+    def _key(char) -> str:
+        """Gets the key used for a character or a character's name."""
+        return (char if isinstance(char, str) else char.name).lower()
+
+    @property
+    def worlds(self) -> List[str]:
+        """The worlds that have online characters."""
+        return list(self._worlds)
+
+    def get(self, name: str):
+        """Gets an online character by its name.
+
+        :param name: The name of the character, case insensitive.
+        :return: The character if it's online, None otherwise.
+        """
+        return self._chars.get(self._key(name))
+
+    def get_world(self, world: str) -> list:
+        """Gets the online characters in a world.
+
+        :param world: The name of the world.
+        :return: The characters in that world, sorted by name.
+        """
+        return [self._chars[key] for key in sorted(self._worlds.get(world, ()))]
+
+    def add(self, char):
+        """Adds a character, replacing the previous entry if it was already in the list.
+
+        New characters are added at the end, existing characters keep their position.
+
+        :param char: The character to add.
+        """
+        key = self._key(char)
+        old = self._chars.get(key)
+        if old is not None and old.world != char.world:
+            self._discard_world_key(old.world, key)
+        self._chars[key] = char
+        self._worlds[char.world].add(key)
+
+    def extend(self, chars: Iterable):
+        """Adds multiple characters.
+
+        :param chars: The characters to add.
+        """
+        for char in chars:
+            self.add(char)
+
+    def remove(self, char):
+        """Removes a character if it's in the list.
+
+        :param char: The character or the name of the character to remove.
+        :return: The removed character, or None if it wasn't in the list.
+        """
+        key = self._key(char)
+        removed = self._chars.pop(key, None)
+        if removed is not None:
+            self._discard_world_key(removed.world, key)
+        return removed
+
+    def remove_missing(self, world: str, online: Iterable) -> list:
+        """Removes the characters of a world that are not in its current online list.
+
+        :param world: The name of the world.
+        :param online: The characters currently online in that world.
+        :return: The characters that were removed.
+        """
+        missing = self._worlds.get(world, set()) - {self._key(char) for char in online}
+        return [self.remove(key) for key in missing]
+
+    def remove_world(self, world: str) -> list:
+        """Removes all the characters of a world.
+
+        :param world: The name of the world.
+        :return: The characters that were removed.
+        """
+        return [self.remove(key) for key in list(self._worlds.get(world, ()))]
+
+    def clear(self):
+        """Removes all characters."""
+        self._chars.clear()
+        self._worlds.clear()
+
+    def _discard_world_key(self, world: str, key: str):
+        keys = self._worlds.get(world)
+        if keys is None:
+            return
+        keys.discard(key)
+        if not keys:
+            del self._worlds[world]
+
+
+# Registered characters currently online, updated by the world scans
+global_online_list = OnlineList()
+
+
+def is_worker_process() -> bool:
+    """Checks if the code is running in a process started by the bot, such as the scanner workers.
+
+    Worker processes import the bot's modules too, so modules use this to skip setting up what only the bot uses."""
+    return multiprocessing.current_process().name != "MainProcess"
+
 
 # Start logging
-# Create logs folder
-os.makedirs('logs/', exist_ok=True)
-# discord.py log
-discord_log = logging.getLogger('discord')
-discord_log.setLevel(logging.INFO)
-handler = logging.FileHandler(filename='logs/discord.log', encoding='utf-8', mode='a')
-handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-discord_log.addHandler(handler)
 # NabBot log
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
-# Save log to file (info level)
-fileHandler = TimedRotatingFileHandler('logs/nabbot', when='midnight')
-fileHandler.suffix = "%Y_%m_%d.log"
-fileHandler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s: %(message)s'))
-fileHandler.setLevel(logging.INFO)
-log.addHandler(fileHandler)
+# Worker processes only log to the console, the log files are written by the bot alone
+if not is_worker_process():
+    # Create logs folder
+    os.makedirs('logs/', exist_ok=True)
+    # discord.py log
+    discord_log = logging.getLogger('discord')
+    discord_log.setLevel(logging.INFO)
+    handler = logging.FileHandler(filename='logs/discord.log', encoding='utf-8', mode='a')
+    handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
+    discord_log.addHandler(handler)
+    # Save log to file (info level)
+    fileHandler = TimedRotatingFileHandler('logs/nabbot', when='midnight')
+    fileHandler.suffix = "%Y_%m_%d.log"
+    fileHandler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s: %(message)s'))
+    fileHandler.setLevel(logging.INFO)
+    log.addHandler(fileHandler)
 # Print output to console too (debug level)
 consoleHandler = logging.StreamHandler()
 consoleHandler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s: %(message)s'))
@@ -0,0 +1,32 @@
+import re
+from typing import List, Tuple
+
+# Tibia.com pages are encoded in ISO-8859-1
+ENCODING = "ISO-8859-1"
+
+# The entries table is found between these markers, the rest of the page is never decoded
+_TABLE_START = b'<td style="width: 20%;" >Vocation</td>'
+_TABLE_END = b'<div style="float: left;"><b>&raquo; Pages:'
+
+# A single pattern matches every category, loyalty entries have an extra column with the title
+_ENTRY_PATTERN = re.compile(r'<td>([^<]+)</TD><td><a href="https://secure\.tibia\.com/community/\?subtopic=characters'
+                            r'&name=[^"]+" >([^<]+)</a></td><td>([^<]+)</TD>(?:<td>[^<]+</TD>)?'
+                            r'<td style="text-align: right;" >([^<]+)</TD></TR>')
+
+
+def parse_highscores(content: bytes) -> List[Tuple[int, str, str, int]]:
+    """Parses a highscores page from Tibia.com.
+
+    Only the entries table is decoded and searched.
+
+    :param content: The raw content of the page.
+    :return: The entries of the page, as (rank, name, vocation, value) tuples.
+    :raises ValueError: The page is incomplete or doesn't contain highscores.
+    """
+    start = content.find(_TABLE_START)
+    end = content.find(_TABLE_END, start)
+    if start < 0 or end < 0:
+        raise ValueError("highscores table not found")
+    table = content[start:end].decode(ENCODING)
+    return [(int(rank), name, vocation, int(value.replace(",", "")))
+            for rank, name, vocation, value in _ENTRY_PATTERN.findall(table)]
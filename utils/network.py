@@ -0,0 +1,603 @@
+import asyncio
+import collections
+import datetime as dt
+import email.utils
+import heapq
+import itertools
+import random
+import time
+import urllib.parse
+from functools import partial
+from typing import Optional, Callable, Any, Dict, List, Tuple, Awaitable, Hashable
+
+import aiohttp
+
+from utils.config import config
+from utils.general import log
+
+# Connection pool settings
+# Total simultaneous connections, and simultaneous connections to a single host.
+CONNECTION_LIMIT = 100
+CONNECTION_LIMIT_PER_HOST = 20
+# Seconds resolved addresses are kept before resolving them again
+DNS_CACHE_TTL = 300
+# Seconds idle connections are kept open to be reused
+KEEPALIVE_TIMEOUT = 30
+# Seconds a whole request may take before timing out
+REQUEST_TIMEOUT = 30
+
+# Retry settings
+RETRY_ATTEMPTS = 5
+# Maximum seconds to wait between attempts, a longer Retry-After makes the request fail right away
+RETRY_MAX_DELAY = 30
+# HTTP statuses that mean the upstream service is temporarily unavailable
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# HTTP status that means the upstream service is up, but too many requests were made
+THROTTLED_STATUS = 429
+
+# Request priorities, lower values are served first when waiting for the rate limiter
+# Commands, someone is waiting for the reply
+PRIORITY_HIGH = 0
+# Background tasks, like scanning online lists or highscores
+PRIORITY_LOW = 1
+PRIORITY_NAMES = {PRIORITY_HIGH: "high", PRIORITY_LOW: "low"}
+
+# Upstream hosts
+TIBIADATA_HOST = "api.tibiadata.com"
+TIBIA_HOST = "secure.tibia.com"
+GUILDSTATS_HOST = "guildstats.eu"
+
+# Requests per second and burst size allowed for each upstream host, by default
+RATE_LIMITS: Dict[str, Tuple[float, int]] = {
+    TIBIADATA_HOST: (5, 10),
+    TIBIA_HOST: (2, 5),
+    GUILDSTATS_HOST: (0.5, 2),
+}
+DEFAULT_RATE_LIMIT = (2, 5)
+
+# Circuit breaker settings
+# Consecutive failed attempts before a host is considered down
+CIRCUIT_FAILURE_THRESHOLD = 5
+# Seconds to wait before probing a host that is down, doubled every time the probe fails
+CIRCUIT_RESET_TIMEOUT = 30
+CIRCUIT_MAX_RESET_TIMEOUT = 300
+# Circuit states
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half-open"
+
+# Shared HTTP session, created on first use and closed when the bot closes
+_session: Optional[aiohttp.ClientSession] = None
+# Rate limiters, by host
+_rate_limiters: Dict[str, 'RateLimiter'] = {}
+# Circuit breakers, by host
+_circuit_breakers: Dict[str, 'CircuitBreaker'] = {}
+
+
+class NetworkError(Exception):
+    """Raised when a resource couldn't be fetched because the upstream service is down or unreachable."""
+    pass
+
+
+class ParseError(Exception):
+    """Raised when the upstream service replied, but its content couldn't be understood.
+
+    Unlike NetworkError, trying again is not expected to help."""
+    pass
+
+
+class CircuitOpenError(NetworkError):
+    """Raised without making a request, because the upstream service failed too many times recently."""
+    pass
+
+
+class CircuitBreaker:
+    """Keeps track of a host's failures, to stop making requests while it's down.
+
+    The circuit starts closed, letting every request through.
+    After too many consecutive failures it opens, and requests fail right away.
+    Once the reset timeout passes, it becomes half-open and a single probe request is let through.
+    If the probe succeeds the circuit closes again, otherwise it opens for twice as long."""
+    def __init__(self, host: str, failure_threshold: int, reset_timeout: float, max_reset_timeout: float):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.base_reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = 0.0
+        # Time when the current probe was let through, 0 if there's none in progress
+        self._probe_started = 0.0
+        self._state = CIRCUIT_CLOSED
+        # Number of times the circuit opened, and requests rejected while open
+        self.trips = 0
+        self.rejected = 0
+
+    def __repr__(self) -> str:
+        return f"CircuitBreaker(host={self.host!r}, state={self.state!r}, failures={self.failures})"
+
+    @property
+    def state(self) -> str:
+        """The current state of the circuit."""
+        if self._state == CIRCUIT_OPEN and time.monotonic() >= self.opened_at + self.reset_timeout:
+            return CIRCUIT_HALF_OPEN
+        return self._state
+
+    @property
+    def available(self) -> bool:
+        """Whether a request would be let through right now."""
+        state = self.state
+        return state == CIRCUIT_CLOSED or (state == CIRCUIT_HALF_OPEN and not self._probing)
+
+    @property
+    def retry_in(self) -> float:
+        """Seconds until requests may be let through again, 0 if they are being let through already."""
+        if self.available:
+            return 0.0
+        if self.state == CIRCUIT_HALF_OPEN:
+            # Waiting for the probe's result
+            return 1.0
+        return self.opened_at + self.reset_timeout - time.monotonic()
+
+    @property
+    def _probing(self) -> bool:
+        # A probe that never reported back is not waited for forever
+        return self._probe_started > 0 and time.monotonic() - self._probe_started < REQUEST_TIMEOUT
+
+    def allow_request(self) -> bool:
+        """Checks if a request can be made, and marks it as the probe if the circuit is half-open.
+
+        :return: True if the request can be made, False if it must fail right away.
+        """
+        if not self.available:
+            self.rejected += 1
+            return False
+        if self.state == CIRCUIT_HALF_OPEN:
+            self._state = CIRCUIT_HALF_OPEN
+            self._probe_started = time.monotonic()
+        return True
+
+    def record_success(self):
+        """Registers a request that got a reply, closing the circuit."""
+        if self._state != CIRCUIT_CLOSED:
+            log.info(f"CircuitBreaker: {self.host} is reachable again, closing circuit")
+        self._state = CIRCUIT_CLOSED
+        self.failures = 0
+        self._probe_started = 0.0
+        self.reset_timeout = self.base_reset_timeout
+
+    def record_failure(self):
+        """Registers a failed request, opening the circuit if there were too many."""
+        self.failures += 1
+        if self._state == CIRCUIT_HALF_OPEN:
+            # The probe failed, wait longer this time
+            self.reset_timeout = min(self.max_reset_timeout, self.reset_timeout * 2)
+            self._open()
+        elif self._state == CIRCUIT_CLOSED and self.failures >= self.failure_threshold:
+            self._open()
+
+    def _open(self):
+        self._state = CIRCUIT_OPEN
+        self.opened_at = time.monotonic()
+        self._probe_started = 0.0
+        self.trips += 1
+        log.warning(f"CircuitBreaker: {self.host} failed {self.failures} times, "
+                    f"pausing requests for {self.reset_timeout} seconds")
+
+
+class RateLimiter:
+    """A token bucket limiting the requests made to a single host.
+
+    Tokens are refilled at a constant rate, up to the bucket's capacity, and every request takes one.
+    Requests waiting for a token are served by priority first and arrival order second, so commands are not delayed by
+    background tasks queued before them."""
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.last_refill = time.monotonic()
+        # Waiting requests, as (priority, arrival order, future) tuples
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+        self._timer: asyncio.Handle = None
+        # Requests served and total seconds waited, by priority
+        self.requests = collections.Counter()
+        self.wait_time = collections.Counter()
+
+    def __repr__(self) -> str:
+        return f"RateLimiter(rate={self.rate}, capacity={self.capacity}, waiting={self.waiting})"
+
+    @property
+    def waiting(self) -> int:
+        """The number of requests waiting for a token."""
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    async def acquire(self, priority=PRIORITY_HIGH):
+        """Waits until a request can be made.
+
+        :param priority: The priority of the request.
+        """
+        start = time.monotonic()
+        self._refill()
+        if not self._waiters and self.tokens >= 1:
+            self.tokens -= 1
+        else:
+            future = asyncio.get_event_loop().create_future()
+            heapq.heappush(self._waiters, (priority, next(self._counter), future))
+            self._schedule()
+            try:
+                await future
+            except asyncio.CancelledError:
+                # The token was given right before being cancelled, return it
+                if future.done() and not future.cancelled():
+                    self.tokens += 1
+                    self._schedule()
+                raise
+        self.requests[priority] += 1
+        self.wait_time[priority] += time.monotonic() - start
+
+    def pause(self, seconds: float):
+        """Stops giving tokens for a while, e.g. when the host asked to wait before making more requests.
+
+        :param seconds: The seconds to wait before the next request.
+        """
+        self._refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def _schedule(self):
+        """Schedules the next release of waiting requests, for when a token will be available."""
+        if self._timer is not None or not self._waiters:
+            return
+        self._refill()
+        delay = max(0.0, (1 - self.tokens) / self.rate)
+        self._timer = asyncio.get_event_loop().call_later(delay, self._release)
+
+    def _release(self):
+        """Gives the available tokens to the waiting requests with the highest priority."""
+        self._timer = None
+        self._refill()
+        while self._waiters and self.tokens >= 1:
+            _, _, future = heapq.heappop(self._waiters)
+            # Request was cancelled while waiting
+            if future.done():
+                continue
+            self.tokens -= 1
+            future.set_result(None)
+        self._schedule()
+
+
+class SingleFlight:
+    """Deduplicates concurrent calls for the same key.
+
+    While a call for a key is in progress, other callers asking for the same key wait for it and receive the same
+    result, instead of starting their own call."""
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: Hashable, fetcher: Callable[[], Awaitable]):
+        """Returns the result of the call in progress for a key, starting a new one if there's none.
+
+        Cancelling a caller doesn't cancel the call, as other callers may still be waiting for it.
+
+        :param key: The key identifying the call.
+        :param fetcher: A function returning the awaitable to run if no call is in progress.
+        :return: The result of the call.
+        """
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fetcher())
+            self._calls[key] = future
+            future.add_done_callback(partial(self._done, key))
+        return await asyncio.shield(future)
+
+    def _done(self, key: Hashable, future: asyncio.Future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        # Retrieve the exception, in case every caller was cancelled
+        if not future.cancelled():
+            future.exception()
+
+
+class ResponseCache:
+    """A size-bounded cache of parsed responses, with time based expiration.
+
+    Entries are fresh for `ttl` seconds, and then stale for `stale_ttl` more seconds. Stale entries are still returned,
+    but they are refreshed in the background so the next caller gets fresh data.
+    When the cache is full, the least recently used entries are discarded.
+    Concurrent requests for the same key share a single fetch.
+    `None` values are never cached, so resources that don't exist are always looked up again."""
+    def __init__(self, ttl: float, stale_ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.maxsize = maxsize
+        # Entries as (time stored, value) tuples, from least to most recently used
+        self._entries: Dict[Hashable, Tuple[float, Any]] = collections.OrderedDict()
+        # Fetches in progress
+        self._calls = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self) -> str:
+        return f"ResponseCache(ttl={self.ttl}, stale_ttl={self.stale_ttl}, maxsize={self.maxsize}, " \
+               f"size={len(self)})"
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def set(self, key: Hashable, value):
+        """Stores a value in the cache, replacing the previous one.
+
+        :param key: The key to store the value with.
+        :param value: The value to store, if None, the key is removed instead.
+        """
+        self._entries.pop(key, None)
+        if value is None:
+            return
+        self._entries[key] = (time.monotonic(), value)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        """Removes a key from the cache."""
+        self._entries.pop(key, None)
+
+    async def get(self, key: Hashable, fetcher: Callable[[], Awaitable], *, fresh=False):
+        """Returns the value of a key, calling the fetcher if it's not cached or it expired.
+
+        :param key: The key to look for.
+        :param fetcher: A function returning an awaitable that fetches the value.
+        :param fresh: Whether to skip the cache and always call the fetcher. The result is still stored.
+        :return: The cached or fetched value.
+        """
+        if not fresh:
+            entry = self._entries.get(key)
+            if entry is not None:
+                age = time.monotonic() - entry[0]
+                if age < self.ttl + self.stale_ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    if age >= self.ttl:
+                        self._revalidate(key, fetcher)
+                    return entry[1]
+        self.misses += 1
+        return await self._calls.do(key, partial(self._fetch, key, fetcher))
+
+    async def _fetch(self, key: Hashable, fetcher: Callable[[], Awaitable]):
+        value = await fetcher()
+        self.set(key, value)
+        return value
+
+    def _revalidate(self, key: Hashable, fetcher: Callable[[], Awaitable]):
+        """Refreshes a key in the background, if it's not being fetched already."""
+        if key in self._calls:
+            return
+
+        async def refresh():
+            try:
+                await self._calls.do(key, partial(self._fetch, key, fetcher))
+            except (NetworkError, ParseError):
+                # The stale value is kept until it expires
+                pass
+            except Exception:
+                log.exception(f"ResponseCache: Couldn't refresh {key!r}")
+
+        asyncio.ensure_future(refresh())
+
+
+def get_rate_limiter(host: str) -> RateLimiter:
+    """Returns the rate limiter for a host, creating it if needed.
+
+    :param host: The host's name.
+    :return: The rate limiter used for that host.
+    """
+    limiter = _rate_limiters.get(host)
+    if limiter is None:
+        limiter = RateLimiter(*RATE_LIMITS.get(host, DEFAULT_RATE_LIMIT))
+        _rate_limiters[host] = limiter
+    return limiter
+
+
+def set_rate_limit(host: str, rate: float, capacity: int):
+    """Changes the rate limit used for a host.
+
+    The default limits in RATE_LIMITS are left untouched, so they can be restored with reset_rate_limit.
+
+    :param host: The host's name.
+    :param rate: The requests per second allowed.
+    :param capacity: The burst size allowed.
+    """
+    limiter = get_rate_limiter(host)
+    limiter._refill()
+    limiter.rate = rate
+    limiter.capacity = capacity
+    limiter.tokens = min(limiter.tokens, capacity)
+
+
+def reset_rate_limit(host: str):
+    """Restores the default rate limit of a host.
+
+    :param host: The host's name.
+    """
+    set_rate_limit(host, *RATE_LIMITS.get(host, DEFAULT_RATE_LIMIT))
+
+
+def get_rate_limiters() -> Dict[str, RateLimiter]:
+    """Returns the rate limiters of all the hosts that have been requested so far."""
+    return dict(_rate_limiters)
+
+
+def get_circuit_breaker(host: str) -> CircuitBreaker:
+    """Returns the circuit breaker for a host, creating it if needed.
+
+    :param host: The host's name.
+    :return: The circuit breaker used for that host.
+    """
+    breaker = _circuit_breakers.get(host)
+    if breaker is None:
+        breaker = CircuitBreaker(host, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT, CIRCUIT_MAX_RESET_TIMEOUT)
+        _circuit_breakers[host] = breaker
+    return breaker
+
+
+def get_circuit_breakers() -> Dict[str, CircuitBreaker]:
+    """Returns the circuit breakers of all the hosts that have been requested so far."""
+    return dict(_circuit_breakers)
+
+
+def is_host_available(host: str) -> bool:
+    """Checks if requests to a host are currently being let through.
+
+    :param host: The host's name.
+    :return: False if the host's circuit is open.
+    """
+    return get_circuit_breaker(host).available
+
+
+async def wait_until_available(host: str):
+    """Waits until requests to a host are let through again.
+
+    Background tasks call this before every iteration, so they pause as a whole while the host is down instead of
+    failing on every request.
+
+    :param host: The host's name.
+    """
+    breaker = get_circuit_breaker(host)
+    while not breaker.available:
+        await asyncio.sleep(breaker.retry_in)
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Returns the shared HTTP session, creating it if needed.
+
+    The session keeps connections alive between requests, so fetches to the same host reuse connections instead of
+    doing a new TCP and TLS handshake every time.
+    It must only be called from inside the bot's event loop."""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=CONNECTION_LIMIT, limit_per_host=CONNECTION_LIMIT_PER_HOST,
+                                         use_dns_cache=True, ttl_dns_cache=DNS_CACHE_TTL,
+                                         keepalive_timeout=KEEPALIVE_TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT))
+    return _session
+
+
+async def close_session():
+    """Closes the shared HTTP session and all its pooled connections."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+def get_retry_delay(attempt: int, retry_after: float = 0) -> float:
+    """Returns the seconds to wait before retrying a failed request.
+
+    The delay grows exponentially with every attempt, starting at `network_retry_delay`.
+    Random jitter is applied so concurrent requests that failed together don't retry at the same time.
+
+    :param attempt: The number of the attempt that just failed, starting at 1.
+    :param retry_after: The seconds the upstream service asked to wait, if any.
+    :return: The seconds to wait.
+    """
+    delay = min(RETRY_MAX_DELAY, config.network_retry_delay * 2 ** (attempt - 1))
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    return max(delay, retry_after)
+
+
+def parse_retry_after(value: Optional[str]) -> float:
+    """Parses the value of a Retry-After header.
+
+    :param value: The header's value, either in seconds or as an HTTP date.
+    :return: The seconds to wait, 0 if the value is missing or invalid.
+    """
+    if not value:
+        return 0
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return 0
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=dt.timezone.utc)
+    return max(0.0, (date - dt.datetime.now(dt.timezone.utc)).total_seconds())
+
+
+async def fetch(url: str, *, tries=RETRY_ATTEMPTS, encoding: Optional[str] = "ISO-8859-1",
+                parser: Callable[[Any], Any]=None, priority=PRIORITY_HIGH):
+    """Fetches a url using the shared session, retrying with exponential backoff if it fails.
+
+    Every attempt waits for the host's rate limiter first.
+    If the host's circuit is open, it fails right away without making a request.
+    Throttled replies don't count as failures of the host, its Retry-After pauses the host's rate limiter instead.
+
+    If a parser is passed, the content is passed through it and its result is returned instead.
+    The parser must raise ValueError when the content is not valid, the request is not tried again in that case.
+
+    :param url: The url to fetch.
+    :param tries: The maximum number of attempts.
+    :param encoding: The encoding used to decode the response. If None, the raw bytes are returned or parsed instead.
+    :param parser: A function that receives the content and returns the parsed result.
+    :param priority: The priority of the request for the rate limiter.
+    :return: The content of the response, or the parser's result.
+    :raises NetworkError: The upstream service could not be reached.
+    :raises ParseError: The content of the response was not valid.
+    :raises CircuitOpenError: The upstream service is considered down.
+    """
+    host = urllib.parse.urlsplit(url).hostname
+    limiter = get_rate_limiter(host)
+    breaker = get_circuit_breaker(host)
+    for attempt in range(1, tries + 1):
+        retry_after = 0
+        if not breaker.available:
+            breaker.rejected += 1
+            raise CircuitOpenError(url)
+        await limiter.acquire(priority)
+        # The circuit may have opened while waiting
+        if not breaker.allow_request():
+            raise CircuitOpenError(url)
+        throttled = False
+        try:
+            async with get_session().get(url) as resp:
+                if resp.status in RETRY_STATUSES:
+                    retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+                    throttled = resp.status == THROTTLED_STATUS
+                    raise NetworkError(f"HTTP status {resp.status}")
+                content = await resp.read() if encoding is None else await resp.text(encoding=encoding)
+            breaker.record_success()
+        except (aiohttp.ClientError, asyncio.TimeoutError, NetworkError):
+            if throttled:
+                # The host is up, it just wants fewer requests
+                breaker.record_success()
+                if retry_after > 0:
+                    # Longer waits make this request fail, but other requests to the host are only delayed up to the
+                    # maximum retry delay
+                    limiter.pause(min(retry_after, RETRY_MAX_DELAY))
+            else:
+                breaker.record_failure()
+            if attempt == tries or retry_after > RETRY_MAX_DELAY:
+                break
+            await asyncio.sleep(get_retry_delay(attempt, retry_after))
+            continue
+        if parser is None:
+            return content
+        try:
+            return parser(content)
+        except ValueError:
+            log.warning(f"fetch: Couldn't parse the content of {url}")
+            raise ParseError(url) from None
+    log.warning(f"fetch: Couldn't fetch {url} after {attempt} attempts")
+    raise NetworkError(url)
@@ -0,0 +1,216 @@
+import asyncio
+import itertools
+import multiprocessing
+import threading
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+from utils.config import config
+from utils.general import log
+from utils.network import NetworkError, ParseError, PRIORITY_LOW, RATE_LIMITS, DEFAULT_RATE_LIMIT, TIBIADATA_HOST, \
+    set_rate_limit, reset_rate_limit, get_circuit_breaker, close_session
+from utils.tibia import World, get_world
+
+# Seconds to wait for a worker's reply before giving up on a scan
+SCANNER_TIMEOUT = 120
+# Seconds to wait for a worker to exit when stopping, before terminating it
+SCANNER_STOP_TIMEOUT = 5
+# Requests per second and burst size allowed for each worker, enough to fetch about 20 worlds every 90 seconds
+# Workers only fetch online lists, the rest of the host's rate limit is left to the bot
+SCANNER_RATE_LIMIT = (0.25, 1)
+
+
+def get_shard(world: str, shards: int) -> int:
+    """Gets the worker a world is assigned to.
+
+    :param world: The name of the world.
+    :param shards: The number of workers.
+    :return: The index of the worker.
+    """
+    return zlib.crc32(world.lower().encode()) % shards
+
+
+def share_rate_limit(host: str, workers: int) -> Tuple[float, int]:
+    """Reserves a small share of a host's rate limit for each worker, reducing the bot's limit by the same amount.
+
+    A worker never gets more than an equal split, in case the host's limit is lower than the workers' share.
+
+    :param host: The host's name.
+    :param workers: The number of worker processes.
+    :return: The requests per second and burst size allowed for each worker.
+    """
+    rate, capacity = RATE_LIMITS.get(host, DEFAULT_RATE_LIMIT)
+    worker_rate = min(SCANNER_RATE_LIMIT[0], rate / (workers + 1))
+    worker_capacity = max(1, min(SCANNER_RATE_LIMIT[1], capacity // (workers + 1)))
+    set_rate_limit(host, rate - worker_rate * workers, max(1, capacity - worker_capacity * workers))
+    return worker_rate, worker_capacity
+
+
+class ScannerPool:
+    """Worker processes that fetch and parse worlds' online lists, away from the bot's event loop.
+
+    Worlds are split between the workers, so the same world is always fetched by the same worker.
+    Results are sent back through a queue, read by a thread that hands them over to the event loop.
+    Failed scans are registered in the bot's circuit breaker, so tasks waiting for the host notice it's down."""
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._context = multiprocessing.get_context("spawn")
+        self._requests: List[multiprocessing.Queue] = []
+        self._results: multiprocessing.Queue = None
+        self._processes: List[multiprocessing.Process] = []
+        self._reader: threading.Thread = None
+        self._loop: asyncio.AbstractEventLoop = None
+        # Requests per second and burst size allowed for each worker
+        self._rate_limit: Tuple[float, int] = SCANNER_RATE_LIMIT
+        # Scans waiting for a reply, by request id
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._counter = itertools.count()
+        # Scans requested and failed
+        self.requests = 0
+        self.errors = 0
+
+    def __repr__(self) -> str:
+        return f"ScannerPool(workers={self.workers}, alive={self.alive}, pending={len(self._pending)})"
+
+    @property
+    def alive(self) -> int:
+        """The number of worker processes running."""
+        return sum(1 for p in self._processes if p.is_alive())
+
+    def start(self):
+        """Starts the worker processes.
+
+        Each worker gets a small share of the upstream rate limit, the bot keeps the rest."""
+        self._loop = asyncio.get_event_loop()
+        self._rate_limit = share_rate_limit(TIBIADATA_HOST, self.workers)
+        self._results = self._context.Queue()
+        self._requests = [self._context.Queue() for _ in range(self.workers)]
+        self._processes = [self._start_worker(i) for i in range(self.workers)]
+        self._reader = threading.Thread(target=self._read_results, name="ScannerPool", daemon=True)
+        self._reader.start()
+        log.info(f"ScannerPool: Started {self.workers} scanner workers")
+
+    def stop(self):
+        """Stops the worker processes and cancels the pending scans.
+
+        The workers are waited for on a separate thread, so the event loop is not blocked.
+        The host's rate limit goes back to its default."""
+        for queue in self._requests:
+            queue.put(None)
+        if self._results is not None:
+            self._results.put(None)
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+        processes, self._processes = self._processes, []
+        threading.Thread(target=_join_workers, args=(processes,), name="ScannerPool-stop", daemon=True).start()
+        reset_rate_limit(TIBIADATA_HOST)
+
+    async def get_world(self, name: str) -> Optional[World]:
+        """Fetches a world in its worker process.
+
+        If the world can't be fetched due to a network error, an NetworkError exception is raised
+        If the world doesn't exist, None is returned.
+
+        :param name: The name of the world.
+        :return: The world, as fetched by the worker.
+        """
+        shard = get_shard(name, self.workers)
+        if not self._processes[shard].is_alive():
+            log.warning(f"ScannerPool: Worker {shard} is not running, restarting it")
+            self._processes[shard] = self._start_worker(shard)
+        request_id = next(self._counter)
+        future = self._loop.create_future()
+        self._pending[request_id] = future
+        self.requests += 1
+        self._requests[shard].put((request_id, name))
+        try:
+            return await asyncio.wait_for(future, SCANNER_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.errors += 1
+            get_circuit_breaker(TIBIADATA_HOST).record_failure()
+            raise NetworkError(f"Scanner worker {shard} took too long to fetch {name}")
+        except (NetworkError, ParseError):
+            self.errors += 1
+            raise
+        finally:
+            self._pending.pop(request_id, None)
+
+    def _start_worker(self, shard: int) -> multiprocessing.Process:
+        process = self._context.Process(target=_worker_main, name=f"scanner-{shard}", daemon=True,
+                                        args=(self._requests[shard], self._results, self._rate_limit,
+                                              config.network_retry_delay))
+        process.start()
+        return process
+
+    def _read_results(self):
+        while True:
+            result = self._results.get()
+            if result is None:
+                break
+            self._loop.call_soon_threadsafe(self._resolve, *result)
+
+    def _resolve(self, request_id: int, world: Optional[World], error: Optional[Exception]):
+        # The host replied unless the request failed, even if its content was not valid
+        breaker = get_circuit_breaker(TIBIADATA_HOST)
+        if error is None or isinstance(error, ParseError):
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+        future = self._pending.get(request_id)
+        if future is None or future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(world)
+
+
+def _join_workers(processes: List[multiprocessing.Process]):
+    """Waits for stopped worker processes to exit, terminating them if they take too long."""
+    for process in processes:
+        process.join(SCANNER_STOP_TIMEOUT)
+        if process.is_alive():
+            process.terminate()
+
+
+def _worker_main(requests: multiprocessing.Queue, results: multiprocessing.Queue, rate_limit: Tuple[float, int],
+                 retry_delay: float):
+    """Entry point of the worker processes."""
+    config.network_retry_delay = retry_delay
+    set_rate_limit(TIBIADATA_HOST, *rate_limit)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(_worker_loop(requests, results))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(close_session())
+        loop.close()
+
+
+async def _worker_loop(requests: multiprocessing.Queue, results: multiprocessing.Queue):
+    loop = asyncio.get_event_loop()
+    tasks = set()
+    while True:
+        request = await loop.run_in_executor(None, requests.get)
+        if request is None:
+            break
+        task = asyncio.ensure_future(_scan_world(results, *request))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    for task in tasks:
+        task.cancel()
+
+
+async def _scan_world(results: multiprocessing.Queue, request_id: int, name: str):
+    try:
+        world = await get_world(name, priority=PRIORITY_LOW, fresh=True)
+        results.put((request_id, world, None))
+    except (NetworkError, ParseError) as e:
+        # The type is kept, so the bot can tell if the host replied
+        results.put((request_id, None, type(e)(str(e))))
+    except Exception as e:
+        log.exception(f"scanner: Error scanning {name}")
+        results.put((request_id, None, NetworkError(f"Error scanning {name}: {e}")))
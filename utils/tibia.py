@@ -1,4 +1,5 @@
 import asyncio
+import copy
 import datetime as dt
 import io
 import json
@@ -7,16 +8,18 @@ import time
 import urllib.parse
 from calendar import timegm
 from contextlib import closing
+from functools import partial
 from html.parser import HTMLParser
 from typing import List, Union, Dict, Optional
 
-import aiohttp
 from PIL import Image, ImageDraw
 from bs4 import BeautifulSoup
 from discord.ext import commands
 
 from utils.config import config
-from utils.database import userDatabase, tibiaDatabase
+from utils.database import userDatabase, tibiaDatabase, asyncUserDatabase
+from utils.highscores import parse_highscores
+from utils.network import fetch, NetworkError, ParseError, PRIORITY_HIGH, ResponseCache, SingleFlight
 from .general import log
 
 # Constants
@@ -58,10 +61,16 @@ tibia_worlds: List[str] = []
 
 HIGHSCORE_CATEGORIES = ["sword", "axe", "club", "distance", "shielding", "fist", "fishing", "magic",
                         "magic_ek", "magic_rp", "loyalty", "achievements"]
+# Highscores pages of each category, entries shown per page, and pages fetched at the same time
+HIGHSCORES_PAGES = 12
+HIGHSCORES_PAGE_SIZE = 25
 
-
-class NetworkError(Exception):
-    pass
+# Recently fetched characters, worlds and guilds, by normalized name
+character_cache = ResponseCache(ttl=60, stale_ttl=120, maxsize=5000)
+world_cache = ResponseCache(ttl=30, stale_ttl=60, maxsize=200)
+guild_cache = ResponseCache(ttl=120, stale_ttl=300, maxsize=1000)
+# Highscores pages being fetched, by url
+highscores_requests = SingleFlight()
 
 
 # TODO: Generate character from tibia.com response
@@ -383,202 +392,232 @@ class Guild:
         return tibia_guild
 
 
-async def get_character(name, tries=5, *, bot: commands.Bot=None) -> Optional[Character]:
+def normalize_name(name: str) -> str:
+    """Returns the form of a character, world or guild name used to compare and index them."""
+    return name.strip().lower()
+
+
+async def get_character(name, tries=5, *, bot: commands.Bot=None, priority=PRIORITY_HIGH, fresh=False) \
+        -> Optional[Character]:
     """Fetches a character from TibiaData, parses and returns a Character object
 
     The character object contains all the information available on Tibia.com
     Information from the user's database is also added, like owner and highscores.
     If the character can't be fetch due to a network error, an NetworkError exception is raised
+    If the response can't be parsed, a ParseError exception is raised
     If the character doesn 't exist, None is returned.
+    Background tasks should use a low priority, so commands are served first.
+    Characters are cached for a short time, fresh skips the cache for callers that need current data.
+    Concurrent requests for the same character share a single fetch.
+    The returned object is a copy, but nested lists such as deaths and former_names are shared and must not be mutated.
     """
-    if tries == 0:
-        log.error("get_character: Couldn't fetch {0}, network error.".format(name))
-        raise NetworkError()
-    try:
-        url = f"https://api.tibiadata.com/v2/characters/{urllib.parse.quote(name.strip(), safe='')}.json"
-    except UnicodeEncodeError:
-        return None
-    # Fetch website
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                content = await resp.text(encoding='ISO-8859-1')
-    except Exception:
-        await asyncio.sleep(config.network_retry_delay)
-        return await get_character(name, tries - 1)
-
-    content_json = json.loads(content)
-    character = Character.parse_from_tibiadata(content_json)
+    character = await character_cache.get(normalize_name(name), partial(_fetch_character, name, tries, priority),
+                                          fresh=fresh)
     if character is None:
         return None
-
-    if character.house is not None:
-        with closing(tibiaDatabase.cursor()) as c:
-            c.execute("SELECT id FROM houses WHERE name LIKE ?", (character.house["name"].strip(),))
-            result = c.fetchone()
-            if result:
-                character.house["houseid"] = result["id"]
+    # The cached character is shared, so information from the database is added to a copy
+    character = copy.copy(character)
 
     # Database operations
+    # Changes are written by the database's writing thread, so a locked database doesn't block the event loop
     c = userDatabase.cursor()
     # Skills from highscores
-    c.execute("SELECT category, rank, value FROM highscores WHERE name LIKE ?", (character.name,))
-    results = c.fetchall()
-    if len(results) > 0:
-        character.highscores = results
+    c.execute("SELECT category, rank, value FROM highscores WHERE name = ?", (character.name,))
+    character.highscores = c.fetchall()
 
     # Check if this user was recently renamed, and update old reference to this
     for old_name in character.former_names:
-        c.execute("SELECT id FROM chars WHERE name LIKE ? LIMIT 1", (old_name, ))
+        c.execute("SELECT id FROM chars WHERE name = ? LIMIT 1", (old_name, ))
         result = c.fetchone()
         if result:
-            with userDatabase as conn:
-                conn.execute("UPDATE chars SET name = ? WHERE id = ?", (character.name, result["id"]))
-                log.info("{0} was renamed to {1} during get_character()".format(old_name, character.name))
+            await asyncUserDatabase.execute("UPDATE chars SET name = ? WHERE id = ?", (character.name, result["id"]))
+            log.info("{0} was renamed to {1} during get_character()".format(old_name, character.name))
 
     # Discord owner
-    c.execute("SELECT user_id, vocation, name, id, world, guild FROM chars WHERE name LIKE ? OR name LIKE ?",
+    c.execute("SELECT user_id, vocation, name, id, world, guild FROM chars WHERE name = ? OR name = ?",
               (name, character.name))
     result = c.fetchone()
     if result is None:
         # Untracked character
+        character.owner = 0
         return character
 
     character.owner = result["user_id"]
     if result["vocation"] != character.vocation:
-        with userDatabase as conn:
-            conn.execute("UPDATE chars SET vocation = ? WHERE id = ?", (character.vocation, result["id"],))
-            log.info("{0}'s vocation was set to {1} from {2} during get_character()".format(character.name,
-                                                                                            character.vocation,
-                                                                                            result["vocation"]))
+        await asyncUserDatabase.execute("UPDATE chars SET vocation = ? WHERE id = ?",
+                                        (character.vocation, result["id"],))
+        log.info("{0}'s vocation was set to {1} from {2} during get_character()".format(character.name,
+                                                                                        character.vocation,
+                                                                                        result["vocation"]))
     # This condition PROBABLY can't be met again
     if result["name"] != character.name:
-        with userDatabase as conn:
-            conn.execute("UPDATE chars SET name = ? WHERE id = ?", (character.name, result["id"],))
-            log.info("{0} was renamed to {1} during get_character()".format(result["name"], character.name))
+        await asyncUserDatabase.execute("UPDATE chars SET name = ? WHERE id = ?", (character.name, result["id"],))
+        log.info("{0} was renamed to {1} during get_character()".format(result["name"], character.name))
 
     if result["world"] != character.world:
-        with userDatabase as conn:
-            conn.execute("UPDATE chars SET world = ? WHERE id = ?", (character.world, result["id"],))
-            log.info("{0}'s world was set to {1} from {2} during get_character()".format(character.name,
-                                                                                         character.world,
-                                                                                         result["world"]))
+        await asyncUserDatabase.execute("UPDATE chars SET world = ? WHERE id = ?", (character.world, result["id"],))
+        log.info("{0}'s world was set to {1} from {2} during get_character()".format(character.name,
+                                                                                     character.world,
+                                                                                     result["world"]))
     if character.guild is not None and result["guild"] != character.guild["name"]:
-        with userDatabase as conn:
-            conn.execute("UPDATE chars SET guild = ? WHERE id = ?", (character.guild["name"], result["id"],))
-            log.info("{0}'s guild was set to {1} from {2} during get_character()".format(character.name,
-                                                                                         character.guild["name"],
-                                                                                         result["guild"]))
-            if bot is not None:
-                bot.dispatch("character_change", character.owner)
+        await asyncUserDatabase.execute("UPDATE chars SET guild = ? WHERE id = ?",
+                                        (character.guild["name"], result["id"],))
+        log.info("{0}'s guild was set to {1} from {2} during get_character()".format(character.name,
+                                                                                     character.guild["name"],
+                                                                                     result["guild"]))
+        if bot is not None:
+            bot.dispatch("character_change", character.owner)
     if character.guild is None and result["guild"] is not None:
-        with userDatabase as conn:
-            conn.execute("UPDATE chars SET guild = ? WHERE id = ?", (None, result["id"],))
-            log.info("{0}'s guild was set to {1} from {2} during get_character()".format(character.name,
-                                                                                         None,
-                                                                                         result["guild"]))
-            if bot is not None:
-                bot.dispatch("character_change", character.owner)
-        
+        await asyncUserDatabase.execute("UPDATE chars SET guild = ? WHERE id = ?", (None, result["id"],))
+        log.info("{0}'s guild was set to {1} from {2} during get_character()".format(character.name,
+                                                                                     None,
+                                                                                     result["guild"]))
+        if bot is not None:
+            bot.dispatch("character_change", character.owner)
+
     return character
 
 
-async def get_highscores(world, category, pagenum, profession=0, tries=5):
+async def _fetch_character(name, tries, priority) -> Optional[Character]:
+    """Fetches and parses a character from TibiaData, without any information from the user's database."""
+    try:
+        url = f"https://api.tibiadata.com/v2/characters/{urllib.parse.quote(name.strip(), safe='')}.json"
+    except UnicodeEncodeError:
+        return None
+    # Fetch website
+    try:
+        content_json = await fetch(url, tries=tries, parser=json.loads, priority=priority)
+    except NetworkError:
+        log.error("get_character: Couldn't fetch {0}, network error.".format(name))
+        raise
+    except ParseError:
+        log.error("get_character: Couldn't parse {0}, invalid content.".format(name))
+        raise
+    character = Character.parse_from_tibiadata(content_json)
+    if character is None:
+        return None
+
+    if character.house is not None:
+        with closing(tibiaDatabase.cursor()) as c:
+            c.execute("SELECT id FROM houses WHERE name LIKE ?", (character.house["name"].strip(),))
+            result = c.fetchone()
+            if result:
+                character.house["houseid"] = result["id"]
+    return character
+
+
+async def get_highscores(world, category, pagenum, profession=0, tries=5, *, priority=PRIORITY_HIGH):
     """Gets a specific page of the highscores
-    Each list element is a dictionary with the following keys: rank, name, value.
-    May return ERROR_NETWORK"""
+    Each list element is a (rank, name, vocation, value) tuple.
+    Concurrent requests for the same page share a single fetch, and receive the same list.
+    May return ERROR_NETWORK
+    If the page can't be parsed, a ParseError exception is raised"""
     url = url_highscores.format(world, category, profession, pagenum)
 
-    if tries == 0:
+    # Fetch website
+    try:
+        return await highscores_requests.do(url, partial(fetch, url, tries=tries, encoding=None,
+                                                         parser=parse_highscores, priority=priority))
+    except NetworkError:
         log.error("get_highscores: Couldn't fetch {0}, {1}, page {2}, network error.".format(world, category, pagenum))
         return ERROR_NETWORK
+    except ParseError:
+        log.error("get_highscores: Couldn't parse {0}, {1}, page {2}, invalid content.".format(world, category,
+                                                                                               pagenum))
+        raise
 
-    # Fetch website
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                content = await resp.text(encoding='ISO-8859-1')
-    except Exception:
-        await asyncio.sleep(config.network_retry_delay)
-        return await get_highscores(world, category, pagenum, profession, tries - 1)
 
-    # Trimming content to reduce load
-    try:
-        start_index = content.index('<td style="width: 20%;" >Vocation</td>')
-        end_index = content.index('<div style="float: left;"><b>&raquo; Pages:')
-        content = content[start_index:end_index]
-    except ValueError:
-        await asyncio.sleep(config.network_retry_delay)
-        return await get_highscores(world, category, pagenum, profession, tries - 1)
-
-    if category == "loyalty":
-        regex_deaths = r'<td>([^<]+)</TD><td><a href="https://secure.tibia.com/community/\?subtopic=characters&name=[^"]+" >([^<]+)</a></td><td>([^<]+)</TD><td>[^<]+</TD><td style="text-align: right;" >([^<]+)</TD></TR>'
-        pattern = re.compile(regex_deaths, re.MULTILINE + re.S)
-        matches = re.findall(pattern, content)
-        score_list = []
-        for m in matches:
-            score_list.append({'rank': m[0], 'name': m[1], 'vocation': m[2], 'value': m[3].replace(',', '')})
-    else:
-        regex_deaths = r'<td>([^<]+)</TD><td><a href="https://secure.tibia.com/community/\?subtopic=characters&name=[^"]+" >([^<]+)</a></td><td>([^<]+)</TD><td style="text-align: right;" >([^<]+)</TD></TR>'
-        pattern = re.compile(regex_deaths, re.MULTILINE + re.S)
-        matches = re.findall(pattern, content)
-        score_list = []
-        for m in matches:
-            score_list.append({'rank': m[0], 'name': m[1], 'vocation': m[2], 'value': m[3].replace(',', '')})
-    return score_list
+async def get_highscores_category(world, category, *, priority=PRIORITY_HIGH) -> Optional[List[tuple]]:
+    """Gets all the pages of a highscores category.
 
+    Pages are fetched in groups of highscores_page_concurrency pages, waiting highscores_page_delay seconds between
+    groups. No more pages are fetched once the last one is found.
 
-async def get_world(name, tries=5) -> Optional[World]:
-    url = f"https://api.tibiadata.com/v2/world/{name}.json"
+    :param world: The world's name.
+    :param category: The category, one of HIGHSCORE_CATEGORIES.
+    :param priority: The priority of the requests.
+    :return: The entries as (rank, name, vocation, value) tuples, or None if a page couldn't be fetched.
+    :raises ParseError: A page couldn't be parsed.
+    """
+    # Special cases (ek/rp mls)
+    profession = 0
+    if category == "magic_ek":
+        category, profession = "magic", 1
+    elif category == "magic_rp":
+        category, profession = "magic", 2
+    entries = []
+    concurrency = max(config.highscores_page_concurrency, 1)
+    for first_page in range(1, HIGHSCORES_PAGES + 1, concurrency):
+        if first_page > 1 and config.highscores_page_delay > 0:
+            await asyncio.sleep(config.highscores_page_delay)
+        last_page = min(first_page + concurrency, HIGHSCORES_PAGES + 1)
+        pages = await asyncio.gather(*[get_highscores(world, category, page, profession, priority=priority)
+                                       for page in range(first_page, last_page)])
+        for scores in pages:
+            if scores == ERROR_NETWORK:
+                return None
+            entries.extend(scores)
+            if len(scores) < HIGHSCORES_PAGE_SIZE:
+                return entries
+    return entries
+
+
+async def get_world(name, tries=5, *, priority=PRIORITY_HIGH, fresh=False) -> Optional[World]:
+    """Fetches a world from TibiaData, parses and returns a World object
+
+    If the world can't be fetched due to a network error, an NetworkError exception is raised
+    If the response can't be parsed, a ParseError exception is raised
+    If the world doesn't exist, None is returned.
+    Worlds are cached for a short time, fresh skips the cache for callers that need current data."""
+    return await world_cache.get(normalize_name(name), partial(_fetch_world, name, tries, priority), fresh=fresh)
+
+
+async def _fetch_world(name, tries, priority) -> Optional[World]:
+    """Fetches and parses a world from TibiaData."""
     name = name.strip()
-    if tries == 0:
-        log.error("get_world: Couldn't fetch {0}, network error.".format(name))
-        raise NetworkError()
-        # Fetch website
+    url = f"https://api.tibiadata.com/v2/world/{name}.json"
 
+    # Fetch website
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                content = await resp.text(encoding='ISO-8859-1')
-    except Exception:
-        await asyncio.sleep(config.network_retry_delay)
-        return await get_world(name, tries - 1)
-
-    content_json = json.loads(content)
+        content_json = await fetch(url, tries=tries, parser=json.loads, priority=priority)
+    except NetworkError:
+        log.error("get_world: Couldn't fetch {0}, network error.".format(name))
+        raise
+    except ParseError:
+        log.error("get_world: Couldn't parse {0}, invalid content.".format(name))
+        raise
     world = World.parse_from_tibiadata(name, content_json)
     return world
 
 
-async def get_guild(name, title_case=True, tries=5) -> Optional[Guild]:
+async def get_guild(name, title_case=True, tries=5, *, priority=PRIORITY_HIGH, fresh=False) -> Optional[Guild]:
     """Fetches a guild from TibiaData, parses and returns a Guild object
 
     The Guild object contains all the information available on Tibia.com
     Guilds are case sensitive on tibia.com so guildstats.eu is checked for correct case.
     If the guild can't be fetched due to a network error, an NetworkError exception is raised
-    If the character doesn't exist, None is returned."""
-    guildstats_url = f"http://guildstats.eu/guild?guild={urllib.parse.quote(name)}"
+    If the response can't be parsed, a ParseError exception is raised
+    If the character doesn't exist, None is returned.
+    Guilds are cached for a short time, fresh skips the cache for callers that need current data."""
+    return await guild_cache.get(normalize_name(name), partial(_fetch_guild, name, title_case, tries, priority),
+                                 fresh=fresh)
 
-    if tries == 0:
-        log.error("get_guild_online: Couldn't fetch {0}, network error.".format(name))
-        raise NetworkError()
+
+async def _fetch_guild(name, title_case, tries, priority) -> Optional[Guild]:
+    """Fetches and parses a guild from TibiaData, finding its correct case in guildstats.eu if needed."""
+    guildstats_url = f"http://guildstats.eu/guild?guild={urllib.parse.quote(name)}"
 
     # Fix casing using guildstats.eu if needed
     # Sorry guildstats.eu :D
     if not title_case:
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(guildstats_url) as resp:
-                    content = await resp.text(encoding='ISO-8859-1')
-        except Exception:
-            await asyncio.sleep(config.network_retry_delay)
-            return await get_guild(name, title_case, tries - 1)
-
-        # Make sure we got a healthy fetch
-        try:
-            content.index('<div class="footer">')
-        except ValueError:
-            await asyncio.sleep(config.network_retry_delay)
-            return await get_guild(name, title_case, tries - 1)
+            content = await fetch(guildstats_url, tries=tries, parser=check_guildstats_content, priority=priority)
+        except NetworkError:
+            log.error("get_guild_online: Couldn't fetch {0}, network error.".format(name))
+            raise
+        except ParseError:
+            log.error("get_guild_online: Couldn't parse {0} from guildstats.eu, incomplete content.".format(name))
+            raise
 
         # Check if the guild doesn't exist
         if "<div>Sorry!" in content:
@@ -586,14 +625,12 @@ async def get_guild(name, title_case=True, tries=5) -> Optional[Guild]:
 
         # Failsafe in case guildstats.eu changes their websites format
         try:
-            content.index("General info")
-            content.index("Recruitment")
-        except Exception:
+            start_index = content.index("General info")
+            end_index = content.index("Recruitment")
+        except ValueError:
             log.error("get_guild_online: -IMPORTANT- guildstats.eu seems to have changed their websites format.")
-            raise NetworkError
+            raise ParseError(guildstats_url)
 
-        start_index = content.index("General info")
-        end_index = content.index("Recruitment")
         content = content[start_index:end_index]
         m = re.search(r'<a href="set=(.+?)"', content)
         if m:
@@ -605,18 +642,18 @@ async def get_guild(name, title_case=True, tries=5) -> Optional[Guild]:
 
     # Fetch website
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(tibiadata_url) as resp:
-                content = await resp.text(encoding='ISO-8859-1')
-    except Exception:
-        await asyncio.sleep(config.network_retry_delay)
-        return await get_guild(name, title_case, tries - 1)
+        content_json = await fetch(tibiadata_url, tries=tries, parser=json.loads, priority=priority)
+    except NetworkError:
+        log.error("get_guild_online: Couldn't fetch {0}, network error.".format(name))
+        raise
+    except ParseError:
+        log.error("get_guild_online: Couldn't parse {0}, invalid content.".format(name))
+        raise
 
-    content_json = json.loads(content)
     guild = Guild.parse_from_tibiadata(content_json)
     if guild is None:
         if title_case:
-            return await get_guild(name, False)
+            return await _fetch_guild(name, False, tries, priority)
         else:
             return None
     if guild.guildhall is not None:
@@ -628,24 +665,33 @@ async def get_guild(name, title_case=True, tries=5) -> Optional[Guild]:
     return guild
 
 
-async def get_recent_news(tries = 5):
-    if tries == 0:
-        log.error("get_recent_news: network error.")
-        raise NetworkError()
-    try:
-        url = f"https://api.tibiadata.com/v2/latestnews.json"
-    except UnicodeEncodeError:
-        return None
+def check_guildstats_content(content: str) -> str:
+    """Makes sure a page from guildstats.eu was fully received
+
+    :param content: The HTML content of the page.
+    :return: The same content.
+    :raises ValueError: The page is incomplete.
+    """
+    content.index('<div class="footer">')
+    return content
+
+
+async def get_recent_news(tries=5, *, priority=PRIORITY_HIGH):
+    """Returns a list of the recent news and articles or None if they couldn't be parsed
+
+    If there's a network error, NetworkError exception is raised
+    If the response can't be parsed, ParseError exception is raised"""
+    url = f"https://api.tibiadata.com/v2/latestnews.json"
     # Fetch website
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                content = await resp.text(encoding='ISO-8859-1')
-    except Exception:
-        await asyncio.sleep(config.network_retry_delay)
-        return await get_recent_news(tries - 1)
+        content_json = await fetch(url, tries=tries, parser=json.loads, priority=priority)
+    except NetworkError:
+        log.error("get_recent_news: network error.")
+        raise
+    except ParseError:
+        log.error("get_recent_news: invalid content.")
+        raise
 
-    content_json = json.loads(content)
     try:
         newslist = content_json["newslist"]
     except KeyError:
@@ -655,27 +701,23 @@ async def get_recent_news(tries = 5):
     return newslist["data"]
 
 
-async def get_news_article(article_id: int, tries=5) -> Optional[Dict[str, Union[str, dt.date]]]:
+async def get_news_article(article_id: int, tries=5, *, priority=PRIORITY_HIGH) \
+        -> Optional[Dict[str, Union[str, dt.date]]]:
     """Returns a news article with the specified id or None if it doesn't exist
 
-    If there's a network error, NetworkError exception is raised"""
-    if tries == 0:
-        log.error("get_recent_news: network error.")
-        raise NetworkError()
-    try:
-        url = f"https://api.tibiadata.com/v2/news/{article_id}.json"
-    except UnicodeEncodeError:
-        return None
+    If there's a network error, NetworkError exception is raised
+    If the response can't be parsed, ParseError exception is raised"""
+    url = f"https://api.tibiadata.com/v2/news/{article_id}.json"
     # Fetch website
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                content = await resp.text(encoding='ISO-8859-1')
-    except Exception:
-        await asyncio.sleep(config.network_retry_delay)
-        return await get_recent_news(tries - 1)
+        content_json = await fetch(url, tries=tries, parser=json.loads, priority=priority)
+    except NetworkError:
+        log.error("get_news_article: network error.")
+        raise
+    except ParseError:
+        log.error("get_news_article: invalid content.")
+        raise
 
-    content_json = json.loads(content)
     try:
         article = content_json["news"]
     except KeyError:
@@ -804,10 +846,8 @@ def get_share_range(level: int):
 async def get_world_bosses(world):
     url = f"http://www.tibiabosses.com/{world}/"
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                content = await resp.text(encoding='ISO-8859-1')
-    except Exception as e:
+        content = await fetch(url)
+    except NetworkError:
         return ERROR_NETWORK
 
     try:
@@ -860,89 +900,88 @@ async def get_house(name, world=None):
             return house
         house["world"] = world
         house["url"] = url_house.format(id=house["id"], world=world)
-        tries = 5
-        while True:
-            try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(house["url"]) as resp:
-                        content = await resp.text(encoding='ISO-8859-1')
-            except Exception:
-                tries -= 1
-                if tries == 0:
-                    log.error("get_house: Couldn't fetch {0} (id {1}) in {2}, network error.".format(house["name"],
-                                                                                                     house["id"],
-                                                                                                     world))
-                    house["fetch"] = False
-                    break
-                await asyncio.sleep(config.network_retry_delay)
-                continue
-
-            # Trimming content to reduce load
-            try:
-                start_index = content.index("\"BoxContent\"")
-                end_index = content.index("</TD></TR></TABLE>")
-                content = content[start_index:end_index]
-            except ValueError:
-                if tries == 0:
-                    log.error("get_house: Couldn't fetch {0} (id {1}) in {2}, network error.".format(house["name"],
-                                                                                                     house["id"],
-                                                                                                     world))
-                    house["fetch"] = False
-                    break
-                else:
-                    tries -= 1
-                    await asyncio.sleep(config.network_retry_delay)
-                    continue
-            m = re.search(r'<BR>(.+)<BR><BR>(.+)', content)
-            if not m:
-                return house
-            house["fetch"] = True
-            house_info = m.group(1)
-            house_status = m.group(2)
-            m = re.search(r'monthly rent is <B>(\d+)', house_info)
-            if m:
-                house["rent"] = int(m.group(1))
-            if "rented" in house_status:
-                house["status"] = "rented"
-                m = re.search(r'rented by <A?.+name=([^\"]+).+(He|She) has paid the rent until <B>([^<]+)</B>',
-                              house_status)
-                if m:
-                    house["owner"] = urllib.parse.unquote_plus(m.group(1))
-                    house["owner_pronoun"] = m.group(2)
-                    house["until"] = m.group(3).replace("&#160;", " ")
-                if "move out" in house_status:
-                    house["status"] = "moving"
-                    m = re.search(r'will move out on <B>([^<]+)</B> \(time of daily server save\)', house_status)
-                    if m:
-                        house["move_date"] = m.group(1).replace("&#160;", " ")
-                    else:
-                        break
-                    m = re.search(r' and (?:will|wants to) pass the house to <A.+name=([^\"]+).+ for <B>(\d+) gold',
-                                  house_status)
-                    if m:
-                        house["status"] = "transfering"
-                        house["transferee"] = urllib.parse.unquote_plus(m.group(1))
-                        house["transfer_price"] = int(m.group(2))
-                        house["accepted"] = ("will pass " in m.group(0))
-            elif "auctioned" in house_status:
-                house["status"] = "auctioned"
-                if ". No bid has" in content:
-                    house["status"] = "empty"
-                    break
-                m = re.search(r'The auction (?:has ended|will end) at <B>([^<]+)</B>\. '
-                              r'The highest bid so far is <B>(\d+).+ by .+name=([^\"]+)\"', house_status)
-                if m:
-                    house["auction_end"] = m.group(1).replace("&#160;", " ")
-                    house["top_bid"] = int(m.group(2))
-                    house["top_bidder"] = urllib.parse.unquote_plus(m.group(3))
-                    break
-                pass
-            break
+        try:
+            content = await fetch(house["url"], parser=trim_house_content)
+        except ParseError:
+            log.error("get_house: Couldn't parse {0} (id {1}) in {2}, incomplete content.".format(house["name"],
+                                                                                                 house["id"],
+                                                                                                 world))
+            house["fetch"] = False
+            return house
+        except NetworkError:
+            log.error("get_house: Couldn't fetch {0} (id {1}) in {2}, network error.".format(house["name"],
+                                                                                             house["id"],
+                                                                                             world))
+            house["fetch"] = False
+            return house
+        parse_house_status(house, content)
         return house
     finally:
         c.close()
 
 
+def trim_house_content(content: str) -> str:
+    """Trims a house's page from Tibia.com, leaving only the house's information
+
+    :param content: The HTML content of the page.
+    :return: The trimmed content.
+    :raises ValueError: The page is incomplete.
+    """
+    start_index = content.index("\"BoxContent\"")
+    end_index = content.index("</TD></TR></TABLE>")
+    return content[start_index:end_index]
+
+
+def parse_house_status(house: Dict, content: str):
+    """Parses a house's current status from its trimmed Tibia.com page, updating the house's dictionary
+
+    :param house: The house's dictionary.
+    :param content: The trimmed HTML content of the house's page.
+    """
+    m = re.search(r'<BR>(.+)<BR><BR>(.+)', content)
+    if not m:
+        return
+    house["fetch"] = True
+    house_info = m.group(1)
+    house_status = m.group(2)
+    m = re.search(r'monthly rent is <B>(\d+)', house_info)
+    if m:
+        house["rent"] = int(m.group(1))
+    if "rented" in house_status:
+        house["status"] = "rented"
+        m = re.search(r'rented by <A?.+name=([^\"]+).+(He|She) has paid the rent until <B>([^<]+)</B>',
+                      house_status)
+        if m:
+            house["owner"] = urllib.parse.unquote_plus(m.group(1))
+            house["owner_pronoun"] = m.group(2)
+            house["until"] = m.group(3).replace("&#160;", " ")
+        if "move out" in house_status:
+            house["status"] = "moving"
+            m = re.search(r'will move out on <B>([^<]+)</B> \(time of daily server save\)', house_status)
+            if m:
+                house["move_date"] = m.group(1).replace("&#160;", " ")
+            else:
+                return
+            m = re.search(r' and (?:will|wants to) pass the house to <A.+name=([^\"]+).+ for <B>(\d+) gold',
+                          house_status)
+            if m:
+                house["status"] = "transfering"
+                house["transferee"] = urllib.parse.unquote_plus(m.group(1))
+                house["transfer_price"] = int(m.group(2))
+                house["accepted"] = ("will pass " in m.group(0))
+    elif "auctioned" in house_status:
+        house["status"] = "auctioned"
+        if ". No bid has" in content:
+            house["status"] = "empty"
+            return
+        m = re.search(r'The auction (?:has ended|will end) at <B>([^<]+)</B>\. '
+                      r'The highest bid so far is <B>(\d+).+ by .+name=([^\"]+)\"', house_status)
+        if m:
+            house["auction_end"] = m.group(1).replace("&#160;", " ")
+            house["top_bid"] = int(m.group(2))
+            house["top_bidder"] = urllib.parse.unquote_plus(m.group(3))
+
+
 def get_tibia_time_zone() -> int:
     """Returns Germany's timezone, considering their daylight saving time dates"""
     # Find date in Germany
@@ -1031,24 +1070,16 @@ async def populate_worlds():
 
 async def get_world_list(tries=3) -> Optional[List[World]]:
     """Fetch the list of Tibia worlds from TibiaData"""
-    if tries == 0:
-        log.error("get_world_list(): Couldn't fetch TibiaData for the worlds list, network error.")
-        return
-
     url = "https://api.tibiadata.com/v2/worlds.json"
 
     # Fetch website
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                content = await resp.text(encoding='ISO-8859-1')
-    except Exception:
-        await asyncio.sleep(config.network_retry_delay)
-        return await get_world_list(tries - 1)
-
-    try:
-        json_content = json.loads(content)
-    except ValueError:
+        json_content = await fetch(url, tries=tries, parser=json.loads)
+    except NetworkError:
+        log.error("get_world_list(): Couldn't fetch TibiaData for the worlds list, network error.")
+        return
+    except ParseError:
+        log.error("get_world_list(): Couldn't parse TibiaData's worlds list, invalid content.")
         return
 
     worlds = []
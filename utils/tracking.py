@@ -0,0 +1,840 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import os
+import pickle
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple, Optional, Iterable, Callable, Awaitable, Any, Set, Hashable
+
+import discord
+
+from utils.database import get_server_property, row_cursor
+from utils.general import log, CONTENT_LIMIT
+from utils.network import NetworkError, ParseError, PRIORITY_LOW
+from utils.tibia import Character, Death, Guild, get_guild, normalize_name
+
+# Database where the online list and scanning state are saved, to be restored after restarting
+STATE_DB = "data/tracking_state.db"
+# File where older versions pickled the online list, imported into the state database once and then deleted
+LEGACY_ONLINE_LIST = "data/online_list.dat"
+
+# Seconds a character is moved forward in the death checks queue when its level changes between scans
+# A level drop while still online almost always means the character died and logged back in
+LEVEL_DROP_PRIORITY = 1800
+LEVEL_UP_PRIORITY = 120
+# Number of recent death detections used for the delay statistics
+DETECTION_HISTORY = 100
+
+# Maximum items waiting in each stage of the online scans pipeline, a full stage makes the previous one wait
+# Fetched worlds waiting to be compared against the online list
+COMPARE_QUEUE_SIZE = 10
+# Compared worlds waiting for the characters that logged in or out to be checked, for each worker
+CHECK_QUEUE_SIZE = 5
+# World scan results waiting to be saved
+PERSIST_QUEUE_SIZE = 10
+# Events waiting to be published and announced
+PUBLISH_QUEUE_SIZE = 200
+
+# Seconds before a watched guild's members are fetched again, membership changes way slower than online status
+GUILD_ROSTER_REFRESH = 15 * 60
+
+# Minimum seconds between edits of a server's watched list, updates in between are merged
+WATCHED_EDIT_INTERVAL = 30
+
+# Reasons for checking a character's deaths
+CHECK_SCHEDULED = "scheduled"
+CHECK_LOGIN = "login"
+CHECK_LOGOUT = "logout"
+
+
+class TrackingEvent:
+    """Base class for the events found by the tracking system.
+
+    Events are dispatched to every cog as `on_<event_name>`, receiving the event as its only argument."""
+    __slots__ = ("name", "world")
+    event_name: str = None
+
+    def __init__(self, name: str, world: str):
+        self.name = name
+        self.world = world
+
+    def __repr__(self) -> str:
+        attributes = ", ".join(f"{attr}={getattr(self, attr)!r}" for attr in self._attributes())
+        return f"{self.__class__.__name__}({attributes})"
+
+    def _attributes(self):
+        for cls in reversed(type(self).__mro__):
+            yield from getattr(cls, "__slots__", ())
+
+
+class CharacterLogin(TrackingEvent):
+    """A registered character was found online. Dispatched as `on_character_login`."""
+    __slots__ = ("level",)
+    event_name = "character_login"
+
+    def __init__(self, name: str, world: str, level: int):
+        super().__init__(name, world)
+        self.level = level
+
+
+class CharacterLogout(TrackingEvent):
+    """A registered character is no longer online. Dispatched as `on_character_logout`."""
+    __slots__ = ()
+    event_name = "character_logout"
+
+
+class CharacterLevelUp(TrackingEvent):
+    """A registered character gained a level. Dispatched as `on_character_level_up`.
+
+    If the character was fetched, it's available as char."""
+    __slots__ = ("level", "char")
+    event_name = "character_level_up"
+
+    def __init__(self, name: str, world: str, level: int, char: Character = None):
+        super().__init__(name, world)
+        self.level = level
+        self.char = char
+
+
+class CharacterDeath(TrackingEvent):
+    """A registered character died. Dispatched as `on_character_death`.
+
+    Deaths that are too old to announce are saved, but no event is published."""
+    __slots__ = ("death", "levels_lost", "char")
+    event_name = "character_death"
+
+    def __init__(self, char: Character, death: Death, levels_lost: int):
+        super().__init__(char.name, char.world)
+        self.death = death
+        self.levels_lost = levels_lost
+        self.char = char
+
+
+class WorldScanResult:
+    """The changes found in a world's online list, waiting to be saved.
+
+    :ivar world: The world's name.
+    :ivar online: The world's characters in the online list.
+    :ivar offline: The names of the characters that are no longer online.
+    :ivar logins: The names of the characters that just logged in.
+    :ivar registered: The registered characters involved in the scan, by lowercase name.
+    :ivar level_updates: New levels of registered characters, as (level, char_id) tuples.
+    :ivar levelups: Level ups found, as (char_id, level, name, char) tuples, char is None if it wasn't fetched."""
+    __slots__ = ("world", "online", "offline", "logins", "registered", "level_updates", "levelups")
+
+    def __init__(self, world: str, online: List[Character], offline: List[str]):
+        self.world = world
+        self.online = online
+        self.offline = offline
+        self.logins: List[str] = []
+        self.registered: Dict[str, Any] = {}
+        self.level_updates: List[Tuple[int, int]] = []
+        self.levelups: List[Tuple[int, int, str, Optional[Character]]] = []
+
+    def __repr__(self) -> str:
+        return f"WorldScanResult(world={self.world!r}, levelups={len(self.levelups)})"
+
+
+class PipelineStage:
+    """A stage of a processing pipeline, where items wait in a bounded queue to be processed by worker tasks.
+
+    Adding an item to a full stage waits until there's room, so a slow stage slows down the ones before it instead of
+    accumulating items indefinitely.
+
+    If a key function is given, every worker has its own queue, and items with the same key are always processed by the
+    same worker, in the order they were added."""
+    def __init__(self, name: str, handler: Callable[[Any], Awaitable], maxsize: int, workers: int = 1,
+                 key: Callable[[Any], Hashable] = None):
+        self.name = name
+        self.handler = handler
+        self.maxsize = maxsize
+        self.workers = workers
+        self.key = key
+        self.queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Future] = []
+        # Items processed, items that failed, and total seconds spent processing items
+        self.processed = 0
+        self.errors = 0
+        self.busy_time = 0.0
+
+    def __repr__(self) -> str:
+        return f"PipelineStage(name={self.name!r}, pending={self.pending}, processed={self.processed})"
+
+    @property
+    def pending(self) -> int:
+        """The number of items waiting to be processed."""
+        return sum(queue.qsize() for queue in self.queues)
+
+    def start(self):
+        """Starts the stage's workers."""
+        if self.key is None:
+            # A single queue shared by all workers
+            self.queues = [asyncio.Queue(self.maxsize)]
+            self._tasks = [asyncio.ensure_future(self._work(self.queues[0])) for _ in range(self.workers)]
+        else:
+            self.queues = [asyncio.Queue(self.maxsize) for _ in range(self.workers)]
+            self._tasks = [asyncio.ensure_future(self._work(queue)) for queue in self.queues]
+
+    def stop(self):
+        """Stops the stage's workers, discarding pending items."""
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def put(self, item):
+        """Adds an item to the stage, waiting if the stage is full.
+
+        :param item: The item to process.
+        """
+        if self.key is None:
+            queue = self.queues[0]
+        else:
+            queue = self.queues[hash(self.key(item)) % len(self.queues)]
+        await queue.put(item)
+
+    async def _work(self, queue: asyncio.Queue):
+        while True:
+            item = await queue.get()
+            start = time.monotonic()
+            try:
+                await self.handler(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.errors += 1
+                log.exception(f"PipelineStage: {self.name} failed processing {item!r}")
+            finally:
+                self.processed += 1
+                self.busy_time += time.monotonic() - start
+
+
+class DeathCheckScheduler:
+    """Decides which online characters are checked for deaths next.
+
+    Characters that haven't been checked for the longest time go first.
+    Events that make a death more likely, like a level drop, move a character forward as if it had been waiting longer.
+
+    A character's position in the queue is a single timestamp, so the queue is kept as a heap, where outdated entries
+    are skipped instead of removed."""
+    def __init__(self):
+        # Position of each character in the queue, by lowercase name
+        self._positions: Dict[str, float] = {}
+        self._names: Dict[str, str] = {}
+        # Entries as (position, insertion order, lowercase name) tuples, may contain outdated entries
+        self._heap: List[Tuple[float, int, str]] = []
+        self._counter = itertools.count()
+        # Checks made, by reason
+        self.checks = collections.Counter()
+        # Recent deaths detected, as (reason, seconds since the death) tuples
+        self.detections = collections.deque(maxlen=DETECTION_HISTORY)
+
+    def __repr__(self) -> str:
+        return f"DeathCheckScheduler(characters={len(self)})"
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __contains__(self, name: str) -> bool:
+        return name.lower() in self._positions
+
+    def add(self, name: str, position: float = None):
+        """Adds a character to the queue, if it's not in the queue already.
+
+        :param name: The name of the character.
+        :param position: The character's position in the queue, as a timestamp. By default, it's added at the end.
+        """
+        key = name.lower()
+        if key in self._positions:
+            return
+        self._names[key] = name
+        self._push(key, time.time() if position is None else position)
+
+    def remove(self, name: str):
+        """Removes a character from the queue.
+
+        :param name: The name of the character.
+        """
+        key = name.lower()
+        self._positions.pop(key, None)
+        self._names.pop(key, None)
+
+    def clear(self):
+        """Removes all characters from the queue."""
+        self._positions.clear()
+        self._names.clear()
+        self._heap.clear()
+
+    def get_position(self, name: str) -> Optional[float]:
+        """Gets a character's position in the queue.
+
+        :param name: The name of the character.
+        :return: The position as a timestamp, or None if the character is not in the queue.
+        """
+        return self._positions.get(name.lower())
+
+    def checked(self, name: str, reason: str = CHECK_SCHEDULED):
+        """Registers a death check, moving the character to the end of the queue.
+
+        :param name: The name of the character.
+        :param reason: Why the character was checked.
+        """
+        self.checks[reason] += 1
+        key = name.lower()
+        if key in self._positions:
+            self._push(key, time.time())
+
+    def level_changed(self, name: str, old_level: int, new_level: int):
+        """Moves a character forward in the queue if its level changed since the last scan.
+
+        :param name: The name of the character.
+        :param old_level: The level seen on the previous scan.
+        :param new_level: The level seen on the current scan.
+        """
+        if new_level < old_level:
+            self.prioritize(name, LEVEL_DROP_PRIORITY)
+        elif new_level > old_level:
+            self.prioritize(name, LEVEL_UP_PRIORITY)
+
+    def prioritize(self, name: str, seconds: float):
+        """Moves a character forward in the queue.
+
+        :param name: The name of the character.
+        :param seconds: How much longer than it actually has the character will be considered to be waiting.
+        """
+        key = name.lower()
+        if key in self._positions:
+            self._push(key, self._positions[key] - seconds)
+
+    def next(self) -> Optional[str]:
+        """Gets the next character to check, moving it to the end of the queue.
+
+        :return: The name of the character, or None if the queue is empty.
+        """
+        while self._heap:
+            position, _, key = heapq.heappop(self._heap)
+            if self._positions.get(key) != position:
+                # Outdated entry
+                continue
+            self._push(key, time.time())
+            return self._names[key]
+        return None
+
+    def record_detection(self, delay: float, reason: str):
+        """Registers a new death, to keep track of how long deaths take to be detected.
+
+        :param delay: Seconds between the death and its detection.
+        :param reason: Why the character was being checked.
+        """
+        self.detections.append((reason, delay))
+
+    def get_detection_stats(self) -> Dict[str, Tuple[int, float, float]]:
+        """Gets statistics of the recent deaths detected.
+
+        :return: The number of detections, average delay and maximum delay, by the reason of the check.
+        """
+        delays = collections.defaultdict(list)
+        for reason, delay in self.detections:
+            delays[reason].append(delay)
+        return {reason: (len(values), sum(values) / len(values), max(values)) for reason, values in delays.items()}
+
+    def _push(self, key: str, position: float):
+        self._positions[key] = position
+        heapq.heappush(self._heap, (position, next(self._counter), key))
+        # Drop outdated entries once they are the majority
+        if len(self._heap) > 2 * len(self._positions) + 100:
+            self._heap = [(p, i, k) for p, i, k in self._heap if self._positions.get(k) == p]
+            heapq.heapify(self._heap)
+
+
+class WatchedListIndex:
+    """Index of the characters and guilds in every server's watched list.
+
+    Allows finding the watched characters of every server in a single pass over a world's online list."""
+    def __init__(self):
+        # Servers watching each character and guild, by lowercase name
+        self._chars: Dict[str, Set[int]] = collections.defaultdict(set)
+        self._guilds: Dict[str, Set[int]] = collections.defaultdict(set)
+        # Characters and guilds watched by each server, as {lowercase name: name}
+        self._server_chars: Dict[int, Dict[str, str]] = collections.defaultdict(dict)
+        self._server_guilds: Dict[int, Dict[str, str]] = collections.defaultdict(dict)
+
+    def __repr__(self) -> str:
+        return f"WatchedListIndex(servers={len(self.servers())}, characters={len(self._chars)}, " \
+               f"guilds={len(self._guilds)})"
+
+    def load(self):
+        """Loads the watched list entries of every server from the database."""
+        self.clear()
+        c = row_cursor()
+        try:
+            c.execute("SELECT server_id, name, is_guild FROM watched_list")
+            for row in c:
+                self.add(row["server_id"], row["name"], row["is_guild"])
+        finally:
+            c.close()
+
+    def add(self, server_id: int, name: str, is_guild: bool = False):
+        """Adds an entry to a server's watched list.
+
+        :param server_id: The id of the server.
+        :param name: The name of the character or guild.
+        :param is_guild: Whether the entry is a guild or not.
+        """
+        key = name.lower()
+        if is_guild:
+            self._guilds[key].add(server_id)
+            self._server_guilds[server_id][key] = name
+        else:
+            self._chars[key].add(server_id)
+            self._server_chars[server_id][key] = name
+
+    def remove(self, server_id: int, name: str, is_guild: bool = False):
+        """Removes an entry from a server's watched list.
+
+        :param server_id: The id of the server.
+        :param name: The name of the character or guild.
+        :param is_guild: Whether the entry is a guild or not.
+        """
+        key = name.lower()
+        servers, entries = (self._guilds, self._server_guilds) if is_guild else (self._chars, self._server_chars)
+        if key in servers:
+            servers[key].discard(server_id)
+            if not servers[key]:
+                del servers[key]
+        if server_id in entries:
+            entries[server_id].pop(key, None)
+            if not entries[server_id]:
+                del entries[server_id]
+
+    def clear(self):
+        """Removes all entries."""
+        self._chars.clear()
+        self._guilds.clear()
+        self._server_chars.clear()
+        self._server_guilds.clear()
+
+    def is_watched(self, name: str, is_guild: bool = False) -> bool:
+        """Checks if a character or guild is in any server's watched list.
+
+        :param name: The name of the character or guild.
+        :param is_guild: Whether the entry is a guild or not.
+        """
+        return name.lower() in (self._guilds if is_guild else self._chars)
+
+    def servers(self) -> Set[int]:
+        """Gets the ids of the servers with at least one entry in their watched list."""
+        return set(self._server_chars) | set(self._server_guilds)
+
+    def get_guilds(self, server_id: int) -> List[str]:
+        """Gets the guilds in a server's watched list.
+
+        :param server_id: The id of the server.
+        :return: The names of the guilds, sorted.
+        """
+        return sorted(self._server_guilds.get(server_id, {}).values())
+
+    def match(self, online: Iterable[Character]) -> Dict[int, List[Character]]:
+        """Finds the watched characters in an online list, for every server.
+
+        :param online: The characters currently online.
+        :return: The online watched characters, sorted by name, by server id.
+        """
+        matches = collections.defaultdict(list)
+        for char in online:
+            for server_id in self._chars.get(char.name.lower(), ()):
+                matches[server_id].append(char)
+        for chars in matches.values():
+            chars.sort(key=lambda c: c.name)
+        return matches
+
+
+class GuildRosters:
+    """Keeps the members of the watched guilds, so their online members can be found from a world's online list.
+
+    Each guild is only fetched again after a while, no matter how many servers watch it."""
+    def __init__(self, refresh: float = GUILD_ROSTER_REFRESH):
+        self.refresh = refresh
+        # Guilds as (guild, last fetch) tuples, by normalized name, guild is None if it doesn't exist
+        self._guilds: Dict[str, Tuple[Optional[Guild], float]] = {}
+
+    def __repr__(self) -> str:
+        return f"GuildRosters(guilds={len(self._guilds)})"
+
+    def __contains__(self, name: str) -> bool:
+        return normalize_name(name) in self._guilds
+
+    def get(self, name: str) -> Optional[Guild]:
+        """Gets a guild, as it was when it was last fetched.
+
+        :param name: The name of the guild.
+        :return: The guild, or None if it doesn't exist or it hasn't been fetched.
+        """
+        guild, _ = self._guilds.get(normalize_name(name), (None, 0))
+        return guild
+
+    def set(self, name: str, guild: Optional[Guild]):
+        """Saves a guild that was just fetched.
+
+        :param name: The name of the guild.
+        :param guild: The guild, or None if it doesn't exist.
+        """
+        self._guilds[normalize_name(name)] = (guild, time.time())
+
+    def discard(self, name: str):
+        """Removes a guild.
+
+        :param name: The name of the guild.
+        """
+        self._guilds.pop(normalize_name(name), None)
+
+    async def update(self, names: Iterable[str]):
+        """Fetches the guilds that haven't been fetched recently, each one only once.
+
+        Guilds that can't be fetched keep their last known members.
+
+        :param names: The names of the guilds.
+        """
+        now = time.time()
+        outdated = {normalize_name(n): n for n in names
+                    if now - self._guilds.get(normalize_name(n), (None, 0))[1] >= self.refresh}
+        if not outdated:
+            return
+        results = await asyncio.gather(*[get_guild(n, priority=PRIORITY_LOW, fresh=True) for n in outdated.values()],
+                                       return_exceptions=True)
+        for name, result in zip(outdated.values(), results):
+            if isinstance(result, NetworkError):
+                continue
+            if isinstance(result, ParseError):
+                log.warning(f"GuildRosters: Couldn't parse guild {name}, keeping its last known members")
+                continue
+            if isinstance(result, Exception):
+                log.error(f"GuildRosters: Error fetching guild {name}", exc_info=result)
+                continue
+            self.set(name, result)
+
+    def get_online(self, name: str, online: Dict[str, Character]) -> List[Character]:
+        """Gets the online members of a guild.
+
+        :param name: The name of the guild.
+        :param online: The characters online in the guild's world, by lowercase name.
+        :return: The online members, in the guild's order.
+        """
+        guild = self.get(name)
+        if guild is None:
+            return []
+        return [online[m["name"].lower()] for m in guild.members if m["name"].lower() in online]
+
+
+class AnnouncementDispatcher:
+    """Sends level up and death announcements to the servers tracking the character's world.
+
+    Every channel has its own queue, so a slow or rate limited channel doesn't hold back the rest.
+    Announcements that pile up while a channel is busy are joined into a single message."""
+    def __init__(self, bot):
+        self.bot = bot
+        # Announcement channels as (server id, channel id) tuples, by world
+        self._routes: Dict[str, List[Tuple[int, Optional[int]]]] = {}
+        # The tracked worlds the routes were built from
+        self._routes_source: Optional[Dict[int, str]] = None
+        # Messages waiting to be sent, and the task sending them, by channel id
+        self._queues: Dict[int, List[str]] = {}
+        self._senders: Dict[int, asyncio.Future] = {}
+        # Announcements queued, and messages actually sent
+        self.announced = 0
+        self.sent = 0
+
+    def __repr__(self) -> str:
+        return f"AnnouncementDispatcher(pending={sum(len(q) for q in self._queues.values())}, " \
+               f"announced={self.announced}, sent={self.sent})"
+
+    def invalidate(self):
+        """Discards the announcement routes, so they are built again for the next announcement."""
+        self._routes_source = None
+
+    def get_routes(self, world: str) -> List[Tuple[int, Optional[int]]]:
+        """Gets the servers tracking a world and their announcements channel.
+
+        :param world: The name of the world.
+        :return: A list of server id and channel id tuples.
+        """
+        if self._routes_source != self.bot.tracked_worlds:
+            routes = collections.defaultdict(list)
+            for server_id, tracked_world in self.bot.tracked_worlds.items():
+                routes[tracked_world].append((server_id, get_server_property(server_id, "levels_channel",
+                                                                             is_int=True)))
+            self._routes = routes
+            self._routes_source = dict(self.bot.tracked_worlds)
+        return self._routes.get(world, [])
+
+    def announce(self, char: Character, message: str) -> int:
+        """Queues an announcement in the servers tracking the character's world where its owner is a member.
+
+        :param char: The character the announcement is about.
+        :param message: The message to send.
+        :return: The number of channels the announcement was queued in.
+        """
+        count = 0
+        for server_id, channel_id in self.get_routes(char.world):
+            server = self.bot.get_guild(server_id)
+            if server is None or server.get_member(char.owner) is None:
+                continue
+            channel = self.bot.get_channel_or_top(server, channel_id)
+            if channel is None:
+                continue
+            self._queues.setdefault(channel.id, []).append(message)
+            if channel.id not in self._senders:
+                self._senders[channel.id] = asyncio.ensure_future(self._send(channel))
+            count += 1
+        self.announced += count
+        return count
+
+    def close(self):
+        """Cancels the pending announcements."""
+        for task in self._senders.values():
+            task.cancel()
+        self._senders.clear()
+        self._queues.clear()
+
+    async def _send(self, channel: discord.TextChannel):
+        try:
+            pending = self._queues[channel.id]
+            while pending:
+                # Join as many of the queued messages as fit in a single message
+                content = pending.pop(0)
+                while pending and len(content) + len(pending[0]) + 1 <= CONTENT_LIMIT:
+                    content += "\n" + pending.pop(0)
+                try:
+                    await channel.send(content)
+                    self.sent += 1
+                except discord.Forbidden:
+                    log.warning("AnnouncementDispatcher: Missing permissions.")
+                except discord.HTTPException:
+                    log.warning("AnnouncementDispatcher: Malformed message.")
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    # The rest of the queue is still sent
+                    log.exception(f"AnnouncementDispatcher: Couldn't send announcement to channel {channel.id}")
+        finally:
+            self._senders.pop(channel.id, None)
+            self._queues.pop(channel.id, None)
+
+
+def update_highscores(conn: sqlite3.Connection, world: str, category: str,
+                      entries: Iterable[Tuple[int, str, str, int]]) -> int:
+    """Saves the current entries of a highscores category, only writing the entries that changed.
+
+    Value changes, and characters entering or leaving the category, are also recorded in the highscores history, to
+    follow them over time. Rank changes caused by other characters' movements are not recorded.
+    Characters leaving the category are recorded without rank and value.
+
+    :param conn: The connection to the users database, the changes are not committed.
+    :param world: The world's name.
+    :param category: The highscores category.
+    :param entries: The category's entries, as (rank, name, vocation, value) tuples.
+    :return: The number of entries that changed.
+    """
+    now = int(time.time())
+    # Entries are compared by lowercase name, like the name column, so a name's case changing is not a new character
+    new = {}
+    for rank, name, vocation, value in entries:
+        # A character may show up twice if it moved to another page while pages were being fetched
+        if name.lower() not in new:
+            new[name.lower()] = (rank, name, vocation, value)
+    current = {row["name"].lower(): (row["rank"], row["name"], row["vocation"], row["value"]) for row in
+               row_cursor(conn).execute("SELECT rank, name, vocation, value FROM highscores "
+                                        "WHERE world = ? AND category = ?", (world, category))}
+    changed = [(rank, category, world, name, vocation, value) for key, (rank, name, vocation, value) in new.items()
+               if current.get(key) != (rank, name, vocation, value)]
+    removed = [current[key][1] for key in current.keys() - new.keys()]
+    conn.executemany("DELETE FROM highscores WHERE world = ? AND category = ? AND name = ?",
+                     [(world, category, name) for name in removed])
+    conn.executemany("INSERT OR REPLACE INTO highscores(rank, category, world, name, vocation, value) "
+                     "VALUES (?, ?, ?, ?, ?, ?)", changed)
+    history = [(world, category, name, rank, value, now) for rank, _, _, name, _, value in changed
+               if name.lower() not in current or current[name.lower()][3] != value]
+    history.extend((world, category, name, None, None, now) for name in removed)
+    conn.executemany("INSERT INTO highscores_history(world, category, name, rank, value, date) "
+                     "VALUES (?, ?, ?, ?, ?, ?)", history)
+    conn.execute("INSERT OR REPLACE INTO highscores_times(world, category, last_scan) VALUES (?, ?, ?)",
+                 (world, category, now))
+    return len(changed)
+
+
+def save_level_changes(conn: sqlite3.Connection, result: WorldScanResult):
+    """Saves the levels of the registered characters found in a world scan, and their level ups.
+
+    :param conn: The connection to the users database, the changes are not committed.
+    :param result: The world scan's result.
+    """
+    now = time.time()
+    conn.executemany("UPDATE chars SET level = ? WHERE id = ?", result.level_updates)
+    conn.executemany("INSERT INTO char_levelups (char_id,level,date) VALUES(?,?,?)",
+                     [(char_id, level, now) for char_id, level, _, _ in result.levelups])
+
+
+def save_new_deaths(conn: sqlite3.Connection, name: str, deaths: List[Death]) -> List[Death]:
+    """Saves the deaths of a registered character that haven't been saved yet.
+
+    :param conn: The connection to the users database, the changes are not committed.
+    :param name: The name of the character.
+    :param deaths: The character's recent deaths, from newest to oldest.
+    :return: The deaths that were saved, from oldest to newest. Empty if the character is not registered.
+    """
+    result = conn.execute("SELECT id FROM chars WHERE name = ?", (name,)).fetchone()
+    if result is None:
+        return []
+    char_id = result["id"]
+    pending_deaths = []
+    for death in deaths:
+        death_time = death.time.timestamp()
+        # Check if we have a death that matches the time
+        result = conn.execute("SELECT * FROM char_deaths "
+                              "WHERE char_id = ? AND date >= ? AND date <= ? AND level = ? AND killer LIKE ?",
+                              (char_id, death_time - 20, death_time + 20, death.level, death.killer)).fetchone()
+        if result is not None:
+            # We already have this death, we're assuming we already have older deaths
+            break
+        pending_deaths.append(death)
+    pending_deaths.reverse()
+    conn.executemany("INSERT INTO char_deaths(char_id, level, killer, byplayer, date) VALUES(?,?,?,?,?)",
+                     [(char_id, d.level, d.killer, d.by_player, d.time.timestamp()) for d in pending_deaths])
+    return pending_deaths
+
+
+class TrackingState:
+    """Saves the online list and the scanning state, so they can be restored after restarting.
+
+    The state is kept in its own SQLite database, in WAL mode.
+    Each world scan only writes the rows of that world, in a single transaction, so a crash loses at most the last scan
+    and never leaves a partially written state.
+    All queries run in a dedicated thread, so the event loop is never blocked."""
+    def __init__(self, path: str = STATE_DB, legacy_path: str = LEGACY_ONLINE_LIST):
+        self.path = path
+        self.legacy_path = legacy_path
+        # A single thread, so writes are applied in order and the connection is only used by the thread that created it
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._conn: sqlite3.Connection = None
+
+    def __repr__(self) -> str:
+        return f"TrackingState(path={self.path!r})"
+
+    async def _run(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._executor, func, *args)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            with conn:
+                conn.execute("""CREATE TABLE IF NOT EXISTS online_chars (
+                             name TEXT PRIMARY KEY,
+                             world TEXT NOT NULL,
+                             level INTEGER,
+                             vocation TEXT,
+                             death_check REAL
+                             )""")
+                conn.execute("CREATE INDEX IF NOT EXISTS online_chars_world_index ON online_chars(world)")
+                conn.execute("""CREATE TABLE IF NOT EXISTS worlds (
+                             name TEXT PRIMARY KEY,
+                             last_scan REAL
+                             )""")
+            self._conn = conn
+        return self._conn
+
+    async def load(self, expiration: float) -> Tuple[List[Tuple[Character, Optional[float]]], Dict[str, float]]:
+        """Loads the saved state.
+
+        Worlds that haven't been scanned recently are discarded, as their online list is no longer reliable.
+        An online list saved by older versions is imported first, if there's one.
+
+        :param expiration: Seconds after which a world's online list is discarded.
+        :return: The online characters with their death check positions, and the last scan time of each world.
+        """
+        return await self._run(self._load, expiration)
+
+    def _load(self, expiration: float):
+        conn = self._connect()
+        self._import_legacy(conn)
+        with conn:
+            conn.execute("DELETE FROM online_chars WHERE world NOT IN (SELECT name FROM worlds WHERE last_scan > ?)",
+                         (time.time() - expiration,))
+        last_scans = {name: last_scan for name, last_scan in conn.execute("SELECT name, last_scan FROM worlds")}
+        chars = [(Character(name, world, level=level, vocation=vocation, online=True), death_check)
+                 for name, world, level, vocation, death_check
+                 in conn.execute("SELECT name, world, level, vocation, death_check FROM online_chars")]
+        return chars, last_scans
+
+    def _import_legacy(self, conn: sqlite3.Connection):
+        """Imports the online list pickled by older versions, as if its worlds were scanned when it was saved.
+
+        The file is deleted afterwards, even if it couldn't be read. Expired worlds are discarded like any other."""
+        try:
+            with open(self.legacy_path, "rb") as f:
+                saved_list, timestamp = pickle.load(f)
+            rows = [(c.name, c.world, c.level, c.vocation) for c in saved_list]
+        except FileNotFoundError:
+            return
+        except (OSError, EOFError, ValueError, AttributeError, ImportError, pickle.PickleError):
+            log.warning("TrackingState: Couldn't read the old online list, discarding it")
+            rows = None
+        if rows is not None:
+            with conn:
+                # Characters and worlds saved by this version are more recent
+                conn.executemany("INSERT OR IGNORE INTO online_chars(name, world, level, vocation) VALUES(?, ?, ?, ?)",
+                                 rows)
+                conn.executemany("INSERT OR IGNORE INTO worlds(name, last_scan) VALUES(?, ?)",
+                                 [(world, timestamp) for world in {row[1] for row in rows}])
+            log.info(f"TrackingState: Imported {len(rows):,} characters from the old online list")
+        try:
+            os.remove(self.legacy_path)
+        except OSError:
+            log.warning(f"TrackingState: Couldn't delete {self.legacy_path}")
+
+    async def save_world(self, world: str, online: Iterable[Character], removed: Iterable[str],
+                         death_scheduler: 'DeathCheckScheduler' = None):
+        """Saves the changes found in a world scan.
+
+        :param world: The name of the world.
+        :param online: The world's characters in the online list.
+        :param removed: The names of the characters that were removed from the online list.
+        :param death_scheduler: The death check scheduler, to save the characters' positions.
+        """
+        position = death_scheduler.get_position if death_scheduler is not None else lambda _: None
+        rows = [(c.name, c.world, c.level, c.vocation, position(c.name)) for c in online]
+        await self._run(self._save_world, world, rows, [(name,) for name in removed], time.time())
+
+    def _save_world(self, world: str, rows: List[tuple], removed: List[tuple], scan_time: float):
+        conn = self._connect()
+        with conn:
+            conn.executemany("DELETE FROM online_chars WHERE name = ?", removed)
+            conn.executemany("INSERT OR REPLACE INTO online_chars(name, world, level, vocation, death_check) "
+                             "VALUES(?, ?, ?, ?, ?)", rows)
+            conn.execute("INSERT OR REPLACE INTO worlds(name, last_scan) VALUES(?, ?)", (world, scan_time))
+
+    async def remove_worlds(self, worlds: Iterable[str]):
+        """Removes the saved state of worlds that are no longer scanned.
+
+        :param worlds: The names of the worlds.
+        """
+        await self._run(self._remove_worlds, [(world,) for world in worlds])
+
+    def _remove_worlds(self, worlds: List[tuple]):
+        conn = self._connect()
+        with conn:
+            conn.executemany("DELETE FROM online_chars WHERE world = ?", worlds)
+            conn.executemany("DELETE FROM worlds WHERE name = ?", worlds)
+
+
+# Death checks queue for the characters in the online list
+death_scheduler = DeathCheckScheduler()
+# Watched list entries of every server
+watched_index = WatchedListIndex()
+# Members of the watched guilds
+guild_rosters = GuildRosters()
+# Saved state of the online list
+tracking_state = TrackingState()